@@ -0,0 +1,315 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module which receives the applications on a single asyncio event loop."""
+
+import asyncio
+import concurrent.futures
+import threading
+
+from protocol import ChannelKind
+from protocol import HEADER
+from protocol import HELLO
+from protocol import LEGACY_PROTOCOL_VERSION
+from protocol import MessageFlags
+from protocol import MessageType
+from protocol import pack_hello
+from protocol import PROTOCOL_VERSION
+from protocol import ProtocolError
+from protocol import SIZE
+from protocol import unpack_header
+from protocol import unpack_hello
+from protocol import unpack_legacy
+from stream_receiver import BaseStreamReceiver
+
+
+class AsyncStreamReceiver(BaseStreamReceiver):
+  """Receiver serving all the clients from one asyncio event loop.
+
+  Every connection is served by a reading coroutine and a writing coroutine,
+  frames are decoded in order per connection on a thread pool so reading the
+  next frame overlaps with decoding the previous one. Interaction events are
+  routed to the connection streaming their window.
+  """
+
+  def __init__(self, host, port, slots=8, max_pending_frames=2,
+               decode_workers=None, instrumentation=None):
+    """Initializes the receiver.
+
+    Args:
+      host: ip the receiver listens on.
+      port: port the receiver listens on.
+      slots: max number of clients connected at the same time.
+      max_pending_frames: frames of a connection waiting to be decoded before
+        its socket stops being read.
+      decode_workers: number of decoding threads, None for the default.
+      instrumentation: optional Instrumentation recording the receiving
+        stages.
+    """
+    super().__init__(instrumentation)
+    self.__host = host
+    self.__port = port
+    self.__slots = slots
+    self.max_pending_frames = max_pending_frames
+    self._used_slots = 0
+    self._running = False
+    self.interaction_events = _ThreadSafeEventQueue()
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        decode_workers, thread_name_prefix="decode"
+    )
+    self._loop = None
+    self._stop_event = None
+    self._started = threading.Event()
+    self._server_thread = None
+    self._sessions = set()
+    self._window_sessions: dict[int, _AsyncClientSession] = {}
+    self._channels = {}
+
+  def start_server(self):
+    """start the event loop thread."""
+    if self._running:
+      print("Server is already running")
+    else:
+      self._running = True
+      self._started.clear()
+      self._server_thread = threading.Thread(
+          target=asyncio.run, args=(self.serve(),)
+      )
+      self._server_thread.start()
+      self._started.wait()
+
+  def stop_server(self):
+    """stop the event loop thread, the connections and the decoding threads."""
+    if self._running:
+      self._running = False
+      self._loop.call_soon_threadsafe(self._stop_event.set)
+      self._server_thread.join()
+      # the decoding threads exit once the frames submitted are decoded
+      self._executor.shutdown(wait=False)
+    else:
+      print("Server not running!")
+
+  async def serve(self):
+    """serve the clients until stop_server is called."""
+    self._loop = asyncio.get_running_loop()
+    self._stop_event = asyncio.Event()
+    self.interaction_events.attach(self._loop)
+
+    try:
+      server = await asyncio.start_server(
+          self.__handle_client, self.__host, self.__port
+      )
+    except OSError as e:
+      print(f"Failed to start the server: {e}")
+      self._running = False
+      self._started.set()
+      return
+    dispatcher = asyncio.create_task(self.__dispatch_events())
+    print(f"Server is listening on {self.__host}:{self.__port}")
+    self._started.set()
+
+    await self._stop_event.wait()
+
+    server.close()
+    for session in list(self._sessions):
+      session.writer.close()
+    await asyncio.gather(
+        *(session.task for session in list(self._sessions)),
+        return_exceptions=True,
+    )
+    dispatcher.cancel()
+    await server.wait_closed()
+
+  async def __handle_client(self, reader, writer):
+    """serve a client connection."""
+    if self._used_slots >= self.__slots:
+      print("Connection refused! No free slots!")
+      writer.close()
+      return
+    self._used_slots += 1
+
+    session = _AsyncClientSession(writer, asyncio.current_task())
+    self._sessions.add(session)
+    frames = asyncio.Queue(self.max_pending_frames)
+    decoder = asyncio.create_task(self.__decode_frames(frames))
+    sender = asyncio.create_task(self.__send_events(session))
+
+    try:
+      await self.__read_frames(session, reader, frames)
+    except (asyncio.IncompleteReadError, ConnectionResetError) as e:
+      print(f"Connection closed: {e}")
+    except (UnicodeDecodeError, ValueError, ProtocolError) as e:
+      print(f"Invalid data received: {e}")
+    finally:
+      await frames.put(None)
+      await decoder
+      sender.cancel()
+      self._sessions.discard(session)
+      for window_id in [
+          window_id
+          for window_id, window_session in self._window_sessions.items()
+          if window_session is session
+      ]:
+        del self._window_sessions[window_id]
+      self._unbind_channel(self._channels, session)
+      self._used_slots -= 1
+      writer.close()
+
+  async def __read_frames(self, session, reader, frames):
+    """read the messages of a connection and queue the frames to decode."""
+    while True:
+      if session.protocol_version == LEGACY_PROTOCOL_VERSION:
+        metadata_size = SIZE.unpack(await reader.readexactly(SIZE.size))[0]
+        metadata = (await reader.readexactly(metadata_size)).decode("utf-8")
+        window_id, data_type, payload_length = unpack_legacy(metadata)
+        flags = MessageFlags.END_OF_FRAME
+        timestamp = 0.0
+      else:
+        header = unpack_header(await reader.readexactly(HEADER.size))
+        window_id = header.window_id
+        data_type = header.message_type
+        flags = header.flags
+        timestamp = header.timestamp
+        payload_length = header.payload_length
+
+      start = self.instrumentation.now()
+      data = await reader.readexactly(payload_length)
+      self.instrumentation.record(window_id, "receive", start)
+
+      if data_type == MessageType.HELLO:
+        await self.__negotiate_protocol(session, data)
+        continue
+      if data_type == MessageType.CHANNEL:
+        self._bind_channel(
+            self._channels,
+            session,
+            session.writer.get_extra_info("socket"),
+            data,
+        )
+        continue
+
+      self._window_sessions[window_id] = session
+      # waits when the decoding lags behind, which stops reading the socket
+      await frames.put((data, window_id, data_type, flags, timestamp))
+
+  async def __negotiate_protocol(self, session, data):
+    """answer the HELLO of the client with the version to use."""
+    version = unpack_hello(data)
+    if version is None:
+      print("Invalid protocol negotiation.")
+      return
+    version = min(version, PROTOCOL_VERSION)
+    session.writer.write(SIZE.pack(HELLO.size) + pack_hello(version))
+    await session.writer.drain()
+    session.protocol_version = version
+    print(f"Using protocol version {version}.")
+
+  async def __decode_frames(self, frames):
+    """decode the frames of a connection in order until None is queued."""
+    while True:
+      frame = await frames.get()
+      if frame is None:
+        return
+      try:
+        await self._loop.run_in_executor(
+            self._executor, self._process_incoming_data, *frame
+        )
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Failed to process a frame: {e}")
+
+  async def __dispatch_events(self):
+    """route the interaction events to the connection of their window."""
+    while True:
+      event = await self.interaction_events.get()
+      session = self._window_sessions.get(event.window_id)
+      if session is None:
+        print(f"No connection for the event {event}")
+        continue
+      if session.channel_id is not None:
+        # a dual channel session receives the events on its own connection
+        session = self._channels.get(session.channel_id, {}).get(
+            ChannelKind.EVENTS, session
+        )
+      session.events.put_nowait(event)
+
+  async def __send_events(self, session):
+    """write the events of a connection, waiting for the socket to drain."""
+    while True:
+      events = [await session.events.get()]
+      while not session.events.empty():
+        events.append(session.events.get_nowait())
+
+      session.writer.write(
+          b"".join(
+              self._pack_event(event, session.protocol_version)
+              for event in events
+          )
+      )
+      try:
+        await session.writer.drain()
+      except ConnectionError as e:
+        print(f"Failed to send the events: {e}")
+        return
+
+
+class _AsyncClientSession:
+  """State of a client connection.
+
+  Attributes:
+    writer: the asyncio.StreamWriter of the connection.
+    task: the task serving the connection.
+    protocol_version: negotiated protocol version.
+    channel_id: session id of a dual channel session, None otherwise.
+    events: asyncio.Queue of the events to send.
+  """
+
+  def __init__(self, writer, task):
+    self.writer = writer
+    self.task = task
+    self.protocol_version = LEGACY_PROTOCOL_VERSION
+    self.channel_id = None
+    self.events = asyncio.Queue()
+
+
+class _ThreadSafeEventQueue:
+  """Lets the display threads put events in an asyncio.Queue of the loop."""
+
+  def __init__(self):
+    self._loop = None
+    self._queue = None
+
+  def attach(self, loop):
+    """bind the queue to the event loop it is consumed from."""
+    self._loop = loop
+    self._queue = asyncio.Queue()
+
+  def put(self, event):
+    """put an event from any thread."""
+    if self._loop is not None:
+      self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+  async def get(self):
+    """get the next event from the event loop."""
+    return await self._queue.get()
+
+
+if __name__ == "__main__":
+  # replace the ip with the ip of the machine you want to connect to
+
+  server = AsyncStreamReceiver("127.0.0.1", 9999)
+  server.start_server()
+
+  while input("") != "STOP":
+    continue
+
+  server.stop_server()
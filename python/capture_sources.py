@@ -0,0 +1,255 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing the frame sources a StreamingClient can capture from.
+
+WindowCapture captures a window with the win32 API, the sources below do not
+depend on it so the pipeline can be benchmarked on any platform.
+"""
+
+import abc
+import argparse
+import os
+import time
+import cv2
+import numpy as np
+
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+class CaptureSource(abc.ABC):
+  """Source of the frames streamed by a StreamingClient."""
+
+  @abc.abstractmethod
+  def screenshot(self):
+    """Captures a frame.
+
+    Returns:
+      the frame as a height x width x 4 uint8 BGRX array, like the win32
+      capture. The frame is streamed without being copied, the source must
+      not modify it afterwards.
+
+    Raises:
+      ScreenCaptureError: if the frame could not be captured.
+    """
+
+  def close(self):
+    """release the resources of the source."""
+
+
+class SyntheticSource(CaptureSource):
+  """Deterministic generated frames mimicking typical windows.
+
+  Patterns:
+    static_ui: a static user interface with a blinking text cursor, only a
+      few pixels change every blink_period frames.
+    scrolling_text: a page of text scrolling by scroll_speed pixels a frame,
+      the whole frame changes.
+    noise: smooth moving noise like a video, the whole frame changes and it
+      compresses badly.
+
+  Attributes:
+    pattern: the pattern generated.
+    frame_index: number of frames generated.
+  """
+
+  PATTERNS = ("static_ui", "scrolling_text", "noise")
+
+  def __init__(
+      self,
+      pattern="static_ui",
+      width=1280,
+      height=720,
+      seed=0,
+      blink_period=8,
+      scroll_speed=4,
+  ):
+    """Initializes the source.
+
+    Args:
+      pattern: one of PATTERNS.
+      width: width of the frames.
+      height: height of the frames.
+      seed: seed of the generated content, the same seed always generates
+        the same frames.
+      blink_period: frames between two blinks of the cursor of static_ui.
+      scroll_speed: pixels scrolled per frame by scrolling_text.
+    """
+    if pattern not in self.PATTERNS:
+      raise ValueError(f"Unknown pattern {pattern}, expected {self.PATTERNS}")
+    self.pattern = pattern
+    self.width = width
+    self.height = height
+    self.seed = seed
+    self.blink_period = blink_period
+    self.scroll_speed = scroll_speed
+    self.frame_index = 0
+
+    rng = np.random.default_rng(seed)
+    if pattern == "static_ui":
+      self._background = self._draw_ui(rng)
+    elif pattern == "scrolling_text":
+      self._page = self._draw_text(rng, 2 * height, (255, 255, 255, 0))
+
+  def _draw_text(self, rng, height, background):
+    """draw lines of random words on a background."""
+    image = np.empty((height, self.width, 4), dtype=np.uint8)
+    image[:] = background
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    for y in range(20, height, 20):
+      words = [
+          "".join(rng.choice(letters, rng.integers(2, 10)))
+          for _ in range(self.width // 60)
+      ]
+      cv2.putText(
+          image,
+          " ".join(words),
+          (8, y),
+          cv2.FONT_HERSHEY_SIMPLEX,
+          0.45,
+          (30, 30, 30, 0),
+          1,
+          cv2.LINE_AA,
+      )
+    return image
+
+  def _draw_ui(self, rng):
+    """draw a toolbar, a side panel and a text area."""
+    image = self._draw_text(rng, self.height, (245, 245, 245, 0))
+    image[:40] = (200, 120, 60, 0)
+    image[40:, : self.width // 5] = (230, 225, 220, 0)
+    for y in range(60, self.height - 30, 36):
+      cv2.rectangle(
+          image,
+          (10, y),
+          (self.width // 5 - 10, y + 24),
+          (180, 170, 160, 0),
+          -1,
+      )
+    return image
+
+  def screenshot(self):
+    """returns the next frame of the pattern."""
+    index = self.frame_index
+    self.frame_index += 1
+
+    if self.pattern == "static_ui":
+      frame = self._background.copy()
+      if (index // self.blink_period) % 2 == 0:
+        x, y = self.width // 2, self.height // 2
+        frame[y - 8 : y + 8, x : x + 2] = (0, 0, 0, 0)
+      return frame
+
+    if self.pattern == "scrolling_text":
+      offset = index * self.scroll_speed % self._page.shape[0]
+      rows = np.arange(offset, offset + self.height) % self._page.shape[0]
+      return self._page[rows]
+
+    # noise: low resolution noise upscaled and drifting with the frames
+    rng = np.random.default_rng((self.seed, index))
+    cells = rng.integers(
+        0, 256, (self.height // 16 + 1, self.width // 16 + 1, 4), np.uint8
+    )
+    frame = cv2.resize(
+        cells,
+        (self.width + 16, self.height + 16),
+        interpolation=cv2.INTER_LINEAR,
+    )
+    shift = index % 16
+    return np.ascontiguousarray(
+        frame[shift : shift + self.height, shift : shift + self.width]
+    )
+
+
+class ImageSequenceSource(CaptureSource):
+  """Frames read from image files, e.g. screenshots of a real session.
+
+  The images are decoded once when the source is created so reading them
+  does not weigh on the measurements.
+
+  Attributes:
+    frames: the decoded frames.
+    loop: whether the sequence restarts at the end, otherwise the last frame
+      is repeated like a window that stopped changing.
+    frame_index: number of frames returned.
+  """
+
+  def __init__(self, paths, loop=True):
+    """Initializes the source.
+
+    Args:
+      paths: a directory, whose images are read in name order, or a list of
+        image paths.
+      loop: whether the sequence restarts at the end.
+
+    Raises:
+      ValueError: if no image could be read.
+    """
+    if isinstance(paths, (str, os.PathLike)):
+      paths = [
+          os.path.join(paths, name)
+          for name in sorted(os.listdir(paths))
+          if name.lower().endswith(_IMAGE_EXTENSIONS)
+      ]
+    self.frames = []
+    for path in paths:
+      image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+      if image is None:
+        print(f"Could not read the image {path}")
+      elif image.ndim == 2:
+        self.frames.append(cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA))
+      elif image.shape[2] == 3:
+        self.frames.append(cv2.cvtColor(image, cv2.COLOR_BGR2BGRA))
+      else:
+        self.frames.append(image)
+    if not self.frames:
+      raise ValueError("No image found for the sequence!")
+    self.loop = loop
+    self.frame_index = 0
+
+  def screenshot(self):
+    """returns the next image of the sequence."""
+    if self.loop:
+      frame = self.frames[self.frame_index % len(self.frames)]
+    else:
+      frame = self.frames[min(self.frame_index, len(self.frames) - 1)]
+    self.frame_index += 1
+    return frame
+
+
+class ScreenCaptureError(Exception):
+  """Custom exception for screencapture."""
+
+  def __init__(
+      self, message="the incoming streaming of serialized images had a problem"
+  ):
+    self.message = message
+    super().__init__(message)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="measure the frame rate of the synthetic patterns"
+  )
+  parser.add_argument("--width", type=int, default=1280)
+  parser.add_argument("--height", type=int, default=720)
+  parser.add_argument("--frames", type=int, default=100)
+  args = parser.parse_args()
+
+  for source_pattern in SyntheticSource.PATTERNS:
+    source = SyntheticSource(source_pattern, args.width, args.height)
+    start_time = time.perf_counter()
+    for _ in range(args.frames):
+      source.screenshot()
+    elapsed_time = time.perf_counter() - start_time
+    print(f"{source_pattern:>14}: {args.frames / elapsed_time:8.1f} fps")
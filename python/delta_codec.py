@@ -0,0 +1,267 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing a lossless inter-frame codec for the video mode.
+
+A KEYFRAME message carries a whole frame compressed with zlib, the DELTA
+messages following it carry the XOR of the changed regions of the frame with
+the previous frame, also compressed with zlib. Only the changed tiles are
+sent and their unchanged pixels XOR to zero, so a delta of a window where a
+few pixels changed is a few hundred bytes.
+
+Scrolling moves most of the pixels of a text window, the encoder detects the
+vertical scroll and the decoder shifts its previous frame by the same number
+of rows before applying the delta, which is then limited to the rows that
+scrolled in.
+
+Both payloads start with the DELTA_HEADER width, height, channels, number of
+regions and scrolled rows. A delta follows it with the PATCH_HEADER rectangle
+of each region and then with the zlib stream of the regions, one after the
+other.
+"""
+
+import argparse
+import struct
+import zlib
+
+from capture_sources import SyntheticSource
+import cv2
+from frame_diff import PATCH_HEADER
+from frame_diff import TileChangeDetector
+import numpy as np
+from protocol import MessageType
+
+DELTA_HEADER = struct.Struct("<4Ii")
+
+
+class DeltaEncoder:
+  """Encodes the frames of a window as keyframes and deltas.
+
+  The encoder is stateful, the frames have to be encoded, sent and decoded
+  in order.
+
+  Attributes:
+    keyframe_interval: frames encoded between two periodic keyframes.
+    level: zlib compression level.
+    detect_scroll: look for a vertical scroll when most of the frame changed.
+  """
+
+  def __init__(self, keyframe_interval=100, level=1, detect_scroll=True):
+    self.keyframe_interval = keyframe_interval
+    self.level = level
+    self.detect_scroll = detect_scroll
+    self._reference = None
+    self._reference_rows = None
+    self._since_keyframe = 0
+    self._keyframe_requested = False
+
+  def request_keyframe(self):
+    """encode the next frame as a keyframe, e.g. for a receiver joining."""
+    self._keyframe_requested = True
+
+  def encode(self, frame, rects=None):
+    """Encodes a frame.
+
+    Args:
+      frame (numpy.ndarray): the frame, height x width x channels uint8.
+      rects: (x, y, width, height) regions changed since the previous frame
+        encoded, None if unknown.
+
+    Returns:
+      tuple of the MessageType, KEYFRAME or DELTA, and the payload.
+    """
+    height, width = frame.shape[:2]
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    if rects is None:
+      rects = [(0, 0, width, height)]
+    rows = None
+    if self.detect_scroll and (
+        sum(w * h for _, _, w, h in rects) > width * height / 2
+    ):
+      rows = [hash(row.tobytes()) for row in frame]
+
+    if (
+        self._keyframe_requested
+        or self._reference is None
+        or self._reference.shape != frame.shape
+        or self._since_keyframe >= self.keyframe_interval
+    ):
+      self._keyframe_requested = False
+      self._since_keyframe = 0
+      self._reference = np.array(frame, copy=True, order="C")
+      self._reference_rows = rows
+      return (
+          MessageType.KEYFRAME,
+          DELTA_HEADER.pack(width, height, channels, 0, 0)
+          + zlib.compress(self._reference, self.level),
+      )
+
+    self._since_keyframe += 1
+    scroll = 0
+    if rows is not None and self._reference_rows is not None:
+      scroll = _find_scroll(self._reference_rows, rows)
+    if scroll:
+      _scroll(self._reference, scroll)
+      rects = _changed_rows(_scroll(self._reference_rows, scroll), rows, width)
+    self._reference_rows = rows
+
+    compressor = zlib.compressobj(self.level)
+    payload = [DELTA_HEADER.pack(width, height, channels, len(rects), scroll)]
+    payload.extend(PATCH_HEADER.pack(*rect) for rect in rects)
+    for x, y, w, h in rects:
+      region = frame[y : y + h, x : x + w]
+      reference = self._reference[y : y + h, x : x + w]
+      payload.append(compressor.compress(np.bitwise_xor(region, reference)))
+      np.copyto(reference, region)
+    payload.append(compressor.flush())
+    return MessageType.DELTA, b"".join(payload)
+
+
+class DeltaDecoder:
+  """Decodes the keyframes and deltas of a window."""
+
+  def __init__(self):
+    self._reference = None
+
+  def decode(self, message_type, data):
+    """Decodes a message.
+
+    Args:
+      message_type: KEYFRAME or DELTA.
+      data: the payload.
+
+    Returns:
+      the decoded frame, height x width x channels uint8, valid until the
+      next call. None for a delta without the keyframe it applies on.
+    """
+    width, height, channels, count, scroll = DELTA_HEADER.unpack_from(data)
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    offset = DELTA_HEADER.size + count * PATCH_HEADER.size
+    pixels = np.frombuffer(
+        zlib.decompress(memoryview(data)[offset:]), dtype=np.uint8
+    )
+
+    if message_type == MessageType.KEYFRAME:
+      self._reference = pixels.reshape(shape).copy()
+      return self._reference
+
+    if self._reference is None or self._reference.shape != shape:
+      # deltas are dropped until the next keyframe
+      return None
+    if scroll:
+      _scroll(self._reference, scroll)
+    start = 0
+    for i in range(count):
+      x, y, w, h = PATCH_HEADER.unpack_from(
+          data, DELTA_HEADER.size + i * PATCH_HEADER.size
+      )
+      reference = self._reference[y : y + h, x : x + w]
+      end = start + reference.size
+      np.bitwise_xor(
+          reference, pixels[start:end].reshape(reference.shape), out=reference
+      )
+      start = end
+    return self._reference
+
+  def reset(self):
+    """forget the reference frame."""
+    self._reference = None
+
+
+def _find_scroll(reference_rows, rows):
+  """Finds the vertical scroll between two frames from the hashes of their rows.
+
+  Every row of the frame also found once, and only once, in the reference
+  votes for the scroll moving it there.
+
+  Args:
+    reference_rows: hashes of the rows of the reference.
+    rows: hashes of the rows of the frame.
+
+  Returns:
+    the number of rows the content moved up, negative if it moved down, 0 if
+    no scroll explains the frame better than no scroll at all.
+  """
+  positions = {}
+  for j, row in enumerate(reference_rows):
+    positions[row] = None if row in positions else j
+  votes = {}
+  for i, row in enumerate(rows):
+    j = positions.get(row)
+    if j is not None:
+      votes[j - i] = votes.get(j - i, 0) + 1
+  if not votes:
+    return 0
+  scroll = max(votes, key=votes.get)
+  if abs(scroll) >= len(rows) or votes[scroll] <= votes.get(0, 0):
+    return 0
+  return scroll
+
+
+def _scroll(rows, scroll):
+  """Moves rows up by scroll, down if negative, in place.
+
+  The rows left uncovered keep their previous content.
+
+  Returns:
+    the rows.
+  """
+  if scroll > 0:
+    rows[:-scroll] = rows[scroll:]
+  else:
+    rows[-scroll:] = rows[:scroll]
+  return rows
+
+
+def _changed_rows(reference_rows, rows, width):
+  """returns the full width rectangles of the runs of rows differing."""
+  rects = []
+  start = None
+  for y, (reference_row, row) in enumerate(zip(reference_rows, rows)):
+    if reference_row != row and start is None:
+      start = y
+    elif reference_row == row and start is not None:
+      rects.append((0, start, width, y - start))
+      start = None
+  if start is not None:
+    rects.append((0, start, width, len(rows) - start))
+  return rects
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="bytes per frame of the delta codec against jpg"
+  )
+  parser.add_argument("--frames", type=int, default=50)
+  args = parser.parse_args()
+
+  encoding_parameters = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+  for source_pattern in SyntheticSource.PATTERNS:
+    source = SyntheticSource(source_pattern)
+    detector = TileChangeDetector()
+    encoder = DeltaEncoder()
+    jpg_bytes = delta_bytes = changed_frames = 0
+    for _ in range(args.frames):
+      captured = source.screenshot()
+      dirty_rects = detector.detect(captured)
+      if not dirty_rects:
+        continue
+      # like the StreamingClient, only the changed frames are sent
+      changed_frames += 1
+      jpg_bytes += len(cv2.imencode(".jpg", captured, encoding_parameters)[1])
+      delta_bytes += len(encoder.encode(captured, dirty_rects)[1])
+    print(
+        f"{source_pattern:>14}: {changed_frames} frames sent, "
+        f"jpg {jpg_bytes / changed_frames / 1e3:8.1f} kB, "
+        f"delta {delta_bytes / changed_frames / 1e3:8.1f} kB per frame"
+    )
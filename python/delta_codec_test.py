@@ -0,0 +1,115 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests that the DeltaEncoder and DeltaDecoder round trip is bit-exact."""
+
+import unittest
+
+from capture_sources import SyntheticSource
+from delta_codec import DELTA_HEADER
+from delta_codec import DeltaDecoder
+from delta_codec import DeltaEncoder
+from frame_diff import TileChangeDetector
+import numpy as np
+from protocol import MessageType
+
+
+def _random_frame(rng, height=120, width=160):
+  """a BGRX frame of random pixels."""
+  return rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+
+
+class DeltaCodecTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.rng = np.random.default_rng(0)
+    self.encoder = DeltaEncoder()
+    self.decoder = DeltaDecoder()
+
+  def _round_trip(self, frame, rects=None):
+    """encodes and decodes a frame, checks it is unchanged."""
+    message_type, data = self.encoder.encode(frame, rects)
+    decoded = self.decoder.decode(message_type, data)
+    np.testing.assert_array_equal(decoded, frame)
+    return message_type, data
+
+  def test_keyframe(self):
+    frame = _random_frame(self.rng)
+    message_type, _ = self._round_trip(frame)
+    self.assertEqual(message_type, MessageType.KEYFRAME)
+
+  def test_delta_of_a_changed_region(self):
+    frame = _random_frame(self.rng)
+    _, keyframe = self._round_trip(frame)
+    frame = frame.copy()
+    frame[10:20, 30:50] = 255
+    message_type, delta = self._round_trip(frame, [(30, 10, 20, 10)])
+    self.assertEqual(message_type, MessageType.DELTA)
+    self.assertLess(len(delta), len(keyframe) / 10)
+
+  def test_scroll(self):
+    frame = _random_frame(self.rng)
+    self._round_trip(frame)
+    scrolled = np.concatenate(
+        (frame[12:], _random_frame(self.rng, height=12))
+    )
+    message_type, delta = self._round_trip(scrolled)
+    self.assertEqual(message_type, MessageType.DELTA)
+    _, _, _, count, scroll = DELTA_HEADER.unpack_from(delta)
+    self.assertEqual(scroll, 12)
+    # only the rows scrolled in are sent
+    self.assertEqual(count, 1)
+
+  def test_requested_keyframe(self):
+    frame = _random_frame(self.rng)
+    self._round_trip(frame)
+    self.encoder.request_keyframe()
+    message_type, _ = self._round_trip(frame)
+    self.assertEqual(message_type, MessageType.KEYFRAME)
+    message_type, _ = self._round_trip(frame, [])
+    self.assertEqual(message_type, MessageType.DELTA)
+
+  def test_keyframe_interval(self):
+    self.encoder = DeltaEncoder(keyframe_interval=3)
+    message_types = []
+    for _ in range(8):
+      frame = _random_frame(self.rng)
+      message_types.append(self._round_trip(frame)[0])
+    self.assertEqual(
+        message_types,
+        ([MessageType.KEYFRAME] + [MessageType.DELTA] * 3) * 2,
+    )
+
+  def test_delta_without_keyframe_is_dropped(self):
+    encoder = DeltaEncoder()
+    frame = _random_frame(self.rng)
+    encoder.encode(frame)
+    message_type, data = encoder.encode(frame, [])
+    self.assertEqual(message_type, MessageType.DELTA)
+    self.assertIsNone(self.decoder.decode(message_type, data))
+
+  def test_synthetic_sources(self):
+    for pattern in SyntheticSource.PATTERNS:
+      with self.subTest(pattern=pattern):
+        self.encoder = DeltaEncoder(keyframe_interval=10)
+        self.decoder = DeltaDecoder()
+        source = SyntheticSource(pattern, 320, 240, seed=1)
+        detector = TileChangeDetector()
+        for _ in range(25):
+          frame = source.screenshot()
+          self._round_trip(frame, detector.detect(frame))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,293 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing the frame encoding shared by the streaming clients."""
+
+import collections
+import concurrent.futures
+import math
+import threading
+
+import cv2
+from frame_diff import pack_patch
+import numpy as np
+from protocol import MessageFlags
+from protocol import MessageType
+
+PNG_PARAMETERS = [int(cv2.IMWRITE_PNG_COMPRESSION), 1]
+
+
+def encode_frame(
+    frame, encoding_parameters, rects=None, scale=1.0, lossless_colors=0
+):
+  """Encodes a frame, or only some regions of it, as jpg or png.
+
+  This is a module level function so it can be run in a process pool.
+
+  Args:
+    frame (numpy.ndarray): the frame to encode.
+    encoding_parameters: cv2.imencode parameters.
+    rects: optional list of (x, y, width, height) regions to encode as patches.
+    scale: downscale factor applied before encoding, the scaled messages start
+      with the rectangle they have to be resized to.
+    lossless_colors: regions at native scale with at most this many colours,
+      counted by count_colors, are encoded as png, 0 to always use jpg.
+
+  Returns:
+    list of (MessageType, MessageFlags, bytes) messages ready to be sent.
+  """
+  if rects is None:
+    height, width = frame.shape[:2]
+    if scale == 1.0:
+      encoded = _encode_region(frame, encoding_parameters, lossless_colors)
+      return [(MessageType.FRAME, MessageFlags.NONE, encoded)]
+    return [(
+        MessageType.FRAME,
+        MessageFlags.SCALED,
+        _encode_scaled(frame, (0, 0, width, height), encoding_parameters,
+                       scale),
+    )]
+
+  messages = []
+  for x, y, w, h in rects:
+    region = frame[y : y + h, x : x + w]
+    if scale == 1.0:
+      encoded = _encode_region(region, encoding_parameters, lossless_colors)
+      data = pack_patch((x, y, w, h), encoded)
+      flags = MessageFlags.NONE
+    else:
+      data = _encode_scaled(region, (x, y, w, h), encoding_parameters, scale)
+      flags = MessageFlags.SCALED
+    messages.append((MessageType.PATCH, flags, data))
+  return messages
+
+
+def encode_regions(frame, parts, lossless_colors=0):
+  """Encodes parts of a frame with their own parameters, as one frame.
+
+  The messages are concatenated in order, the receiver applies the later
+  patches over the earlier ones.
+
+  Args:
+    frame (numpy.ndarray): the frame to encode.
+    parts: list of (encoding_parameters, rects, scale) passed to
+      encode_frame.
+    lossless_colors: passed to encode_frame.
+
+  Returns:
+    list of (MessageType, MessageFlags, bytes) messages ready to be sent.
+  """
+  messages = []
+  for encoding_parameters, rects, scale in parts:
+    messages += encode_frame(
+        frame, encoding_parameters, rects, scale, lossless_colors
+    )
+  return messages
+
+
+def _encode_region(region, encoding_parameters, lossless_colors):
+  """encodes a region as png if it has few colours, as jpg otherwise."""
+  if lossless_colors and count_colors(region) <= lossless_colors:
+    # the X channel would make the png transparent
+    _, encoded = cv2.imencode(".png", region[..., :3], PNG_PARAMETERS)
+  else:
+    _, encoded = cv2.imencode(".jpg", region, encoding_parameters)
+  return encoded.tobytes()
+
+
+def count_colors(region, samples=4096):
+  """Counts the colours of a region on a subsample of its pixels.
+
+  Flat user interface has a few colours, antialiased text a few dozens,
+  photos and video thousands.
+
+  Args:
+    region (numpy.ndarray): BGR or BGRX pixels.
+    samples: about how many pixels, evenly spread, are counted.
+
+  Returns:
+    the number of distinct colours of the subsample.
+  """
+  height, width = region.shape[:2]
+  step = max(1, math.isqrt(height * width // samples))
+  sample = region[::step, ::step]
+  if sample.ndim == 2:
+    return len(np.unique(sample))
+  sample = sample.astype(np.uint32)
+  return len(np.unique(
+      sample[..., 0] | sample[..., 1] << 8 | sample[..., 2] << 16
+  ))
+
+
+def _encode_scaled(region, rect, encoding_parameters, scale):
+  """downscales and encodes a region, prefixed by its full size rectangle."""
+  width = max(1, round(rect[2] * scale))
+  height = max(1, round(rect[3] * scale))
+  region = cv2.resize(region, (width, height), interpolation=cv2.INTER_AREA)
+  _, encoded = cv2.imencode(".jpg", region, encoding_parameters)
+  return pack_patch(rect, encoded.tobytes())
+
+
+class _EncodeJob:
+  """A frame waiting to be encoded or delivered."""
+
+  def __init__(self, future, on_done, on_drop):
+    self.future = future
+    self.on_done = on_done
+    self.on_drop = on_drop
+    self.dropped = False
+
+
+class EncodePool:
+  """Encoding stage shared by all the StreamingClient of a connection.
+
+  Frames are encoded on a bounded pool of workers (cv2 releases the GIL so
+  threads are used by default) and the results are delivered in capture order
+  for each window. When a window has too many frames pending the oldest ones
+  not yet being encoded are dropped since a newer frame supersedes them.
+
+  Attributes:
+    max_pending: max number of frames per window waiting in the pool.
+    submitted: number of frames submitted.
+    completed: number of frames encoded and delivered.
+    dropped: number of frames dropped because of backpressure or errors.
+  """
+
+  # names the workers and the errors
+  stage = "encode"
+
+  def __init__(self, max_workers=4, max_pending=2, use_processes=False):
+    """Initializes the pool.
+
+    Args:
+      max_workers: number of encoding workers.
+      max_pending: max number of frames per window waiting in the pool.
+      use_processes: encode on a process pool instead of a thread pool.
+    """
+    if use_processes:
+      self._executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+    else:
+      self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers, thread_name_prefix=self.stage
+      )
+    self.max_pending = max_pending
+    self.submitted = 0
+    self.completed = 0
+    self.dropped = 0
+    self._lock = threading.Lock()
+    self._jobs: dict[int, collections.deque[_EncodeJob]] = {}
+    self._delivery_locks: dict[int, threading.Lock] = {}
+
+  def submit(
+      self, window_id, encode, args, on_done, on_drop=None, supersedes=True
+  ):
+    """Queues a frame for encoding.
+
+    Args:
+      window_id: window the frame belongs to, results are delivered in order
+        per window.
+      encode: function doing the encoding, it must be picklable when using
+        processes.
+      args: tuple of arguments for the encode function.
+      on_done: called with the result of encode once all the previous frames
+        of the window have been delivered.
+      on_drop: called when the frame is dropped without being delivered.
+      supersedes: whether the frame makes the previous frames of the window
+        stale, otherwise none is dropped to make room for it.
+    """
+    stale_jobs = []
+    with self._lock:
+      jobs = self._jobs.setdefault(window_id, collections.deque())
+      self._delivery_locks.setdefault(window_id, threading.Lock())
+
+      # frames already being encoded are kept, they are about to be sent.
+      pending = [job for job in jobs if not job.dropped]
+      waiting = [job for job in pending if not job.future.running()]
+      while supersedes and waiting and len(pending) >= self.max_pending:
+        stale_job = waiting.pop(0)
+        pending.remove(stale_job)
+        stale_job.dropped = True
+        stale_jobs.append(stale_job)
+      self.dropped += len(stale_jobs)
+
+      future = self._executor.submit(encode, *args)
+      jobs.append(_EncodeJob(future, on_done, on_drop))
+      self.submitted += 1
+
+    # cancelling runs the done callbacks, which take the lock.
+    for stale_job in stale_jobs:
+      stale_job.future.cancel()
+      if stale_job.on_drop is not None:
+        stale_job.on_drop()
+
+    future.add_done_callback(lambda _: self.__deliver(window_id))
+
+  def __deliver(self, window_id):
+    """Delivers the encoded frames of a window in submission order."""
+    with self._delivery_locks[window_id]:
+      while True:
+        with self._lock:
+          jobs = self._jobs[window_id]
+          if not jobs or not jobs[0].future.done():
+            return
+          job = jobs.popleft()
+
+        if job.dropped or job.future.cancelled():
+          continue
+
+        try:
+          result = job.future.result()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+          print(f"Failed to {self.stage} a frame: {e}")
+          with self._lock:
+            self.dropped += 1
+          if job.on_drop is not None:
+            job.on_drop()
+          continue
+
+        job.on_done(result)
+        with self._lock:
+          self.completed += 1
+
+  def queue_depth(self, window_id=None):
+    """returns the number of frames waiting in the pool.
+
+    Args:
+      window_id: only count the frames of this window.
+    """
+    with self._lock:
+      if window_id is not None:
+        jobs = self._jobs.get(window_id, ())
+        return sum(1 for job in jobs if not job.dropped)
+      return sum(
+          1 for jobs in self._jobs.values() for job in jobs if not job.dropped
+      )
+
+  def get_metrics(self):
+    """returns a snapshot of the pool counters and queue depths."""
+    with self._lock:
+      depths = {
+          window_id: sum(1 for job in jobs if not job.dropped)
+          for window_id, jobs in self._jobs.items()
+      }
+      return {
+          "submitted": self.submitted,
+          "completed": self.completed,
+          "dropped": self.dropped,
+          "queue_depth": sum(depths.values()),
+          "window_queue_depth": depths,
+      }
+
+  def close(self):
+    """stops the workers, frames not yet encoded are discarded."""
+    self._executor.shutdown(wait=True, cancel_futures=True)
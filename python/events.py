@@ -14,9 +14,15 @@
 """Module which abstraction for the events."""
 
 import enum
+import itertools
+import queue
+import struct
 import cv2
 import numpy as np
 
+# put in an events queue to stop its consumer.
+STOP_EVENT = None
+
 
 class UIEventsTypes(enum.Enum):
   LEFT_BUTTON_DOWN = cv2.EVENT_LBUTTONDOWN
@@ -43,41 +49,77 @@ class ClickType(enum.Enum):
   KEY_PRESS = 3
 
 
+# event type, value, x, y and window id.
+EVENT = struct.Struct("<5i")
+
+_EVENT_TYPES = frozenset(event_type.value for event_type in UIEventsTypes)
+
+_BUTTONS = {
+    UIEventsTypes.LEFT_BUTTON_DOWN.value: MouseButton.LEFT,
+    UIEventsTypes.LEFT_DOUBLE_CLICK.value: MouseButton.LEFT,
+    UIEventsTypes.RIGHT_BUTTON_DOWN.value: MouseButton.RIGHT,
+    UIEventsTypes.RIGHT_DOUBLE_CLICK.value: MouseButton.RIGHT,
+    UIEventsTypes.MIDDLE_BUTTON_DOWN.value: MouseButton.MIDDLE,
+    UIEventsTypes.MIDDLE_DOUBLE_CLICK.value: MouseButton.MIDDLE,
+}
+
+_TASKS = {
+    UIEventsTypes.LEFT_BUTTON_DOWN.value: ClickType.MOUSE_CLICK,
+    UIEventsTypes.RIGHT_BUTTON_DOWN.value: ClickType.MOUSE_CLICK,
+    UIEventsTypes.MIDDLE_BUTTON_DOWN.value: ClickType.MOUSE_CLICK,
+    UIEventsTypes.LEFT_DOUBLE_CLICK.value: ClickType.MOUSE_DOUBLE_CLICK,
+    UIEventsTypes.RIGHT_DOUBLE_CLICK.value: ClickType.MOUSE_DOUBLE_CLICK,
+    UIEventsTypes.MIDDLE_DOUBLE_CLICK.value: ClickType.MOUSE_DOUBLE_CLICK,
+    UIEventsTypes.SCROLL.value: ClickType.MOUSE_SCROLL,
+    UIEventsTypes.KEYSTROKE.value: ClickType.KEY_PRESS,
+}
+
+
 class UIevent:
   """this is an abstraction class for the events.
 
+  The event is serialized as the EVENT struct of its five fields.
+
   Attributes:
     event_type: the type of the event UIEventsTypes,
     value: the value of the keystroke or the scroll value,
     x: px value of the mouse if this is a mouse event,
     y: px value of the mouse if this is a mouse event,
     window_id: window id hwnd win 32 api,
-    data_array: an array containing the above,
   """
 
+  __slots__ = ("event_type", "value", "x", "y", "window_id")
+
   def __init__(self, event_type=0, value=0, x=0, y=0, window_id=0):
-    self.event_type = UIEventsTypes(event_type).value
+    if isinstance(event_type, UIEventsTypes):
+      event_type = event_type.value
+    elif event_type not in _EVENT_TYPES:
+      raise ValueError(f"{event_type} is not a valid UIEventsTypes")
+    self.event_type = event_type
     self.value = value
     self.x = x
     self.y = y
     self.window_id = int(window_id)
-    self.data_array = np.array(
+
+  @property
+  def data_array(self):
+    """an int32 array containing the fields."""
+    return np.array(
         [self.event_type, self.value, self.x, self.y, self.window_id],
         dtype=np.int32,
     )
 
   def to_bytes(self):
     """transform event in bytes."""
-    return self.data_array.tobytes()
+    return EVENT.pack(
+        self.event_type, self.value, self.x, self.y, self.window_id
+    )
 
   def from_bytes(self, inbytes):
     """handles byte to event."""
-    self.data_array = np.frombuffer(inbytes, dtype=np.int32)
-    self.event_type = self.data_array[0]
-    self.value = self.data_array[1]
-    self.x = self.data_array[2]
-    self.y = self.data_array[3]
-    self.window_id = self.data_array[4]
+    self.event_type, self.value, self.x, self.y, self.window_id = (
+        EVENT.unpack(inbytes)
+    )
 
   def is_valid(self):
     """returns true is event is valid."""
@@ -113,41 +155,129 @@ class UIevent:
 
   def button(self) -> MouseButton:
     """return mouse button."""
-    if UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_BUTTON_DOWN:
-      return MouseButton.LEFT
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_DOUBLE_CLICK:
-      return MouseButton.LEFT
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_BUTTON_DOWN:
-      return MouseButton.RIGHT
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_DOUBLE_CLICK:
-      return MouseButton.RIGHT
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_BUTTON_DOWN:
-      return MouseButton.MIDDLE
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_DOUBLE_CLICK:
-      return MouseButton.MIDDLE
-    else:
-      return None
+    return _BUTTONS.get(self.event_type)
 
   def event_task(self) -> ClickType:
     """return click/scroll/press type."""
-    if UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_BUTTON_DOWN:
-      return ClickType.MOUSE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_BUTTON_DOWN:
-      return ClickType.MOUSE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_BUTTON_DOWN:
-      return ClickType.MOUSE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_DOUBLE_CLICK:
-      return ClickType.MOUSE_DOUBLE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_DOUBLE_CLICK:
-      return ClickType.MOUSE_DOUBLE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_DOUBLE_CLICK:
-      return ClickType.MOUSE_DOUBLE_CLICK
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.SCROLL:
-      return ClickType.MOUSE_SCROLL
-    elif UIEventsTypes(self.event_type) == UIEventsTypes.KEYSTROKE:
-      return ClickType.KEY_PRESS
+    return _TASKS.get(self.event_type)
+
+
+def pack_many(events):
+  """Serializes a burst of events with a single struct call.
+
+  Args:
+    events: list of UIevent.
+
+  Returns:
+    the bytes of the events one after the other, like their to_bytes.
+  """
+  return struct.pack(
+      f"<{len(events) * 5}i",
+      *itertools.chain.from_iterable(
+          (event.event_type, event.value, event.x, event.y, event.window_id)
+          for event in events
+      ),
+  )
+
+
+def unpack_many(data):
+  """Decodes consecutive serialized events.
+
+  Like from_bytes the event types are not checked.
+
+  Args:
+    data: bytes-like object holding the events one after the other.
+
+  Returns:
+    list of the UIevent.
+
+  Raises:
+    struct.error: if the size does not match whole events.
+  """
+  events = []
+  for fields in EVENT.iter_unpack(data):
+    event = UIevent.__new__(UIevent)
+    event.event_type, event.value, event.x, event.y, event.window_id = fields
+    events.append(event)
+  return events
+
+
+def drain_queue(event_queue, timeout=None):
+  """Blocks until an item is available then takes all the pending ones.
+
+  Args:
+    event_queue: the queue.Queue to drain.
+    timeout: max seconds to wait for the first item, None to wait forever.
+
+  Returns:
+    list of the items taken, task_done has to be called for each of them.
+
+  Raises:
+    queue.Empty: if no item arrived before the timeout.
+  """
+  items = [event_queue.get(timeout=timeout)]
+  while True:
+    try:
+      items.append(event_queue.get_nowait())
+    except queue.Empty:
+      return items
+
+
+def requeue_front(event_queue, items):
+  """Puts items taken from a queue back at its front, in their order.
+
+  Putting them back with put would move them after the items queued since.
+  task_done is left to the consumer taking them again.
+
+  Args:
+    event_queue: the queue.Queue the items were taken from.
+    items: list of the items, e.g. taken by drain_queue.
+  """
+  with event_queue.mutex:
+    event_queue.queue.extendleft(reversed(items))
+    event_queue.not_empty.notify(len(items))
+
+
+def coalesce_events(events):
+  """Merges the bursts of events that can be simulated as one.
+
+  Consecutive scrolls on the same window become one scroll of the summed
+  value at the position of the last one, a scroll of a then of b scrolls
+  like one of a + b. Scrolls summing to zero are dropped. The other events,
+  STOP_EVENT included, are kept in order and end the bursts.
+
+  Args:
+    events: list of the UIevent, e.g. taken by drain_queue.
+
+  Returns:
+    list of the events to simulate, the events merged are not modified.
+  """
+  coalesced = []
+  for event in events:
+    previous = coalesced[-1] if coalesced else STOP_EVENT
+    if (
+        event is not STOP_EVENT
+        and previous is not STOP_EVENT
+        and event.event_type == UIEventsTypes.SCROLL.value
+        and previous.event_type == UIEventsTypes.SCROLL.value
+        and event.window_id == previous.window_id
+    ):
+      coalesced[-1] = UIevent(
+          event.event_type,
+          previous.value + event.value,
+          event.x,
+          event.y,
+          event.window_id,
+      )
     else:
-      return None
+      coalesced.append(event)
+  return [
+      event
+      for event in coalesced
+      if event is STOP_EVENT
+      or event.event_type != UIEventsTypes.SCROLL.value
+      or event.value
+  ]
 
 
 # Start of the main program here
@@ -0,0 +1,151 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the serialization of the interaction events.
+
+Compares the previous numpy backed events with the struct packed UIevent,
+one event at a time and in bursts with pack_many and unpack_many.
+"""
+
+import argparse
+import time
+
+from events import MouseButton
+from events import pack_many
+from events import UIevent
+from events import UIEventsTypes
+from events import unpack_many
+import numpy as np
+
+
+class _NumpyEvent:
+  """the UIevent before the struct packing, kept as the reference."""
+
+  def __init__(self, event_type=0, value=0, x=0, y=0, window_id=0):
+    self.event_type = UIEventsTypes(event_type).value
+    self.value = value
+    self.x = x
+    self.y = y
+    self.window_id = int(window_id)
+    self.data_array = np.array(
+        [self.event_type, self.value, self.x, self.y, self.window_id],
+        dtype=np.int32,
+    )
+
+  def to_bytes(self):
+    return self.data_array.tobytes()
+
+  def from_bytes(self, inbytes):
+    self.data_array = np.frombuffer(inbytes, dtype=np.int32)
+    self.event_type = self.data_array[0]
+    self.value = self.data_array[1]
+    self.x = self.data_array[2]
+    self.y = self.data_array[3]
+    self.window_id = self.data_array[4]
+
+  def button(self):
+    if UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_BUTTON_DOWN:
+      return MouseButton.LEFT
+    elif UIEventsTypes(self.event_type) == UIEventsTypes.LEFT_DOUBLE_CLICK:
+      return MouseButton.LEFT
+    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_BUTTON_DOWN:
+      return MouseButton.RIGHT
+    elif UIEventsTypes(self.event_type) == UIEventsTypes.RIGHT_DOUBLE_CLICK:
+      return MouseButton.RIGHT
+    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_BUTTON_DOWN:
+      return MouseButton.MIDDLE
+    elif UIEventsTypes(self.event_type) == UIEventsTypes.MIDDLE_DOUBLE_CLICK:
+      return MouseButton.MIDDLE
+    else:
+      return None
+
+
+def _events_per_second(function, count):
+  """runs function, processing count events, and returns the rate."""
+  start_time = time.perf_counter()
+  function()
+  return count / (time.perf_counter() - start_time)
+
+
+def run(count):
+  """Serializes and deserializes count scroll events.
+
+  Returns:
+    dict of the events per second of every operation, for the numpy events
+    and the struct packed ones.
+  """
+  fields = [
+      (UIEventsTypes.SCROLL.value, 120, i % 1920 + 1, i % 1080 + 1, 42)
+      for i in range(count)
+  ]
+  numpy_events = [_NumpyEvent(*f) for f in fields]
+  events = [UIevent(*f) for f in fields]
+  numpy_data = [event.to_bytes() for event in numpy_events]
+  data = [event.to_bytes() for event in events]
+  burst = b"".join(data)
+
+  def numpy_decode():
+    for message in numpy_data:
+      event = _NumpyEvent()
+      event.from_bytes(message)
+
+  def decode():
+    for message in data:
+      event = UIevent()
+      event.from_bytes(message)
+
+  return {
+      "create and to_bytes": (
+          _events_per_second(
+              lambda: [_NumpyEvent(*f).to_bytes() for f in fields], count
+          ),
+          _events_per_second(
+              lambda: [UIevent(*f).to_bytes() for f in fields], count
+          ),
+      ),
+      "from_bytes": (
+          _events_per_second(numpy_decode, count),
+          _events_per_second(decode, count),
+      ),
+      "button": (
+          _events_per_second(
+              lambda: [event.button() for event in numpy_events], count
+          ),
+          _events_per_second(
+              lambda: [event.button() for event in events], count
+          ),
+      ),
+      "pack_many": (
+          _events_per_second(
+              lambda: b"".join(event.to_bytes() for event in numpy_events),
+              count,
+          ),
+          _events_per_second(lambda: pack_many(events), count),
+      ),
+      "unpack_many": (
+          _events_per_second(numpy_decode, count),
+          _events_per_second(lambda: unpack_many(burst), count),
+      ),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--events", type=int, default=100_000)
+  args = parser.parse_args()
+
+  for operation, (before, after) in run(args.events).items():
+    print(
+        f"{operation:>20}: numpy {before / 1e6:6.2f} M events/s, "
+        f"struct {after / 1e6:6.2f} M events/s, x{after / before:5.1f}"
+    )
@@ -0,0 +1,75 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the coalescing of the interaction events."""
+
+import unittest
+
+from events import coalesce_events
+from events import STOP_EVENT
+from events import UIevent
+from events import UIEventsTypes
+
+
+def _scroll(value, x=10, y=20, window_id=1):
+  """a scroll event."""
+  return UIevent(UIEventsTypes.SCROLL, value, x, y, window_id)
+
+
+def _click(window_id=1):
+  """a click event."""
+  return UIevent(UIEventsTypes.LEFT_BUTTON_DOWN, 0, 5, 5, window_id)
+
+
+def _fields(events):
+  """the fields of the events, to compare them."""
+  return [
+      event
+      if event is STOP_EVENT
+      else (event.event_type, event.value, event.x, event.y, event.window_id)
+      for event in events
+  ]
+
+
+class CoalesceEventsTest(unittest.TestCase):
+
+  def test_scroll_burst_becomes_one_scroll_at_the_last_position(self):
+    events = [_scroll(120), _scroll(120, 11, 21), _scroll(-40, 12, 22)]
+    self.assertEqual(
+        _fields(coalesce_events(events)), _fields([_scroll(200, 12, 22)])
+    )
+    # the events merged are not modified
+    self.assertEqual(_fields(events[:1]), _fields([_scroll(120)]))
+
+  def test_scrolls_of_other_windows_are_not_merged(self):
+    events = [_scroll(120), _scroll(120, window_id=2), _scroll(120)]
+    self.assertEqual(_fields(coalesce_events(events)), _fields(events))
+
+  def test_other_events_end_the_burst(self):
+    events = [_scroll(120), _click(), _scroll(120), _scroll(120)]
+    self.assertEqual(
+        _fields(coalesce_events(events)),
+        _fields([_scroll(120), _click(), _scroll(240)]),
+    )
+
+  def test_stop_event_is_kept_in_order(self):
+    events = [_scroll(120), STOP_EVENT, _scroll(120)]
+    self.assertEqual(_fields(coalesce_events(events)), _fields(events))
+
+  def test_scrolls_summing_to_zero_are_dropped(self):
+    events = [_click(), _scroll(120), _scroll(-120)]
+    self.assertEqual(_fields(coalesce_events(events)), _fields([_click()]))
+
+
+if __name__ == "__main__":
+  unittest.main()
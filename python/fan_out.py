@@ -0,0 +1,507 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module broadcasting the streamed windows to several receivers.
+
+The windows are captured and encoded once, every receiver connection has its
+own queue and sending thread so a slow receiver only delays itself.
+"""
+
+import argparse
+import collections
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+import typing
+
+from capture_sources import SyntheticSource
+import cv2
+from delta_codec import DeltaDecoder
+from frame_diff import pack_patch
+from frame_diff import unpack_patch
+import numpy as np
+from protocol import LEGACY_PROTOCOL_VERSION
+from protocol import MessageFlags
+from protocol import MessageType
+from rate_control import BandwidthBudget
+from streaming_client import InteractionSimulator
+from streaming_client import SharedConnectionClient
+from streaming_client import StreamingClient
+
+
+_LEGACY_ENCODING_PARAMETERS = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+
+
+class _Message(typing.NamedTuple):
+  """a message as passed to SharedConnectionClient.send_data."""
+
+  data: bytes
+  data_type: MessageType
+  sequence: int
+  timestamp: float
+  flags: MessageFlags
+
+
+class FanOutConnection:
+  """Connection of the StreamingClient sending to several receivers.
+
+  It is used in place of a SharedConnectionClient. The messages of a window
+  are gathered until the end of the frame, then the frame is queued to every
+  receiver. The state of every window, its last full frame or keyframe and
+  the patches or deltas applied on it since, is kept so a receiver joining
+  late, or falling more than max_pending_frames frames behind, gets it
+  instead of the frames it missed.
+
+  Sending does not block the StreamingClient, the quality is not lowered for
+  the slow receivers, they skip frames instead.
+
+  Attributes:
+    bandwidth_budget: BandwidthBudget shared by the streaming clients.
+    interaction_queue: queue of the events received from all the receivers.
+    max_pending_frames: frames of a window queued to a receiver before its
+      queue is replaced by the state of the window.
+  """
+
+  def __init__(
+      self, handshake_timeout=1.0, bandwidth_budget=None, max_pending_frames=2
+  ):
+    """Initializes the connection, without any receiver.
+
+    Args:
+      handshake_timeout: seconds to wait for a receiver to answer the
+        protocol version negotiation before using the legacy protocol.
+      bandwidth_budget: bytes per second shared by all the streaming clients,
+        None for unlimited.
+      max_pending_frames: frames of a window queued to a receiver before its
+        queue is replaced by the state of the window.
+    """
+    self.handshake_timeout = handshake_timeout
+    self.bandwidth_budget = BandwidthBudget(bandwidth_budget)
+    self.max_pending_frames = max_pending_frames
+    self.interaction_queue = queue.Queue()
+    self.interaction_simulator = None
+    if InteractionSimulator is not None:
+      self.interaction_simulator = InteractionSimulator(self.interaction_queue)
+      threading.Thread(target=self.interaction_simulator.process_queue).start()
+    self._lock = threading.Lock()
+    self._targets: list[_FanOutTarget] = []
+    self._partial_frames = collections.defaultdict(list)
+    self._states: dict[int, list[_Message]] = {}
+    self._state_sizes: dict[int, tuple[int, int]] = {}
+    self._keyframe_requests = {}
+    self._frame_sent = {}
+
+  @property
+  def protocol_version(self):
+    """the version every receiver supports, legacy without receivers.
+
+    The StreamingClients choose their features with it when created, the
+    frames of the features a receiver joining later does not support are
+    converted for it.
+    """
+    with self._lock:
+      return min(
+          (target.connection.protocol_version for target in self._targets),
+          default=LEGACY_PROTOCOL_VERSION,
+      )
+
+  def add_receiver(self, host, port):
+    """Connects to a receiver and sends it the state of every window.
+
+    Args:
+      host: ip of the receiver.
+      port: port of the receiver.
+
+    Returns:
+      the SharedConnectionClient connected to the receiver.
+    """
+    connection = SharedConnectionClient(
+        host,
+        port,
+        self.handshake_timeout,
+        interaction_queue=self.interaction_queue,
+    )
+    target = _FanOutTarget(connection, self.max_pending_frames)
+    with self._lock:
+      self._targets.append(target)
+      for window_id, state in self._states.items():
+        target.put(window_id, self.__snapshot(state), None)
+      for window_id in self._keyframe_requests:
+        self.__register_target_stream(target, window_id)
+    return connection
+
+  def remove_receiver(self, connection):
+    """stop sending to a receiver and close its connection."""
+    with self._lock:
+      targets = [t for t in self._targets if t.connection is connection]
+      self._targets = [t for t in self._targets if t not in targets]
+    for target in targets:
+      target.close()
+      connection.close()
+
+  def register_stream(
+      self, window_id, request_keyframe, frame_sent=None, control=None
+  ):
+    """Registers a window streamed to the receivers.
+
+    Args:
+      window_id: the window streamed.
+      request_keyframe: called when the patches kept for a window outgrow its
+        last full frame.
+      frame_sent: optional, called like for a SharedConnectionClient once a
+        frame is queued to all the receivers, the seconds it took do not
+        include the sending.
+      control: ignored, a receiver can not pause or downscale a window the
+        other receivers show.
+    """
+    with self._lock:
+      self._keyframe_requests[window_id] = request_keyframe
+      if frame_sent is not None:
+        self._frame_sent[window_id] = frame_sent
+      for target in self._targets:
+        self.__register_target_stream(target, window_id)
+
+  def interaction_point(self, window_id):
+    """the latest interaction point of a window among all the receivers."""
+    with self._lock:
+      points = [
+          target.connection.interaction_point(window_id)
+          for target in self._targets
+      ]
+    return max(
+        (point for point in points if point is not None),
+        key=lambda point: point[2],
+        default=None,
+    )
+
+  def unregister_stream(self, window_id):
+    """forget a window that stopped streaming."""
+    with self._lock:
+      self._keyframe_requests.pop(window_id, None)
+      self._frame_sent.pop(window_id, None)
+      self._states.pop(window_id, None)
+      self._state_sizes.pop(window_id, None)
+      self._partial_frames.pop(window_id, None)
+      for target in self._targets:
+        target.connection.unregister_stream(window_id)
+
+  def __register_target_stream(self, target, window_id):
+    """resend the state of the window when the receiver reconnects."""
+    target.connection.register_stream(
+        window_id, lambda: self.__resend_state(target, window_id)
+    )
+
+  def __resend_state(self, target, window_id):
+    """queue the state of a window to a receiver."""
+    with self._lock:
+      state = self._states.get(window_id)
+      if state is not None:
+        target.put(window_id, self.__snapshot(state), None)
+
+  def send_data(
+      self,
+      window_id,
+      data: bytes,
+      data_type,
+      sequence=0,
+      timestamp=0.0,
+      flags=MessageFlags.END_OF_FRAME,
+  ):
+    """Queues data to every receiver once its frame is complete.
+
+    Args:
+      window_id: identifier of the window the data sent belongs to.
+      data: the serialized data to be sent.
+      data_type: MessageType of the data being sent.
+      sequence: sequence number of the frame the data belongs to.
+      timestamp: capture time of the frame the data belongs to.
+      flags: MessageFlags of the data.
+    """
+    request_keyframe = None
+    start_time = time.perf_counter()
+    with self._lock:
+      frame = self._partial_frames[window_id]
+      frame.append(_Message(data, data_type, sequence, timestamp, flags))
+      if not flags & MessageFlags.END_OF_FRAME:
+        return
+      del self._partial_frames[window_id]
+
+      frame_size = sum(len(message.data) for message in frame)
+      if any(
+          message.data_type in (MessageType.FRAME, MessageType.KEYFRAME)
+          for message in frame
+      ):
+        self._states[window_id] = list(frame)
+        self._state_sizes[window_id] = (frame_size, 0)
+      elif window_id in self._states:
+        self._states[window_id].extend(frame)
+        keyframe_size, patches_size = self._state_sizes[window_id]
+        patches_size += frame_size
+        self._state_sizes[window_id] = (keyframe_size, patches_size)
+        if patches_size > keyframe_size:
+          request_keyframe = self._keyframe_requests.get(window_id)
+
+      state = self._states.get(window_id)
+      snapshot = self.__snapshot(state) if state is not None else None
+      for target in self._targets:
+        target.put(window_id, frame, snapshot)
+      frame_sent = self._frame_sent.get(window_id)
+
+    if frame_sent is not None:
+      frame_sent(frame_size, time.perf_counter() - start_time, timestamp)
+    if request_keyframe is not None:
+      request_keyframe()
+
+  @staticmethod
+  def __snapshot(state):
+    """the state of a window as one frame."""
+    last = len(state) - 1
+    return [
+        message._replace(
+            flags=(message.flags | MessageFlags.END_OF_FRAME)
+            if i == last
+            else (message.flags & ~MessageFlags.END_OF_FRAME)
+        )
+        for i, message in enumerate(state)
+    ]
+
+  def get_stats(self):
+    """returns the frames sent and dropped for every receiver."""
+    with self._lock:
+      return [
+          {
+              "receiver": i,
+              "sent_frames": target.sent_frames,
+              "dropped_frames": target.dropped_frames,
+          }
+          for i, target in enumerate(self._targets)
+      ]
+
+  def close(self):
+    """close the connections to all the receivers."""
+    with self._lock:
+      targets, self._targets = self._targets, []
+    for target in targets:
+      target.close()
+      target.connection.close()
+    if self.interaction_simulator is not None:
+      self.interaction_simulator.stop()
+
+
+class _FanOutTarget:
+  """Queue and sending thread of a receiver.
+
+  Attributes:
+    connection: SharedConnectionClient connected to the receiver.
+    sent_frames: number of frames sent.
+    dropped_frames: number of frames skipped because the receiver was slow.
+  """
+
+  def __init__(self, connection, max_pending_frames):
+    self.connection = connection
+    self.max_pending_frames = max_pending_frames
+    self.sent_frames = 0
+    self.dropped_frames = 0
+    self._frames = collections.deque()
+    self._condition = threading.Condition()
+    self._running = True
+    # decode the video mode of the windows for a legacy receiver
+    self._decoders: dict[int, DeltaDecoder] = {}
+    self._thread = threading.Thread(target=self.__send_frames, daemon=True)
+    self._thread.start()
+
+  def put(self, window_id, frame, snapshot):
+    """Queues a frame of a window.
+
+    Args:
+      window_id: the window of the frame.
+      frame: list of the _Message of the frame.
+      snapshot: the state of the window including the frame, queued instead
+        of the pending frames of the window when there are too many. None to
+        always queue the frame.
+    """
+    with self._condition:
+      pending = sum(1 for w, _ in self._frames if w == window_id)
+      if snapshot is not None and pending >= self.max_pending_frames:
+        self._frames = collections.deque(
+            (w, f) for w, f in self._frames if w != window_id
+        )
+        self.dropped_frames += pending
+        frame = snapshot
+      self._frames.append((window_id, frame))
+      self._condition.notify()
+
+  def __send_frames(self):
+    """send the queued frames until closed."""
+    while True:
+      with self._condition:
+        while self._running and not self._frames:
+          self._condition.wait()
+        if not self._running:
+          return
+        window_id, frame = self._frames.popleft()
+
+      if self.connection.protocol_version == LEGACY_PROTOCOL_VERSION:
+        frame = self.__legacy_frame(window_id, frame)
+      for message in frame:
+        self.connection.send_data(
+            window_id,
+            message.data,
+            message.data_type,
+            message.sequence,
+            message.timestamp,
+            message.flags,
+        )
+      self.sent_frames += 1
+
+  def __legacy_frame(self, window_id, frame):
+    """Converts a frame for a legacy receiver.
+
+    The downscaled messages are resized to their full size and the keyframes
+    and deltas are decoded, then encoded again as jpg.
+
+    Returns:
+      list of the _Message to send, the last one ends the frame.
+    """
+    messages = []
+    for message in frame:
+      flags = message.flags & ~MessageFlags.SCALED
+      if message.data_type in (MessageType.KEYFRAME, MessageType.DELTA):
+        decoder = self._decoders.setdefault(window_id, DeltaDecoder())
+        image = decoder.decode(message.data_type, message.data)
+        if image is None:
+          continue
+        message = message._replace(
+            data=_encode_jpg(image), data_type=MessageType.FRAME, flags=flags
+        )
+      elif message.flags & MessageFlags.SCALED:
+        (x, y, w, h), encoded = unpack_patch(message.data)
+        image = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+          continue
+        data = _encode_jpg(
+            cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+        )
+        if message.data_type == MessageType.PATCH:
+          data = pack_patch((x, y, w, h), data)
+        message = message._replace(data=data, flags=flags)
+      messages.append(message)
+    if messages and frame[-1].flags & MessageFlags.END_OF_FRAME:
+      messages[-1] = messages[-1]._replace(
+          flags=messages[-1].flags | MessageFlags.END_OF_FRAME
+      )
+    return messages
+
+  def close(self):
+    """stop the sending thread, the frames queued are not sent."""
+    with self._condition:
+      self._running = False
+      self._condition.notify()
+    self._thread.join()
+
+
+def _encode_jpg(image):
+  """encodes an image as jpg for a legacy receiver."""
+  _, encoded = cv2.imencode(".jpg", image, _LEGACY_ENCODING_PARAMETERS)
+  return encoded.tobytes()
+
+
+def _sink(ready, receiver_count):
+  """Receivers reading and discarding everything, run in another process.
+
+  They do not answer the protocol negotiation so the legacy protocol is used.
+  """
+  servers = []
+  for _ in range(receiver_count):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    servers.append(server)
+  ready.send([server.getsockname()[1] for server in servers])
+
+  def drain(server):
+    connection, _ = server.accept()
+    buffer = bytearray(1 << 20)
+    while connection.recv_into(buffer):
+      pass
+
+  threads = [threading.Thread(target=drain, args=(s,)) for s in servers]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+
+def run(receiver_count, pattern="scrolling_text", duration=3.0):
+  """Streams a synthetic window to local receivers.
+
+  Args:
+    receiver_count: number of receivers.
+    pattern: SyntheticSource pattern streamed.
+    duration: seconds to stream.
+
+  Returns:
+    dict with the frames sent to each receiver and the cpu seconds used per
+    captured frame by the streaming process.
+  """
+  ready, ready_child = multiprocessing.Pipe()
+  sink = multiprocessing.Process(
+      target=_sink, args=(ready_child, receiver_count)
+  )
+  sink.start()
+  ports = ready.recv()
+
+  connection = FanOutConnection(handshake_timeout=0.2)
+  for port in ports:
+    connection.add_receiver("127.0.0.1", port)
+  source = SyntheticSource(pattern)
+  client = StreamingClient(
+      pattern, 1, connection, max_fps=30, capture_source=source
+  )
+
+  start_cpu = time.process_time()
+  client.start_stream()
+  time.sleep(duration)
+  client.stop_stream()
+  client.client_thread.join()
+  cpu = time.process_time() - start_cpu
+
+  stats = connection.get_stats()
+  connection.close()
+  sink.join()
+  return {
+      "receivers": receiver_count,
+      "captured_frames": source.frame_index,
+      "sent_frames": [target["sent_frames"] for target in stats],
+      "cpu_per_frame": cpu / max(1, source.frame_index),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="cpu used by the fan out as receivers are added"
+  )
+  parser.add_argument("--receivers", type=int, default=4)
+  parser.add_argument("--pattern", default="scrolling_text")
+  parser.add_argument("--duration", type=float, default=3.0)
+  args = parser.parse_args()
+
+  for count in range(1, args.receivers + 1):
+    result = run(count, args.pattern, args.duration)
+    print(
+        f"{count} receivers: {result['captured_frames']} frames, "
+        f"{result['cpu_per_frame'] * 1e3:6.2f} ms cpu per frame, "
+        f"sent {result['sent_frames']}"
+    )
@@ -0,0 +1,171 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the FanOutConnection with several local receivers."""
+
+import socket
+import threading
+import time
+import unittest
+
+from capture_sources import SyntheticSource
+import cv2
+from fan_out import FanOutConnection
+from frame_diff import pack_patch
+from instrumentation import Instrumentation
+import numpy as np
+from protocol import MessageFlags
+from protocol import MessageType
+from stream_receiver import StreamReceiver
+from streaming_client import StreamingClient
+
+
+def _wait_for(condition, timeout=5.0):
+  """polls condition until it is true, returns its last value."""
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+
+def _png(image):
+  """encodes an image losslessly."""
+  return cv2.imencode(".png", image)[1].tobytes()
+
+
+class _Sink:
+  """A legacy receiver reading and discarding everything, on a thread."""
+
+  def __init__(self):
+    self.server = socket.create_server(("127.0.0.1", 0))
+    self.port = self.server.getsockname()[1]
+    threading.Thread(target=self.__drain, daemon=True).start()
+
+  def __drain(self):
+    connection, _ = self.server.accept()
+    buffer = bytearray(1 << 20)
+    with connection:
+      while connection.recv_into(buffer):
+        pass
+
+  def close(self):
+    self.server.close()
+
+
+class _RecordingReceiver(StreamReceiver):
+  """A receiver keeping the messages and the frames shown of window 1."""
+
+  def __init__(self):
+    with socket.socket() as sock:
+      sock.bind(("127.0.0.1", 0))
+      self.port = sock.getsockname()[1]
+    super().__init__("127.0.0.1", self.port, decode_workers=0)
+    self.message_types = []
+    self.shown = []
+
+  def _process_incoming_data(
+      self,
+      data,
+      window_id,
+      data_type,
+      flags=MessageFlags.END_OF_FRAME,
+      timestamp=0.0,
+  ):
+    self.message_types.append(data_type)
+    super()._process_incoming_data(
+        data, window_id, data_type, flags, timestamp
+    )
+
+  def update_display_frame(self, window_id, frame, capture_time=0.0):
+    self.shown.append(frame)
+
+
+class FanOutTest(unittest.TestCase):
+
+  def _encode_time(self, receiver_count, frame_count=20):
+    """median seconds to encode a frame streamed to receiver_count sinks."""
+    sinks = [_Sink() for _ in range(receiver_count)]
+    connection = FanOutConnection(handshake_timeout=0.2)
+    for sink in sinks:
+      connection.add_receiver("127.0.0.1", sink.port)
+    source = SyntheticSource("scrolling_text", 640, 360, seed=1)
+    instrumentation = Instrumentation(enabled=True)
+    client = StreamingClient(
+        "fan out",
+        1,
+        connection,
+        capture_source=source,
+        instrumentation=instrumentation,
+    )
+    for i in range(frame_count):
+      client._process_frame(source.screenshot())
+      # the sending threads are idle while the next frame is encoded
+      self.assertTrue(
+          _wait_for(
+              lambda count=i + 1: all(
+                  stats["sent_frames"] == count
+                  for stats in connection.get_stats()
+              )
+          )
+      )
+    connection.close()
+    for sink in sinks:
+      sink.close()
+    histogram = instrumentation.get_histogram("encode")
+    self.assertEqual(histogram.count, frame_count)
+    return histogram.percentile(50)
+
+  def test_encode_time_does_not_grow_with_the_receivers(self):
+    one, two, four = (self._encode_time(count) for count in (1, 2, 4))
+    # the frames are encoded once whatever the number of receivers
+    self.assertLess(two, one * 1.5 + 1e-3)
+    self.assertLess(four, one * 1.5 + 1e-3)
+
+  def test_late_receiver_gets_the_last_frame_and_its_patches(self):
+    first, late = _RecordingReceiver(), _RecordingReceiver()
+    for receiver in (first, late):
+      receiver.start_server()
+      self.addCleanup(receiver.stop_server)
+    connection = FanOutConnection()
+    self.addCleanup(connection.close)
+    connection.add_receiver("127.0.0.1", first.port)
+
+    image = np.zeros((64, 64, 3), np.uint8)
+    connection.send_data(1, _png(image), MessageType.FRAME)
+    connection.send_data(1, _png(image + 1), MessageType.FRAME)
+    for i in range(3):
+      patch = np.full((8, 8, 3), 50 * (i + 1), np.uint8)
+      image[8 * i : 8 * i + 8, :8] = patch
+      connection.send_data(
+          1, pack_patch((0, 8 * i, 8, 8), _png(patch)), MessageType.PATCH
+      )
+    expected = image + 1
+    expected[:24, :8] = image[:24, :8]
+    self.assertTrue(
+        _wait_for(
+            lambda: first.shown and np.array_equal(first.shown[-1], expected)
+        )
+    )
+
+    connection.add_receiver("127.0.0.1", late.port)
+    self.assertTrue(_wait_for(lambda: late.shown))
+    # the last frame and the patches since, shown once all applied
+    self.assertEqual(
+        late.message_types, [MessageType.FRAME] + [MessageType.PATCH] * 3
+    )
+    self.assertEqual(len(late.shown), 1)
+    np.testing.assert_array_equal(late.shown[0], expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,118 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of the frame preparation of the streaming client.
+
+Compares converting the captured BGRX frames to RGB before the change
+detection and the encoding with using them as captured, and encoding the low
+colour regions as png, reporting the time, the bytes allocated and the bytes
+sent per frame.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from capture_sources import SyntheticSource
+import cv2
+from encode_pool import encode_frame
+from frame_diff import TileChangeDetector
+
+ENCODING_PARAMETERS = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+
+
+def _process(frame, detector, convert, lossless_colors):
+  """prepares, diffs and encodes a frame like StreamingClient.
+
+  Returns:
+    the number of bytes encoded.
+  """
+  if convert:
+    frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
+  rects = detector.detect(frame)
+  if not rects:
+    return 0
+  if TileChangeDetector.dirty_ratio(rects, frame) >= 0.5:
+    rects = None
+  messages = encode_frame(
+      frame, ENCODING_PARAMETERS, rects, lossless_colors=lossless_colors
+  )
+  return sum(len(data) for _, _, data in messages)
+
+
+def run(pattern, frame_count, convert, trace_memory=False, lossless_colors=0):
+  """Processes synthetic frames with partial updates.
+
+  Args:
+    pattern: SyntheticSource pattern.
+    frame_count: number of frames to process.
+    convert: convert the frames to RGB first, like the previous client.
+    trace_memory: trace the allocations, slows down the processing.
+    lossless_colors: encode the regions with at most this many colours as
+      png.
+
+  Returns:
+    dict with the milliseconds spent, the peak of bytes allocated and the
+    bytes encoded per frame, the capture itself is excluded.
+  """
+  source = SyntheticSource(pattern)
+  frames = [source.screenshot() for _ in range(frame_count)]
+  detector = TileChangeDetector()
+  _process(frames[0], detector, convert, lossless_colors)
+  encoded_bytes = 0
+
+  if trace_memory:
+    tracemalloc.start()
+  peak = 0
+  elapsed_time = 0.0
+  for frame in frames[1:]:
+    if trace_memory:
+      tracemalloc.reset_peak()
+      baseline, _ = tracemalloc.get_traced_memory()
+    start_time = time.perf_counter()
+    encoded_bytes += _process(frame, detector, convert, lossless_colors)
+    elapsed_time += time.perf_counter() - start_time
+    if trace_memory:
+      peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+  if trace_memory:
+    tracemalloc.stop()
+
+  return {
+      "ms_per_frame": elapsed_time / (frame_count - 1) * 1e3,
+      "peak_allocated_bytes": peak if trace_memory else None,
+      "bytes_per_frame": encoded_bytes / (frame_count - 1),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--frames", type=int, default=50)
+  args = parser.parse_args()
+
+  for source_pattern in SyntheticSource.PATTERNS:
+    for name, convert_frame, colors in (
+        ("rgb", True, 0),
+        ("bgrx", False, 0),
+        ("png", False, 256),
+    ):
+      timing = run(source_pattern, args.frames, convert_frame,
+                   lossless_colors=colors)
+      memory = run(source_pattern, 10, convert_frame, trace_memory=True,
+                   lossless_colors=colors)
+      print(
+          f"{source_pattern:>14} {name:>4}: "
+          f"{timing['ms_per_frame']:6.2f} ms/frame, "
+          f"{timing['bytes_per_frame'] / 1e3:7.1f} kB/frame, "
+          f"peak allocated {memory['peak_allocated_bytes'] / 1e6:6.2f} MB"
+          " per frame"
+      )
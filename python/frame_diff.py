@@ -0,0 +1,167 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing the tile based change detection between frames."""
+
+import struct
+import numpy as np
+
+# x, y, width and height of a patch, prepended to the encoded patch bytes.
+PATCH_HEADER = struct.Struct("<4I")
+
+
+def pack_patch(rect, encoded: bytes) -> bytes:
+  """prepend the patch rectangle to the encoded patch."""
+  return PATCH_HEADER.pack(*rect) + encoded
+
+
+def unpack_patch(data):
+  """split a patch payload in its rectangle and the encoded patch.
+
+  Args:
+    data: bytes-like payload built by pack_patch.
+
+  Returns:
+    tuple with the (x, y, width, height) rectangle and a memoryview of the
+    encoded patch.
+  """
+  rect = PATCH_HEADER.unpack_from(data)
+  return rect, memoryview(data)[PATCH_HEADER.size:]
+
+
+class TileChangeDetector:
+  """Finds the regions of a frame that changed since the previous frame.
+
+  The frame is split in a grid of square tiles, every tile containing at least
+  one changed pixel is dirty and adjacent dirty tiles are merged in rectangles.
+  The pixels of BGRX frames are compared as single uint32 values, so a change
+  of the unused X byte alone marks the pixel as changed.
+
+  Attributes:
+    tile_size: edge of the square tiles in px.
+  """
+
+  def __init__(self, tile_size=64):
+    self.tile_size = tile_size
+    self._prev_frame = None
+    # reused between the frames to not allocate full frame masks
+    self._changed = None
+    self._changed_channels = None
+
+  def reset(self):
+    """forget the previous frame, the next frame will be fully dirty."""
+    self._prev_frame = None
+
+  def detect(self, frame):
+    """Compares the frame with the previous one.
+
+    Args:
+      frame (numpy.ndarray): the current frame.
+
+    Returns:
+      list of (x, y, width, height) dirty rectangles, empty if nothing changed.
+      The whole frame is returned on the first call or when its size changed.
+    """
+    height, width = frame.shape[:2]
+
+    if self._prev_frame is None or self._prev_frame.shape != frame.shape:
+      self._prev_frame = frame.copy()
+      return [(0, 0, width, height)]
+
+    changed = self._changed_pixels(frame)
+
+    tiles = np.logical_or.reduceat(
+        changed, np.arange(0, height, self.tile_size), axis=0
+    )
+    tiles = np.logical_or.reduceat(
+        tiles, np.arange(0, width, self.tile_size), axis=1
+    )
+
+    if not tiles.any():
+      return []
+
+    np.copyto(self._prev_frame, frame)
+    return self._tiles_to_rects(tiles, width, height)
+
+  def _changed_pixels(self, frame):
+    """returns the mask of the pixels changed, valid until the next call."""
+    if self._changed is None or self._changed.shape != frame.shape[:2]:
+      self._changed = np.empty(frame.shape[:2], dtype=bool)
+      self._changed_channels = None
+
+    if frame.ndim == 2:
+      return np.not_equal(frame, self._prev_frame, out=self._changed)
+
+    if frame.shape[2] == 4 and frame.dtype == np.uint8:
+      try:
+        pixels = frame.view(np.uint32)[..., 0]
+      except ValueError:
+        # the pixels are not contiguous
+        pass
+      else:
+        return np.not_equal(
+            pixels, self._prev_frame.view(np.uint32)[..., 0], out=self._changed
+        )
+
+    if self._changed_channels is None:
+      self._changed_channels = np.empty(frame.shape, dtype=bool)
+    np.not_equal(frame, self._prev_frame, out=self._changed_channels)
+    return np.any(self._changed_channels, axis=2, out=self._changed)
+
+  def _tiles_to_rects(self, tiles, width, height):
+    """merge the dirty tiles in rectangles.
+
+    Dirty tiles are merged in horizontal runs, runs spanning the same columns
+    on consecutive tile rows are merged together.
+
+    Args:
+      tiles: boolean grid of the dirty tiles.
+      width: frame width in px.
+      height: frame height in px.
+
+    Returns:
+      list of (x, y, width, height) rectangles in px.
+    """
+    size = self.tile_size
+    open_runs = {}
+    rects = []
+
+    for row, tile_row in enumerate(tiles):
+      padded = np.concatenate(([False], tile_row, [False]))
+      edges = np.flatnonzero(padded[1:] != padded[:-1])
+      runs = {(int(start), int(end)) for start, end in zip(edges[::2],
+                                                            edges[1::2])}
+
+      for run in list(open_runs):
+        if run not in runs:
+          rects.append(open_runs.pop(run))
+
+      for start, end in runs:
+        bottom = min(height, (row + 1) * size)
+        if (start, end) in open_runs:
+          x, y, w, _ = open_runs[(start, end)]
+          open_runs[(start, end)] = (x, y, w, bottom - y)
+        else:
+          x = start * size
+          y = row * size
+          open_runs[(start, end)] = (x, y, min(width, end * size) - x,
+                                     bottom - y)
+
+    rects.extend(open_runs.values())
+    return rects
+
+  @staticmethod
+  def dirty_ratio(rects, frame):
+    """returns the fraction of the frame area covered by the rectangles."""
+    height, width = frame.shape[:2]
+    return sum(w * h for _, _, w, h in rects) / float(width * height)
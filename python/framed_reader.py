@@ -0,0 +1,167 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing socket readers that reuse their receive buffer."""
+
+import struct
+
+_SIZE_STRUCT = struct.Struct("<L")
+
+
+class FramedReader:
+  """Reads length prefixed messages from a socket without copying them.
+
+  Data is received with recv_into directly into a growable bytearray that is
+  reused for every read, the returned memoryviews point into that buffer so
+  they are only valid until the next read.
+
+  Attributes:
+    sock: the connected socket to read from.
+  """
+
+  def __init__(self, sock, initial_size=1 << 20):
+    self.sock = sock
+    self._buffer = bytearray(initial_size)
+    self._view = memoryview(self._buffer)
+
+  def _reserve(self, size):
+    """grows the buffer so it can hold size bytes."""
+    if size > len(self._buffer):
+      new_size = max(size, 2 * len(self._buffer))
+      self._buffer = bytearray(new_size)
+      self._view = memoryview(self._buffer)
+
+  def read_exactly(self, size):
+    """Reads exactly size bytes.
+
+    Args:
+      size: number of bytes to read.
+
+    Returns:
+      memoryview of the bytes, valid until the next read.
+
+    Raises:
+      ConnectionResetError: if the peer closed the connection.
+    """
+    self._reserve(size)
+    view = self._view[:size]
+    received = 0
+    while received < size:
+      count = self.sock.recv_into(view[received:], size - received)
+      if not count:
+        raise ConnectionResetError("Connection closed by the peer.")
+      received += count
+    return view
+
+  def read_size(self):
+    """reads a little endian unsigned 32 bit length prefix."""
+    return _SIZE_STRUCT.unpack(self.read_exactly(_SIZE_STRUCT.size))[0]
+
+  def read_message(self):
+    """reads a length prefixed message, valid until the next read."""
+    return self.read_exactly(self.read_size())
+
+
+class BufferedFrameReader:
+  """Reads the messages of a socket in large chunks.
+
+  Every recv_into fills as much of the buffer as the socket has available
+  and all the complete messages it holds are returned at once, a burst of
+  small messages costs a single system call instead of two per message. The
+  partial message left at the end of the buffer is moved to its start
+  before the next read, the buffer grows only for a message not fitting.
+
+  Attributes:
+    sock: the connected socket to read from.
+    prefix_size: size of the fixed size prefix of every message.
+    payload_length: called with a memoryview of a prefix, returns the size
+      of the payload following it. It can raise to reject the prefix, the
+      bytes buffered are then dropped since nothing after it can be framed.
+  """
+
+  def __init__(
+      self, sock, prefix_size=_SIZE_STRUCT.size, payload_length=None,
+      initial_size=64 << 10,
+  ):
+    self.sock = sock
+    self.prefix_size = prefix_size
+    self.payload_length = payload_length or (
+        lambda prefix: _SIZE_STRUCT.unpack(prefix)[0]
+    )
+    self._buffer = bytearray(initial_size)
+    self._view = memoryview(self._buffer)
+    self._start = 0
+    self._end = 0
+
+  def _extract(self):
+    """Takes the complete messages in the buffer.
+
+    Returns:
+      tuple of the list of (prefix, payload) memoryviews and the size of the
+      first incomplete message, the size of the prefix when it is incomplete
+      too.
+    """
+    messages = []
+    view = self._view
+    start = self._start
+    needed = self.prefix_size
+    while self._end - start >= self.prefix_size:
+      payload_start = start + self.prefix_size
+      try:
+        end = payload_start + self.payload_length(view[start:payload_start])
+      except Exception:
+        self._start = self._end = 0
+        raise
+      if end > self._end:
+        needed = end - start
+        break
+      messages.append((view[start:payload_start], view[payload_start:end]))
+      start = end
+    self._start = start
+    return messages, needed
+
+  def _make_room(self, needed):
+    """moves the pending bytes to the start and grows the buffer if needed."""
+    pending = self._end - self._start
+    if needed > len(self._buffer):
+      buffer = bytearray(max(needed, 2 * len(self._buffer)))
+      buffer[:pending] = self._view[self._start : self._end]
+      self._buffer = buffer
+      self._view = memoryview(buffer)
+    elif self._start:
+      self._view[:pending] = self._view[self._start : self._end]
+    self._start = 0
+    self._end = pending
+
+  def read_messages(self):
+    """Reads all the messages available, waiting for one at least.
+
+    Returns:
+      list of (prefix, payload) memoryviews, valid until the next read.
+
+    Raises:
+      ConnectionResetError: if the peer closed the connection.
+      Exception: what payload_length raised for an invalid prefix.
+    """
+    while True:
+      messages, needed = self._extract()
+      if messages:
+        return messages
+      if self._start == self._end:
+        self._start = self._end = 0
+      elif needed > len(self._buffer) - self._start:
+        self._make_room(needed)
+      count = self.sock.recv_into(self._view[self._end :])
+      if not count:
+        raise ConnectionResetError("Connection closed by the peer.")
+      self._end += count
@@ -0,0 +1,169 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the BufferedFrameReader on fragmented streams."""
+
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from framed_reader import BufferedFrameReader
+from protocol import HEADER
+from protocol import HELLO
+from protocol import MessageType
+from protocol import pack_header
+from protocol import pack_hello
+from protocol import SIZE
+from protocol import unpack_header
+from streaming_client import SharedConnectionClient
+
+_SIZE = struct.Struct("<L")
+
+
+def _send(sock, chunks, pause_seed):
+  """sends the chunks with random pauses, then closes the writing side."""
+  pauses = random.Random(pause_seed)
+  for chunk in chunks:
+    sock.sendall(chunk)
+    if pauses.random() < 0.05:
+      time.sleep(0.001)
+  sock.shutdown(socket.SHUT_WR)
+
+
+def _read_back(reader_factory, chunks, pause_seed=0):
+  """sends the chunks over a socket pair, returns the messages read."""
+  sender, receiver = socket.socketpair()
+  thread = threading.Thread(target=_send, args=(sender, chunks, pause_seed))
+  thread.start()
+  reader = reader_factory(receiver)
+  received = []
+  try:
+    while True:
+      received.extend(
+          (bytes(prefix), bytes(payload))
+          for prefix, payload in reader.read_messages()
+      )
+  except ConnectionResetError:
+    pass
+  thread.join()
+  sender.close()
+  receiver.close()
+  return received
+
+
+def _answer_hellos(server, connections, count):
+  """accepts count connections, answers their HELLO and queues them."""
+  for _ in range(count):
+    connection, _ = server.accept()
+    connection.recv(4096)
+    connection.sendall(SIZE.pack(HELLO.size) + pack_hello())
+    connections.put(connection)
+
+
+def _fragment(rng, stream):
+  """splits the stream in fragments from one byte to several messages."""
+  fragments = []
+  position = 0
+  while position < len(stream):
+    size = rng.choice(
+        (1, 3, rng.randrange(1, 100), rng.randrange(1, 300_000))
+    )
+    fragments.append(stream[position : position + size])
+    position += size
+  return fragments
+
+
+class BufferedFrameReaderTest(unittest.TestCase):
+
+  def test_fuzz_size_prefixed_messages(self):
+    rng = random.Random(0)
+    for _ in range(50):
+      payloads = [
+          rng.randbytes(rng.choice((0, 1, 20, rng.randrange(1, 200_000))))
+          for _ in range(rng.randrange(1, 60))
+      ]
+      stream = b"".join(_SIZE.pack(len(p)) + p for p in payloads)
+      initial_size = rng.choice((1, 100, 64 << 10))
+      received = _read_back(
+          lambda sock, size=initial_size: BufferedFrameReader(
+              sock, initial_size=size
+          ),
+          _fragment(rng, stream),
+          rng.random(),
+      )
+      self.assertEqual([payload for _, payload in received], payloads)
+
+  def test_header_prefixed_messages(self):
+    rng = random.Random(1)
+    payloads = [rng.randbytes(rng.randrange(0, 5000)) for _ in range(100)]
+    stream = b"".join(
+        pack_header(MessageType.PATCH, i, len(p)) + p
+        for i, p in enumerate(payloads)
+    )
+    received = _read_back(
+        lambda sock: BufferedFrameReader(
+            sock,
+            HEADER.size,
+            lambda prefix: unpack_header(prefix).payload_length,
+            initial_size=64,
+        ),
+        _fragment(rng, stream),
+    )
+    self.assertEqual([payload for _, payload in received], payloads)
+    self.assertEqual(
+        [unpack_header(prefix).window_id for prefix, _ in received],
+        list(range(len(payloads))),
+    )
+
+  def test_truncated_stream_raises(self):
+    stream = _SIZE.pack(10) + b"short"
+    sender, receiver = socket.socketpair()
+    sender.sendall(stream)
+    sender.shutdown(socket.SHUT_WR)
+    reader = BufferedFrameReader(receiver)
+    with self.assertRaises(ConnectionResetError):
+      reader.read_messages()
+    sender.close()
+    receiver.close()
+
+  def test_invalid_header_reconnects_the_client(self):
+    server = socket.create_server(("127.0.0.1", 0))
+    connections = queue.Queue()
+    thread = threading.Thread(
+        target=_answer_hellos, args=(server, connections, 2), daemon=True
+    )
+    thread.start()
+    client = SharedConnectionClient(
+        "127.0.0.1", server.getsockname()[1], interaction_queue=queue.Queue()
+    )
+    first = connections.get(timeout=5)
+    # a header with a bad magic value, the stream cannot be framed after it
+    first.sendall(b"\0" * HEADER.size)
+    try:
+      second = connections.get(timeout=5)
+    except queue.Empty:
+      second = None
+    client.close()
+    for connection in (first, second):
+      if connection is not None:
+        connection.close()
+    server.close()
+    self.assertIsNotNone(second)
+
+
+if __name__ == "__main__":
+  unittest.main()
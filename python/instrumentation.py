@@ -0,0 +1,197 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing the latency instrumentation of the streaming pipeline."""
+
+import collections
+import threading
+import time
+
+
+class LatencyHistogram:
+  """Histogram of durations with a bounded relative error, like HdrHistogram.
+
+  Durations are counted in units of resolution seconds and the units are
+  bucketed keeping only their precision_bits most significant bits, so the
+  memory used grows with the log of the max duration.
+
+  Attributes:
+    count: number of durations recorded.
+    total: sum of the durations recorded, in seconds.
+    max: longest duration recorded, in seconds.
+  """
+
+  def __init__(self, resolution=1e-6, precision_bits=5):
+    self.resolution = resolution
+    self.precision_bits = precision_bits
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self._buckets = collections.Counter()
+    self._lock = threading.Lock()
+
+  def record(self, seconds):
+    """record a duration in seconds."""
+    units = max(0, int(seconds / self.resolution))
+    shift = max(0, units.bit_length() - self.precision_bits)
+    bucket = (units >> shift) << shift
+    with self._lock:
+      self._buckets[bucket] += 1
+      self.count += 1
+      self.total += seconds
+      self.max = max(self.max, seconds)
+
+  def merge(self, other):
+    """add the durations of a histogram with the same resolution."""
+    with other._lock:
+      buckets = collections.Counter(other._buckets)
+      count, total, maximum = other.count, other.total, other.max
+    with self._lock:
+      self._buckets.update(buckets)
+      self.count += count
+      self.total += total
+      self.max = max(self.max, maximum)
+
+  def percentile(self, percent):
+    """returns the duration in seconds below which percent of them fall."""
+    with self._lock:
+      if not self.count:
+        return 0.0
+      rank = percent / 100.0 * self.count
+      seen = 0
+      for bucket in sorted(self._buckets):
+        seen += self._buckets[bucket]
+        if seen >= rank:
+          return min(bucket * self.resolution, self.max)
+      return self.max
+
+  def summary(self):
+    """returns count, mean, p50, p95, p99 and max."""
+    return {
+        "count": self.count,
+        "mean": self.total / self.count if self.count else 0.0,
+        "p50": self.percentile(50),
+        "p95": self.percentile(95),
+        "p99": self.percentile(99),
+        "max": self.max,
+    }
+
+
+class Instrumentation:
+  """Per window and per stage latency histograms.
+
+  Disabled instances ignore everything recorded, so the instrumentation can be
+  left in place with a negligible overhead.
+
+  Attributes:
+    enabled: whether the durations are recorded.
+  """
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self._histograms: dict[tuple[int, str], LatencyHistogram] = {}
+    self._lock = threading.Lock()
+    self._dump_stop = None
+
+  @staticmethod
+  def now():
+    """returns the time to pass as start to record."""
+    return time.perf_counter()
+
+  def record(self, window_id, stage, start):
+    """Records the duration of a stage.
+
+    Args:
+      window_id: window the stage processed a frame of.
+      stage: name of the stage.
+      start: value returned by now() when the stage started.
+    """
+    if self.enabled:
+      self.record_duration(window_id, stage, time.perf_counter() - start)
+
+  def record_duration(self, window_id, stage, seconds):
+    """records a duration in seconds, measured by the caller."""
+    if not self.enabled:
+      return
+    key = (window_id, stage)
+    histogram = self._histograms.get(key)
+    if histogram is None:
+      with self._lock:
+        histogram = self._histograms.setdefault(key, LatencyHistogram())
+    histogram.record(seconds)
+
+  def record_since_capture(self, window_id, stage, capture_time):
+    """records the time elapsed since the capture time of a frame.
+
+    The capture time is a time.time() taken by the streaming client, when the
+    receiver runs on another machine the clocks have to be synchronized.
+    """
+    if self.enabled and capture_time:
+      self.record_duration(window_id, stage, time.time() - capture_time)
+
+  def get_stats(self):
+    """returns {window_id: {stage: summary}} with the durations in seconds."""
+    with self._lock:
+      histograms = dict(self._histograms)
+    stats = {}
+    for (window_id, stage), histogram in sorted(
+        histograms.items(), key=lambda item: (str(item[0][0]), item[0][1])
+    ):
+      stats.setdefault(window_id, {})[stage] = histogram.summary()
+    return stats
+
+  def get_histogram(self, stage):
+    """returns a LatencyHistogram of the durations of a stage of all windows."""
+    with self._lock:
+      histograms = [h for (_, s), h in self._histograms.items() if s == stage]
+    merged = LatencyHistogram()
+    for histogram in histograms:
+      merged.merge(histogram)
+    return merged
+
+  def reset(self):
+    """forget all the durations recorded."""
+    with self._lock:
+      self._histograms = {}
+
+  def dump(self):
+    """print the stats in milliseconds."""
+    for window_id, stages in self.get_stats().items():
+      print(f"window {window_id}")
+      for stage, summary in stages.items():
+        print(
+            f"  {stage:<20} n={summary['count']:<6} "
+            f"p50={summary['p50'] * 1e3:8.2f}ms "
+            f"p95={summary['p95'] * 1e3:8.2f}ms "
+            f"p99={summary['p99'] * 1e3:8.2f}ms "
+            f"max={summary['max'] * 1e3:8.2f}ms"
+        )
+
+  def start_periodic_dump(self, interval=5.0):
+    """print the stats every interval seconds until stop_periodic_dump."""
+    if self._dump_stop is not None:
+      return
+    self._dump_stop = threading.Event()
+    stop = self._dump_stop
+
+    def periodic_dump():
+      while not stop.wait(interval):
+        self.dump()
+
+    threading.Thread(target=periodic_dump, daemon=True).start()
+
+  def stop_periodic_dump(self):
+    """stop the periodic dump."""
+    if self._dump_stop is not None:
+      self._dump_stop.set()
+      self._dump_stop = None
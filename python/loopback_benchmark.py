@@ -0,0 +1,298 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""End to end loopback benchmark of the streaming pipeline.
+
+StreamingClients capturing synthetic or recorded windows stream to a
+headless StreamReceiver running in another process, so the cpu used by each
+side is measured apart. The receiver also sends interaction events back to
+measure their latency. Both sides run on the same machine, the latencies
+compare the capture time or the sending time of the other process with the
+same clock.
+
+The results are printed as JSON, the logs of the pipeline go to stderr, so
+they can be stored and compared between commits.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import multiprocessing
+import queue
+import socket
+import sys
+import time
+
+from capture_sources import SyntheticSource
+from events import UIevent
+from events import UIEventsTypes
+from instrumentation import Instrumentation
+from protocol import MessageFlags
+from session_recording import RecordedSource
+from session_recording import SessionRecording
+from stream_receiver import StreamReceiver
+from streaming_client import SharedConnectionClient
+from streaming_client import StreamingClient
+
+WINDOW_COUNTS = (1, 3, 8, 16)
+
+
+class HeadlessStreamReceiver(StreamReceiver):
+  """StreamReceiver counting the frames it decodes instead of showing them.
+
+  Attributes:
+    received_bytes: payload bytes received for each window.
+    displayed_frames: frames decoded for each window.
+  """
+
+  def __init__(self, host, port, slots=8, instrumentation=None):
+    super().__init__(host, port, slots, instrumentation)
+    self.received_bytes = collections.Counter()
+    self.displayed_frames = collections.Counter()
+
+  def _process_incoming_data(
+      self,
+      data,
+      window_id,
+      data_type,
+      flags=MessageFlags.END_OF_FRAME,
+      timestamp=0.0,
+  ):
+    self.received_bytes[window_id] += len(data)
+    super()._process_incoming_data(
+        data, window_id, data_type, flags, timestamp
+    )
+
+  def update_display_frame(self, window_id, frame, capture_time=0.0):
+    """count the frame."""
+    self.displayed_frames[window_id] += 1
+
+
+class _TimedQueue(queue.Queue):
+  """interaction queue recording the time each event arrives."""
+
+  def __init__(self):
+    super().__init__()
+    self.arrivals = {}
+
+  def put(self, item, block=True, timeout=None):
+    self.arrivals[item.value] = time.time()
+    super().put(item, block, timeout)
+
+
+def _summary_ms(histogram):
+  """the percentiles of a LatencyHistogram in milliseconds."""
+  return {
+      key: value * 1e3 if key != "count" else value
+      for key, value in histogram.summary().items()
+  }
+
+
+def _receiver(port, window_count, event_count, control):
+  """Runs the headless receiver, run in another process.
+
+  The receiver waits for "start", sends event_count events to the windows
+  while the clients stream, then waits for "stop" and sends back its
+  results.
+  """
+  instrumentation = Instrumentation(enabled=True)
+  receiver = HeadlessStreamReceiver(
+      "127.0.0.1", port, instrumentation=instrumentation
+  )
+  receiver.start_server()
+  control.send("ready")
+
+  duration = control.recv()
+  start_cpu = time.process_time()
+  sent_times = {}
+  interval = duration / (event_count + 1)
+  for i in range(1, event_count + 1):
+    time.sleep(interval)
+    sent_times[i] = time.time()
+    receiver.interaction_events.put(
+        UIevent(UIEventsTypes.LEFT_BUTTON_DOWN, i, 1, 1, i % window_count + 1)
+    )
+  control.recv()
+  cpu = time.process_time() - start_cpu
+
+  control.send({
+      "sent_times": sent_times,
+      "cpu": cpu,
+      "received_bytes": dict(receiver.received_bytes),
+      "displayed_frames": dict(receiver.displayed_frames),
+      "capture_to_decode": _summary_ms(
+          instrumentation.get_histogram("capture_to_decode")
+      ),
+      "decode": _summary_ms(instrumentation.get_histogram("decode")),
+  })
+  receiver.stop_server()
+
+
+def _free_port():
+  """returns a port free on the loopback interface."""
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def run(
+    window_count,
+    sources,
+    duration=5.0,
+    event_count=20,
+    client_options=None,
+):
+  """Streams windows to a headless receiver over the loopback interface.
+
+  Args:
+    window_count: number of windows streamed.
+    sources: called with the index of a window, returns its CaptureSource.
+    duration: seconds streamed.
+    event_count: interaction events sent by the receiver.
+    client_options: keyword arguments of the StreamingClients.
+
+  Returns:
+    dict of the results.
+  """
+  port = _free_port()
+  control, control_child = multiprocessing.Pipe()
+  receiver = multiprocessing.Process(
+      target=_receiver,
+      args=(port, window_count, event_count, control_child),
+  )
+  receiver.start()
+  control.recv()
+
+  interaction_queue = _TimedQueue()
+  connection = SharedConnectionClient(
+      "127.0.0.1", port, interaction_queue=interaction_queue
+  )
+  clients = [
+      StreamingClient(
+          f"window {i}",
+          i + 1,
+          connection,
+          capture_source=sources(i),
+          **(client_options or {}),
+      )
+      for i in range(window_count)
+  ]
+
+  control.send(duration)
+  start_cpu = time.process_time()
+  for client in clients:
+    client.start_stream()
+  time.sleep(duration)
+  for client in clients:
+    client.stop_stream()
+  for client in clients:
+    client.client_thread.join()
+  client_cpu = time.process_time() - start_cpu
+  # let the frames in flight arrive
+  time.sleep(0.5)
+  control.send("stop")
+  results = control.recv()
+  connection.close()
+  receiver.join()
+  for client in clients:
+    client.window.close()
+
+  frames = sum(results["displayed_frames"].values())
+  event_latency = Instrumentation(enabled=True)
+  for value, sent_time in results["sent_times"].items():
+    arrival = interaction_queue.arrivals.get(value)
+    if arrival is not None:
+      event_latency.record_duration(0, "event", arrival - sent_time)
+  return {
+      "windows": window_count,
+      "fps_per_window": frames / duration / window_count,
+      "bytes_per_frame": (
+          sum(results["received_bytes"].values()) / frames if frames else 0
+      ),
+      "client_cpu_per_window": client_cpu / duration / window_count,
+      "receiver_cpu_per_window": results["cpu"] / duration / window_count,
+      "capture_to_decode_ms": results["capture_to_decode"],
+      "decode_ms": results["decode"],
+      "event_latency_ms": _summary_ms(event_latency.get_histogram("event")),
+      "events_lost": event_count - len(interaction_queue.arrivals),
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+  )
+  parser.add_argument(
+      "--windows", type=int, nargs="+", default=list(WINDOW_COUNTS)
+  )
+  parser.add_argument("--pattern", default="static_ui",
+                      choices=SyntheticSource.PATTERNS)
+  parser.add_argument(
+      "--recording",
+      help="replay the windows of this session recording instead",
+  )
+  parser.add_argument("--width", type=int, default=1280)
+  parser.add_argument("--height", type=int, default=720)
+  parser.add_argument("--duration", type=float, default=5.0)
+  parser.add_argument("--max-fps", type=float, default=15.0)
+  parser.add_argument("--partial-updates", action="store_true")
+  parser.add_argument("--video-mode", action="store_true")
+  parser.add_argument("--output", help="also write the JSON to this file")
+  args = parser.parse_args()
+
+  if args.recording:
+    recording = SessionRecording(args.recording)
+    recorded_windows = recording.window_ids()
+
+    def window_source(index):
+      return RecordedSource(
+          recording, recorded_windows[index % len(recorded_windows)],
+          loop=True,
+      )
+  else:
+
+    def window_source(index):
+      return SyntheticSource(
+          args.pattern, args.width, args.height, seed=index
+      )
+
+  report = {
+      "source": args.recording or args.pattern,
+      "width": args.width,
+      "height": args.height,
+      "duration": args.duration,
+      "max_fps": args.max_fps,
+      "partial_updates": args.partial_updates,
+      "video_mode": args.video_mode,
+      "runs": [],
+  }
+  with contextlib.redirect_stdout(sys.stderr):
+    for count in args.windows:
+      report["runs"].append(
+          run(
+              count,
+              window_source,
+              args.duration,
+              client_options={
+                  "max_fps": args.max_fps,
+                  "partial_updates": args.partial_updates,
+                  "video_mode": args.video_mode,
+              },
+          )
+      )
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, "w") as file:
+      file.write(output)
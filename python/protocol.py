@@ -0,0 +1,266 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module describing the wire protocol between streaming client and receiver.
+
+Version 0 (legacy) frames every message with a little endian uint32 size
+followed by a "window_id|data_type|payload_size" utf-8 string, events sent
+back by the receiver are only prefixed by their size.
+
+From version 1 every message, in both directions, starts with the fixed size
+binary HEADER. The version is negotiated with a HELLO message sent by the
+client with the legacy framing, so receivers not knowing about it ignore it,
+and answered by the receiver with the size prefixed HELLO struct. Clients not
+getting an answer keep on using the legacy framing.
+
+A version 1 client can split its session in two connections: after the
+negotiation each connection sends a CHANNEL message with the session id and
+its ChannelKind, the receiver then sends the interaction events on the EVENTS
+connection only, away from the frames queued on the BULK connection.
+
+From version 1 the receiver can also send CONTROL messages next to the
+interaction events, hinting how a window should be streamed, e.g. paused
+while nobody looks at it.
+"""
+
+import enum
+import struct
+import typing
+
+MAGIC = 0x4D57  # "WM"
+LEGACY_PROTOCOL_VERSION = 0
+PROTOCOL_VERSION = 1
+
+# magic, version, message type, flags, window id, sequence number,
+# capture timestamp and payload length.
+HEADER = struct.Struct("<HBBHQIdI")
+# magic and version.
+HELLO = struct.Struct("<HB")
+# size prefix of the legacy framing.
+SIZE = struct.Struct("<L")
+# session id and ChannelKind.
+CHANNEL = struct.Struct("<QB")
+# paused, target width and height, max frame rate.
+CONTROL = struct.Struct("<BHHf")
+
+
+class MessageType(enum.IntEnum):
+  """Type of the payload, the lower case name is used by the legacy framing."""
+
+  HELLO = 0
+  FRAME = 1
+  PATCH = 2
+  UI_EVENT = 3
+  # inter-frame coding of the video mode, see delta_codec.
+  KEYFRAME = 4
+  DELTA = 5
+  # binds the connection to a session, see ChannelKind.
+  CHANNEL = 6
+  # streaming hints sent by the receiver, see StreamControl.
+  CONTROL = 7
+
+
+class MessageFlags(enum.IntFlag):
+  NONE = 0
+  # last message of a captured frame, the receiver can display it.
+  END_OF_FRAME = 1
+  # the payload was downscaled, it starts with the PATCH_HEADER rectangle
+  # the decoded image has to be resized to.
+  SCALED = 2
+
+
+class ChannelKind(enum.IntEnum):
+  # connection sending the frames.
+  BULK = 0
+  # connection receiving the interaction events.
+  EVENTS = 1
+
+
+class StreamControl(typing.NamedTuple):
+  """How the receiver wants a window streamed, each message replaces the last.
+
+  Attributes:
+    window_id: the window.
+    paused: stop capturing the window, e.g. while it is out of sight.
+    width: target width, the frames are downscaled to fit, 0 for no limit.
+    height: target height, 0 for no limit.
+    max_fps: max frame rate, 0 for no limit.
+  """
+
+  window_id: int
+  paused: bool = False
+  width: int = 0
+  height: int = 0
+  max_fps: float = 0.0
+
+
+class Header(typing.NamedTuple):
+  magic: int
+  version: int
+  message_type: int
+  flags: int
+  window_id: int
+  sequence: int
+  timestamp: float
+  payload_length: int
+
+
+def pack_header(
+    message_type,
+    window_id,
+    payload_length,
+    sequence=0,
+    timestamp=0.0,
+    flags=MessageFlags.END_OF_FRAME,
+):
+  """Packs a version 1 header.
+
+  Args:
+    message_type: MessageType of the payload.
+    window_id: window the payload belongs to, 0 if none.
+    payload_length: size in bytes of the payload following the header.
+    sequence: sequence number of the captured frame.
+    timestamp: capture time of the frame in seconds since the epoch.
+    flags: MessageFlags of the message.
+
+  Returns:
+    the packed header.
+  """
+  return HEADER.pack(
+      MAGIC,
+      PROTOCOL_VERSION,
+      message_type,
+      flags,
+      window_id,
+      sequence & 0xFFFFFFFF,
+      timestamp,
+      payload_length,
+  )
+
+
+def unpack_header(buffer):
+  """Unpacks a version 1 header.
+
+  Args:
+    buffer: bytes-like object starting with the header.
+
+  Returns:
+    the unpacked Header.
+
+  Raises:
+    ProtocolError: if the magic or the version do not match.
+  """
+  header = Header._make(HEADER.unpack_from(buffer))
+  if header.magic != MAGIC or header.version != PROTOCOL_VERSION:
+    raise ProtocolError(
+        f"Invalid header magic {header.magic:#x} version {header.version}"
+    )
+  return header
+
+
+def pack_legacy(window_id, message_type, payload_length):
+  """Packs the size prefixed metadata string of the legacy framing."""
+  metadata = (
+      f"{window_id}|{MessageType(message_type).name.lower()}|{payload_length}"
+  ).encode()
+  return SIZE.pack(len(metadata)) + metadata
+
+
+def unpack_legacy(metadata):
+  """Parses the metadata string of the legacy framing.
+
+  Args:
+    metadata: the decoded "window_id|data_type|payload_size" string.
+
+  Returns:
+    tuple of window id, MessageType and payload length.
+
+  Raises:
+    ValueError: if the metadata is not valid.
+  """
+  window_id, data_type, payload_length = metadata.split("|")
+  try:
+    message_type = MessageType[data_type.upper()]
+  except KeyError as e:
+    raise ValueError(f"Unknown data type {data_type}") from e
+  return int(window_id), message_type, int(payload_length)
+
+
+def pack_hello(version=PROTOCOL_VERSION):
+  """packs the HELLO payload offering or accepting a version."""
+  return HELLO.pack(MAGIC, version)
+
+
+def unpack_hello(data):
+  """returns the version of a HELLO payload, None if data is not a HELLO."""
+  if len(data) != HELLO.size:
+    return None
+  magic, version = HELLO.unpack(data)
+  return version if magic == MAGIC else None
+
+
+def pack_channel(session_id, kind):
+  """packs the CHANNEL payload binding a connection to a session."""
+  return CHANNEL.pack(session_id, kind)
+
+
+def unpack_channel(data):
+  """Unpacks a CHANNEL payload.
+
+  Returns:
+    tuple of the session id and the ChannelKind.
+
+  Raises:
+    ProtocolError: if the payload is not a CHANNEL payload.
+  """
+  if len(data) != CHANNEL.size:
+    raise ProtocolError("Invalid channel message")
+  session_id, kind = CHANNEL.unpack(data)
+  try:
+    return session_id, ChannelKind(kind)
+  except ValueError as e:
+    raise ProtocolError(f"Unknown channel kind {kind}") from e
+
+
+def pack_control(control):
+  """packs the CONTROL payload of a StreamControl, without its window id."""
+  return CONTROL.pack(
+      control.paused, control.width, control.height, control.max_fps
+  )
+
+
+def unpack_control(window_id, data):
+  """Unpacks a CONTROL payload.
+
+  Args:
+    window_id: the window of the message header.
+    data: the payload.
+
+  Returns:
+    the StreamControl.
+
+  Raises:
+    ProtocolError: if the payload is not a CONTROL payload.
+  """
+  if len(data) != CONTROL.size:
+    raise ProtocolError("Invalid control message")
+  paused, width, height, max_fps = CONTROL.unpack(data)
+  return StreamControl(window_id, bool(paused), width, height, max_fps)
+
+
+class ProtocolError(Exception):
+  """Custom exception for malformed messages."""
+
+  def __init__(self, message="the message does not follow the protocol"):
+    self.message = message
+    super().__init__(message)
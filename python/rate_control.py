@@ -0,0 +1,233 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module providing the rate control of the streaming clients."""
+
+import math
+import threading
+
+
+class BandwidthBudget:
+  """Bandwidth shared by all the StreamingClient of a connection.
+
+  Every window reports the bandwidth it is using, a window is allowed to use
+  what the others leave free and at least an equal share of the budget.
+
+  Attributes:
+    bytes_per_second: the budget, None for unlimited.
+  """
+
+  def __init__(self, bytes_per_second=None):
+    self.bytes_per_second = bytes_per_second
+    self._lock = threading.Lock()
+    self._usage = {}
+
+  def update(self, window_id, fps, bytes_per_second):
+    """report the frame rate and the bandwidth used by a window."""
+    with self._lock:
+      self._usage[window_id] = (fps, bytes_per_second)
+
+  def remove(self, window_id):
+    """remove a window that stopped streaming."""
+    with self._lock:
+      self._usage.pop(window_id, None)
+
+  def max_fps(self, window_id, bytes_per_frame):
+    """Returns the max frame rate a window can stream at.
+
+    Args:
+      window_id: the window asking.
+      bytes_per_frame: average size of the frames sent by the window.
+
+    Returns:
+      the frame rate fitting in the budget, math.inf if unlimited.
+    """
+    if self.bytes_per_second is None or bytes_per_frame <= 0:
+      return math.inf
+
+    with self._lock:
+      used_by_others = sum(
+          usage[1]
+          for other_id, usage in self._usage.items()
+          if other_id != window_id
+      )
+      windows = len(self._usage.keys() | {window_id})
+    available = max(
+        self.bytes_per_second / windows, self.bytes_per_second - used_by_others
+    )
+    return available / bytes_per_frame
+
+  def get_stats(self):
+    """returns the frame rate and bandwidth used by each window."""
+    with self._lock:
+      return {
+          window_id: {"fps": fps, "bytes_per_second": bytes_per_second}
+          for window_id, (fps, bytes_per_second) in self._usage.items()
+      }
+
+
+class AdaptiveFrameRate:
+  """Chooses the capture frame rate of a window.
+
+  The rate follows how often the captured frames change: it jumps up as soon
+  as the window gets busy and slowly backs off to min_fps when it goes static.
+  It is capped by the share of the bandwidth budget left to the window.
+
+  Attributes:
+    min_fps: idle frame rate.
+    max_fps: frame rate of a window changing at every frame.
+    fps: the current frame rate.
+  """
+
+  def __init__(
+      self, window_id, min_fps=1.0, max_fps=15.0, budget=None, smoothing=0.3
+  ):
+    """Initializes the controller.
+
+    Args:
+      window_id: the window controlled.
+      min_fps: idle frame rate.
+      max_fps: frame rate of a window changing at every frame.
+      budget: optional BandwidthBudget shared with the other windows.
+      smoothing: weight of the latest frame in the moving averages.
+    """
+    self.window_id = window_id
+    self.min_fps = min_fps
+    self.max_fps = max_fps
+    self.budget = budget
+    self.smoothing = smoothing
+    self.fps = max_fps
+    self._change_rate = 1.0
+    self._bytes_per_frame = 0.0
+
+  @property
+  def frame_time(self):
+    """seconds between two captures."""
+    return 1.0 / self.fps
+
+  def record_sent(self, sent_bytes):
+    """record the size of a frame sent."""
+    self._bytes_per_frame += self.smoothing * (
+        sent_bytes - self._bytes_per_frame
+    )
+
+  def update(self, frame_changed):
+    """Updates the frame rate after a capture.
+
+    Args:
+      frame_changed: whether the captured frame changed.
+
+    Returns:
+      the new frame rate.
+    """
+    self._change_rate += self.smoothing * (
+        float(frame_changed) - self._change_rate
+    )
+    target = self.min_fps + (self.max_fps - self.min_fps) * self._change_rate
+
+    if target > self.fps:
+      fps = target
+    else:
+      fps = self.fps + self.smoothing * (target - self.fps)
+
+    if self.budget is not None:
+      fps = min(fps, self.budget.max_fps(self.window_id, self._bytes_per_frame))
+    self.fps = min(self.max_fps, max(self.min_fps, fps))
+
+    if self.budget is not None:
+      self.budget.update(
+          self.window_id,
+          self.fps,
+          self.fps * self._change_rate * self._bytes_per_frame,
+      )
+    return self.fps
+
+
+class AdaptiveQuality:
+  """Chooses the jpg quality and the downscale factor of a window.
+
+  The time spent sending each frame is averaged, while it is above the target
+  latency the quality is lowered first and then the resolution, while it is
+  well below the target the resolution is restored first and then the
+  quality.
+
+  Attributes:
+    quality: the current jpg quality.
+    scale: the current downscale factor, 1.0 for native resolution.
+  """
+
+  def __init__(
+      self,
+      target_latency=0.1,
+      min_quality=30,
+      max_quality=80,
+      min_scale=0.5,
+      allow_scaling=True,
+      smoothing=0.3,
+      adjust_interval=3,
+  ):
+    """Initializes the controller.
+
+    Args:
+      target_latency: send time per frame to hold, in seconds.
+      min_quality: lowest jpg quality used under pressure.
+      max_quality: jpg quality without pressure.
+      min_scale: lowest downscale factor used under pressure.
+      allow_scaling: whether the resolution can be lowered.
+      smoothing: weight of the latest frame in the send time average.
+      adjust_interval: number of frames sent between two adjustments.
+    """
+    self.target_latency = target_latency
+    self.min_quality = min_quality
+    self.max_quality = max_quality
+    self.min_scale = min_scale
+    self.allow_scaling = allow_scaling
+    self.smoothing = smoothing
+    self.adjust_interval = adjust_interval
+    self.quality = max_quality
+    self.scale = 1.0
+    self._send_time = 0.0
+    self._frames_since_adjust = 0
+
+  @property
+  def degraded(self):
+    """whether frames are sent below full quality or resolution."""
+    return self.quality < self.max_quality or self.scale < 1.0
+
+  def record_sent(self, sent_bytes, send_time):
+    """Records a frame sent and adjusts quality and scale.
+
+    Args:
+      sent_bytes: size of the frame sent.
+      send_time: seconds spent sending the frame.
+    """
+    if not sent_bytes:
+      return
+    self._send_time += self.smoothing * (send_time - self._send_time)
+    self._frames_since_adjust += 1
+    if self._frames_since_adjust < self.adjust_interval:
+      return
+
+    if self._send_time > self.target_latency:
+      self._frames_since_adjust = 0
+      if self.quality > self.min_quality:
+        self.quality = max(self.min_quality, self.quality - 10)
+      elif self.allow_scaling and self.scale > self.min_scale:
+        self.scale = max(self.min_scale, self.scale * 0.75)
+
+    elif self._send_time < self.target_latency / 2:
+      self._frames_since_adjust = 0
+      if self.scale < 1.0:
+        self.scale = min(1.0, self.scale / 0.75)
+      elif self.quality < self.max_quality:
+        self.quality = min(self.max_quality, self.quality + 5)
@@ -0,0 +1,126 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Loopback benchmark of the frame receiving path of the stream receiver.
+
+Compares the previous receive loop, growing a bytes object 4096 bytes at a
+time, with the FramedReader filling a reused buffer with recv_into.
+"""
+
+import argparse
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+
+from framed_reader import FramedReader
+
+
+def _build_message(frame_size):
+  """frames a payload like SharedConnectionClient.send_data."""
+  metadata = f"1|frame|{frame_size}".encode()
+  return struct.pack("<L", len(metadata)) + metadata + bytes(frame_size)
+
+
+def _send_frames(sock, message, frame_count):
+  """sends frame_count times the message."""
+  for _ in range(frame_count):
+    sock.sendall(message)
+  sock.shutdown(socket.SHUT_WR)
+
+
+def _legacy_receive(sock, frame_count):
+  """the receive loop used before the FramedReader.
+
+  The reads are capped to the frame size so the stream stays in sync.
+  """
+  for _ in range(frame_count):
+    metadata_size = struct.unpack("<L", sock.recv(4))[0]
+    metadata = sock.recv(metadata_size).decode("utf-8")
+    _, _, expected_frame_size = metadata.split("|")
+    expected_frame_size = int(expected_frame_size)
+    data = b""
+    while len(data) < expected_frame_size:
+      data += sock.recv(min(4096, expected_frame_size - len(data)))
+
+
+def _framed_receive(sock, frame_count):
+  """the receive loop using the FramedReader."""
+  reader = FramedReader(sock)
+  for _ in range(frame_count):
+    metadata = str(reader.read_message(), "utf-8")
+    _, _, expected_frame_size = metadata.split("|")
+    reader.read_exactly(int(expected_frame_size))
+
+
+def run(receive, frame_size, frame_count, trace_memory=False):
+  """Streams frames over a loopback connection.
+
+  Args:
+    receive: receiving function, _legacy_receive or _framed_receive.
+    frame_size: size of the frames in bytes.
+    frame_count: number of frames to stream.
+    trace_memory: trace the allocations, slows down the receiving.
+
+  Returns:
+    dict with the throughput in MB/s and the peak of bytes allocated while
+    receiving.
+  """
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(("127.0.0.1", 0))
+  server.listen()
+  sender = socket.create_connection(server.getsockname())
+  receiver, _ = server.accept()
+  server.close()
+
+  sender_thread = threading.Thread(
+      target=_send_frames,
+      args=(sender, _build_message(frame_size), frame_count),
+  )
+  if trace_memory:
+    tracemalloc.start()
+  start_time = time.perf_counter()
+  sender_thread.start()
+  receive(receiver, frame_count)
+  elapsed_time = time.perf_counter() - start_time
+  peak = None
+  if trace_memory:
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  sender_thread.join()
+  sender.close()
+  receiver.close()
+
+  return {
+      "mb_per_s": frame_size * frame_count / elapsed_time / 1e6,
+      "peak_allocated_bytes": peak,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--frame-size", type=int, default=500_000)
+  parser.add_argument("--frames", type=int, default=200)
+  args = parser.parse_args()
+
+  for name, receive_function in (
+      ("legacy", _legacy_receive),
+      ("framed", _framed_receive),
+  ):
+    throughput = run(receive_function, args.frame_size, args.frames)
+    memory = run(receive_function, args.frame_size, 10, trace_memory=True)
+    print(
+        f"{name:>7}: {throughput['mb_per_s']:8.1f} MB/s, "
+        f"peak allocated {memory['peak_allocated_bytes'] / 1e6:6.2f} MB"
+    )
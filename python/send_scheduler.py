@@ -0,0 +1,257 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module scheduling the frames of the windows sharing a connection.
+
+The frames are sent by a single thread in deficit round robin order: every
+window with frames pending earns quantum bytes per round and sends its frames
+while they fit in what it earned, so a window sending large frames can not
+starve the windows sending small ones. The window the user interacted with
+last earns focus_weight times more.
+"""
+
+import argparse
+import collections
+import threading
+import time
+import typing
+
+from instrumentation import LatencyHistogram
+
+
+class _Entry(typing.NamedTuple):
+  """a frame waiting to be sent."""
+
+  frame: typing.Any
+  size: int
+  queued_at: float
+
+
+class FrameScheduler:
+  """Deficit round robin queue of the frames of several windows.
+
+  A frame replacing the whole window, a full frame or a keyframe, drops the
+  frames of the window still pending, they would only be sent to be drawn
+  over. The other frames apply on the previous ones and are never dropped,
+  put blocks instead while the window has max_pending_frames pending.
+
+  Attributes:
+    quantum: bytes a window earns per round.
+    focus_weight: multiplier of the quantum of the focused window.
+    focus_timeout: seconds after the last interaction the focus is kept.
+    max_pending_frames: frames of a window pending before put blocks.
+    dropped_frames: number of frames dropped because a newer one replaced
+      them.
+  """
+
+  def __init__(
+      self,
+      quantum=64 << 10,
+      focus_weight=4,
+      focus_timeout=2.0,
+      max_pending_frames=2,
+  ):
+    self.quantum = quantum
+    self.focus_weight = focus_weight
+    self.focus_timeout = focus_timeout
+    self.max_pending_frames = max_pending_frames
+    self.dropped_frames = 0
+    self._pending: dict[int, collections.deque[_Entry]] = {}
+    self._deficits: dict[int, int] = {}
+    self._active = collections.deque()
+    self._focus = None
+    self._focus_time = 0.0
+    self._condition = threading.Condition()
+    self._closed = False
+
+  def put(self, window_id, frame, size, replaces_pending=False):
+    """Queues a frame of a window.
+
+    Args:
+      window_id: the window of the frame.
+      frame: the frame, returned as is by get.
+      size: bytes of the frame.
+      replaces_pending: the frame replaces the whole window, the pending
+        frames of the window are dropped.
+
+    The frame is dropped if the window is removed while put waits.
+    """
+    with self._condition:
+      pending = self._pending.get(window_id)
+      if pending is None:
+        pending = self._pending[window_id] = collections.deque()
+        self._deficits[window_id] = 0
+      if replaces_pending:
+        self.dropped_frames += len(pending)
+        pending.clear()
+      else:
+        while not self._closed and len(pending) >= self.max_pending_frames:
+          self._condition.wait()
+          if self._pending.get(window_id) is not pending:
+            self.dropped_frames += 1
+            return
+        if self._closed:
+          return
+      if window_id not in self._active:
+        self._active.append(window_id)
+      pending.append(_Entry(frame, size, time.perf_counter()))
+      self._condition.notify_all()
+
+  def get(self, timeout=None):
+    """Takes the next frame to send.
+
+    Args:
+      timeout: max seconds to wait for a frame, None to wait forever.
+
+    Returns:
+      tuple of the window, the frame and the seconds it waited in the queue,
+      None when closed or on timeout.
+    """
+    with self._condition:
+      if not self._condition.wait_for(
+          lambda: self._closed or self._active, timeout
+      ) or self._closed:
+        return None
+      window_id, entry = self.__next_entry()
+      self._condition.notify_all()
+      return window_id, entry.frame, time.perf_counter() - entry.queued_at
+
+  def __next_entry(self):
+    """pops the next entry in deficit round robin order."""
+    while True:
+      window_id = self._active[0]
+      pending = self._pending[window_id]
+      if self._deficits[window_id] >= pending[0].size:
+        entry = pending.popleft()
+        self._deficits[window_id] -= entry.size
+        if not pending:
+          # an idle window does not keep what it earned
+          self._deficits[window_id] = 0
+          self._active.popleft()
+        return window_id, entry
+      self._deficits[window_id] += self.quantum * self.__weight(window_id)
+      self._active.rotate(-1)
+
+  def __weight(self, window_id):
+    """the focused window earns more while the user interacts with it."""
+    if (
+        window_id == self._focus
+        and time.perf_counter() - self._focus_time < self.focus_timeout
+    ):
+      return self.focus_weight
+    return 1
+
+  def set_focus(self, window_id):
+    """boost a window, called when the user interacts with it."""
+    with self._condition:
+      self._focus = window_id
+      self._focus_time = time.perf_counter()
+
+  def remove(self, window_id):
+    """drop the pending frames of a window and forget it, wakes up put."""
+    with self._condition:
+      pending = self._pending.pop(window_id, None)
+      self._deficits.pop(window_id, None)
+      if pending:
+        pending.clear()
+        self._active.remove(window_id)
+      self._condition.notify_all()
+
+  def clear(self):
+    """drop all the pending frames, e.g. after a reconnection."""
+    with self._condition:
+      for pending in self._pending.values():
+        pending.clear()
+      self._active.clear()
+      self._condition.notify_all()
+
+  def close(self):
+    """wake up and return from put and get, the pending frames are dropped."""
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+
+
+def simulate(windows, bandwidth, duration=5.0, scheduler=None):
+  """Simulates windows sending full frames over a link, in virtual time.
+
+  Args:
+    windows: list of (window_id, frame_size, fps).
+    bandwidth: bytes per second of the link.
+    duration: seconds simulated.
+    scheduler: FrameScheduler the frames go through, None to send them in
+      arrival order like concurrent sendall calls.
+
+  Returns:
+    dict with the LatencyHistogram of every window, from capture to sent.
+  """
+  arrivals = sorted(
+      (i / fps, window_id, size)
+      for window_id, size, fps in windows
+      for i in range(int(duration * fps))
+  )
+  latencies = {window_id: LatencyHistogram() for window_id, _, _ in windows}
+  fifo = collections.deque()
+  link_time = 0.0
+  next_arrival = 0
+  while True:
+    # queue every frame captured while the link was busy
+    while (
+        next_arrival < len(arrivals) and arrivals[next_arrival][0] <= link_time
+    ):
+      capture_time, window_id, size = arrivals[next_arrival]
+      next_arrival += 1
+      if scheduler is None:
+        fifo.append((window_id, (capture_time, size)))
+      else:
+        scheduler.put(window_id, (capture_time, size), size, True)
+
+    if scheduler is None:
+      sent = fifo.popleft() if fifo else None
+    else:
+      sent = scheduler.get(timeout=0)
+    if sent is None:
+      if next_arrival == len(arrivals):
+        return latencies
+      link_time = arrivals[next_arrival][0]
+      continue
+    window_id, (capture_time, size) = sent[:2]
+    link_time += size / bandwidth
+    latencies[window_id].record(link_time - capture_time)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description=(
+          "latency of small windows sharing a link with a large one, sent in"
+          " arrival order or scheduled"
+      )
+  )
+  parser.add_argument("--bandwidth", type=float, default=20e6)
+  args = parser.parse_args()
+
+  simulated_windows = [(1, 1 << 20, 15), (2, 20 << 10, 30), (3, 40 << 10, 30)]
+  for name, frame_scheduler in (
+      ("arrival order", None),
+      ("scheduled", FrameScheduler()),
+  ):
+    print(name)
+    for window, histogram in simulate(
+        simulated_windows, args.bandwidth, scheduler=frame_scheduler
+    ).items():
+      summary = histogram.summary()
+      print(
+          f"  window {window}: {summary['count']:4} frames sent, "
+          f"p50 {summary['p50'] * 1e3:8.1f} ms, "
+          f"p95 {summary['p95'] * 1e3:8.1f} ms"
+      )
@@ -0,0 +1,90 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the FrameScheduler deficit round robin and of its blocking."""
+
+import collections
+import threading
+import unittest
+
+from send_scheduler import FrameScheduler
+
+
+def _take(scheduler, count):
+  """takes count frames, returns the bytes and the frames of each window."""
+  sent_bytes = collections.Counter()
+  sent_frames = collections.Counter()
+  for _ in range(count):
+    window_id, frame, _ = scheduler.get(timeout=0)
+    sent_bytes[window_id] += frame
+    sent_frames[window_id] += 1
+  return sent_bytes, sent_frames
+
+
+class FrameSchedulerTest(unittest.TestCase):
+
+  def test_windows_send_the_same_bytes_whatever_their_frame_size(self):
+    scheduler = FrameScheduler(quantum=64 << 10, max_pending_frames=100)
+    for _ in range(10):
+      scheduler.put(1, 64 << 10, 64 << 10)
+    for _ in range(80):
+      scheduler.put(2, 8 << 10, 8 << 10)
+    sent_bytes, sent_frames = _take(scheduler, 27)
+    self.assertEqual(sent_frames, {1: 3, 2: 24})
+    self.assertEqual(sent_bytes[1], sent_bytes[2])
+
+  def test_focused_window_earns_focus_weight_times_more(self):
+    scheduler = FrameScheduler(
+        quantum=16 << 10, focus_weight=4, max_pending_frames=100
+    )
+    for _ in range(50):
+      scheduler.put(1, 16 << 10, 16 << 10)
+      scheduler.put(2, 16 << 10, 16 << 10)
+    scheduler.set_focus(2)
+    _, sent_frames = _take(scheduler, 25)
+    self.assertEqual(sent_frames, {1: 5, 2: 20})
+
+  def test_full_frame_drops_the_pending_frames(self):
+    scheduler = FrameScheduler()
+    scheduler.put(1, "patch 1", 1)
+    scheduler.put(1, "patch 2", 1)
+    scheduler.put(1, "full frame", 1, replaces_pending=True)
+    self.assertEqual(scheduler.dropped_frames, 2)
+    self.assertEqual(scheduler.get(timeout=0)[1], "full frame")
+    self.assertIsNone(scheduler.get(timeout=0))
+
+  def test_remove_wakes_up_a_blocked_put(self):
+    scheduler = FrameScheduler(max_pending_frames=1)
+    scheduler.put(1, "frame 1", 1)
+    thread = threading.Thread(target=scheduler.put, args=(1, "frame 2", 1))
+    thread.start()
+    thread.join(0.1)
+    self.assertTrue(thread.is_alive())
+    scheduler.remove(1)
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(scheduler.dropped_frames, 1)
+    self.assertIsNone(scheduler.get(timeout=0))
+
+  def test_close_wakes_up_get(self):
+    scheduler = FrameScheduler()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(scheduler.get()))
+    thread.start()
+    scheduler.close()
+    thread.join(5)
+    self.assertEqual(results, [None])
+
+
+if __name__ == "__main__":
+  unittest.main()
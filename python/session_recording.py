@@ -0,0 +1,310 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module recording the captured frames of a session and replaying them.
+
+A recording is an append-only file starting with MAGIC, followed by one
+ENTRY per captured frame: window id, capture time, width, height, channels,
+offset and length of the raw pixels. The pixels of a frame follow its entry,
+unless the same pixels were already recorded, the entry then points to them
+and its length is 0. The file is only appended to, a recording interrupted
+by a crash stays readable up to its last complete frame.
+
+A RecordedSource memory-maps the recording and streams its frames as views
+on the mapping, so the captures of a real session can be replayed without
+the win32 API and without copying them.
+"""
+
+import argparse
+import hashlib
+import mmap
+import struct
+import threading
+import time
+import typing
+
+from capture_sources import CaptureSource
+from capture_sources import SyntheticSource
+import numpy as np
+
+MAGIC = b"WMREC\x00\x00\x01"
+# window id, capture time, width, height, channels, pixels offset and length.
+ENTRY = struct.Struct("<QdIIIQQ")
+
+
+class RecordedFrame(typing.NamedTuple):
+  window_id: int
+  timestamp: float
+  width: int
+  height: int
+  channels: int
+  offset: int
+  length: int
+
+
+class SessionRecorder:
+  """Appends the frames captured by StreamingClients to a recording.
+
+  The recorder can be shared by the clients of all the windows, the frames
+  are hashed so a window that did not change only costs an entry.
+
+  Attributes:
+    path: the recording.
+    recorded_frames: number of frames recorded.
+    stored_frames: number of frames whose pixels were stored.
+  """
+
+  def __init__(self, path):
+    """Creates the recording, overwriting an existing file."""
+    self.path = path
+    self.recorded_frames = 0
+    self.stored_frames = 0
+    self._file = open(path, "wb")
+    self._file.write(MAGIC)
+    self._offsets: dict[bytes, tuple[int, int]] = {}
+    self._lock = threading.Lock()
+
+  def record(self, window_id, frame, timestamp=None):
+    """Appends a frame.
+
+    Args:
+      window_id: the window captured.
+      frame (numpy.ndarray): the frame, height x width x channels uint8.
+      timestamp: capture time in seconds since the epoch, now if None.
+    """
+    if timestamp is None:
+      timestamp = time.time()
+    frame = np.ascontiguousarray(frame)
+    height, width = frame.shape[:2]
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    digest = hashlib.blake2b(frame, digest_size=16).digest()
+
+    with self._lock:
+      if self._file.closed:
+        return
+      position = self._file.tell()
+      offset, length = self._offsets.get(digest, (0, 0))
+      stored = not length
+      if stored:
+        offset, length = position + ENTRY.size, frame.nbytes
+        self._offsets[digest] = (offset, length)
+      self._file.write(
+          ENTRY.pack(
+              window_id,
+              timestamp,
+              width,
+              height,
+              channels,
+              offset,
+              length if stored else 0,
+          )
+      )
+      if stored:
+        self._file.write(memoryview(frame).cast("B"))
+        self.stored_frames += 1
+      self.recorded_frames += 1
+
+  def close(self):
+    """flush and close the recording."""
+    with self._lock:
+      self._file.close()
+
+
+class SessionRecording:
+  """A recording memory-mapped for reading.
+
+  Attributes:
+    path: the recording.
+    frames: the RecordedFrame of every entry, in capture order. The length
+      of the deduplicated frames is the one of the pixels they point to.
+  """
+
+  def __init__(self, path):
+    """Maps the recording and reads its entries.
+
+    Raises:
+      ValueError: if the file is not a recording.
+    """
+    self.path = path
+    with open(path, "rb") as file:
+      self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._mmap[: len(MAGIC)] != MAGIC:
+      self._mmap.close()
+      raise ValueError(f"{path} is not a session recording")
+
+    self.frames = []
+    position = len(MAGIC)
+    while position + ENTRY.size <= len(self._mmap):
+      frame = RecordedFrame._make(ENTRY.unpack_from(self._mmap, position))
+      position += ENTRY.size + frame.length
+      if position > len(self._mmap):
+        # the last frame was not completely written
+        break
+      if not frame.length:
+        frame = frame._replace(
+            length=frame.width * frame.height * frame.channels
+        )
+      self.frames.append(frame)
+
+  def window_ids(self):
+    """returns the ids of the windows recorded, in order of appearance."""
+    return list(dict.fromkeys(frame.window_id for frame in self.frames))
+
+  def pixels(self, frame):
+    """Returns the pixels of a frame.
+
+    Args:
+      frame: a RecordedFrame of the recording.
+
+    Returns:
+      read only height x width x channels uint8 array viewing the mapping.
+    """
+    shape = (frame.height, frame.width)
+    if frame.channels > 1:
+      shape += (frame.channels,)
+    return np.frombuffer(
+        self._mmap, np.uint8, frame.length, frame.offset
+    ).reshape(shape)
+
+  def close(self):
+    """unmap the recording, once the pixels returned are not used anymore."""
+    try:
+      self._mmap.close()
+    except BufferError:
+      # arrays still view the mapping, it is unmapped with the last of them
+      pass
+
+
+class RecordedSource(CaptureSource):
+  """Replays the frames of a window from a recording.
+
+  With realtime pacing screenshot returns the frame the window showed at
+  the same time of the recording, like a live capture would, otherwise every
+  call returns the next frame, as fast as the client captures them.
+
+  Attributes:
+    recording: the SessionRecording replayed.
+    window_id: the window replayed.
+    realtime: whether the frames follow the pacing of the recording.
+    loop: whether the replay restarts at the end, otherwise the last frame
+      is repeated like a window that stopped changing.
+    frame_index: index of the last frame returned.
+  """
+
+  def __init__(self, recording, window_id=None, realtime=True, loop=False):
+    """Initializes the source.
+
+    Args:
+      recording: a SessionRecording or the path of a recording.
+      window_id: the window to replay, optional when only one was recorded.
+      realtime: follow the pacing of the recording.
+      loop: restart at the end of the recording.
+
+    Raises:
+      ValueError: if the window was not recorded.
+    """
+    self._owns_recording = not isinstance(recording, SessionRecording)
+    if self._owns_recording:
+      recording = SessionRecording(recording)
+    window_ids = recording.window_ids()
+    if window_id is None and len(window_ids) == 1:
+      window_id = window_ids[0]
+    if window_id not in window_ids:
+      raise ValueError(
+          f"Window {window_id} not found in the recording, expected one of"
+          f" {window_ids}"
+      )
+    self.recording = recording
+    self.window_id = window_id
+    self.realtime = realtime
+    self.loop = loop
+    self.frame_index = -1
+    self._frames = [f for f in recording.frames if f.window_id == window_id]
+    self._timestamps = [f.timestamp - self._frames[0].timestamp
+                        for f in self._frames]
+    self._start_time = None
+
+  def screenshot(self):
+    """returns the next frame, a read only view on the recording."""
+    count = len(self._frames)
+    if self.realtime:
+      now = time.perf_counter()
+      if self._start_time is None:
+        self._start_time = now
+      elapsed = now - self._start_time
+      if self.loop and self._timestamps[-1] > 0:
+        elapsed %= self._timestamps[-1]
+      # the last frame recorded before the elapsed time
+      index = self.frame_index if self.frame_index >= 0 else 0
+      if index >= count or self._timestamps[index] > elapsed:
+        index = 0
+      while index + 1 < count and self._timestamps[index + 1] <= elapsed:
+        index += 1
+    elif self.loop:
+      index = (self.frame_index + 1) % count
+    else:
+      index = min(self.frame_index + 1, count - 1)
+    self.frame_index = index
+    return self.recording.pixels(self._frames[index])
+
+  def close(self):
+    """unmap the recording if the source opened it."""
+    if self._owns_recording:
+      self.recording.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description=(
+          "record a synthetic window and measure the replay rate of a"
+          " recording"
+      )
+  )
+  parser.add_argument("recording", help="path of the recording")
+  parser.add_argument(
+      "--record",
+      choices=SyntheticSource.PATTERNS,
+      help="first record this synthetic pattern",
+  )
+  parser.add_argument("--frames", type=int, default=100)
+  args = parser.parse_args()
+
+  if args.record:
+    recorder = SessionRecorder(args.recording)
+    source = SyntheticSource(args.record)
+    start_time = time.perf_counter()
+    for i in range(args.frames):
+      recorder.record(1, source.screenshot(), i / 30)
+    recorder.close()
+    print(
+        f"recorded {recorder.recorded_frames} frames, "
+        f"{recorder.stored_frames} stored, "
+        f"{(time.perf_counter() - start_time) / args.frames * 1e3:.2f} ms"
+        " per frame"
+    )
+
+  session = SessionRecording(args.recording)
+  for recorded_window in session.window_ids():
+    replay = RecordedSource(session, recorded_window, realtime=False)
+    frame_count = sum(
+        1 for f in session.frames if f.window_id == recorded_window
+    )
+    start_time = time.perf_counter()
+    for _ in range(frame_count):
+      replay.screenshot()
+    elapsed_time = time.perf_counter() - start_time
+    print(
+        f"window {recorded_window}: {frame_count} frames, "
+        f"replayed at {frame_count / elapsed_time:10.1f} fps"
+    )
+  session.close()
@@ -15,26 +15,408 @@
 
 import queue
 import socket
-import struct
 import threading
 import cv2
 import numpy as np
+from delta_codec import DeltaDecoder
+from encode_pool import EncodePool
+from events import drain_queue
+from events import requeue_front
+from events import STOP_EVENT
+from events import UIevent
+from frame_diff import unpack_patch
+from framed_reader import FramedReader
+from instrumentation import Instrumentation
+from protocol import ChannelKind
+from protocol import HEADER
+from protocol import HELLO
+from protocol import LEGACY_PROTOCOL_VERSION
+from protocol import MessageFlags
+from protocol import MessageType
+from protocol import pack_control
+from protocol import pack_header
+from protocol import pack_hello
+from protocol import PROTOCOL_VERSION
+from protocol import ProtocolError
+from protocol import SIZE
+from protocol import StreamControl
+from protocol import unpack_header
+from protocol import unpack_channel
+from protocol import unpack_hello
+from protocol import unpack_legacy
+from window_display import FrameMailbox
 from window_display import WindowDisplay
 
+_REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class BaseStreamReceiver:
+  """Decodes the received frames and shows them, whatever the transport.
+
+  Attributes:
+    receive_buffer_size: SO_RCVBUF of the connections receiving the frames
+      of a dual channel session.
+    events_buffer_size: SO_SNDBUF and SO_RCVBUF of the connections sending
+      the events of a dual channel session, small so the events do not
+      queue up behind each other.
+    windows: display and display thread of each window.
+    frames: last frame of each window, patches are applied on it.
+    decoders: DeltaDecoder of each window streamed in video mode.
+    display_sizes: (width, height) each window is shown at, see
+      set_display_size.
+    interaction_events: queue the displays put the ui events in.
+    instrumentation: Instrumentation recording the receiving stages.
+  """
+
+  receive_buffer_size = 4 << 20
+  events_buffer_size = 16 << 10
+
+  def __init__(self, instrumentation=None):
+    self.windows: dict[int, tuple[WindowDisplay, threading.Thread]] = {}
+    self.frames: dict[int, np.ndarray] = {}
+    self.decoders: dict[int, DeltaDecoder] = {}
+    self.display_sizes: dict[int, tuple[int, int]] = {}
+    # full size of the last full frame of each window
+    self._source_sizes: dict[int, tuple[int, int]] = {}
+    # reduction of the last full frame received and of the last applied
+    self._reductions: dict[int, int] = {}
+    self._frame_reductions: dict[int, int] = {}
+    self.interaction_events = queue.Queue()
+    self.instrumentation = instrumentation or Instrumentation()
+
+  def set_display_size(self, window_id, size):
+    """Sets the size a window is shown at.
+
+    The next full frames of the window are decoded reduced by 2, 4 or 8 as
+    long as they stay at least as large as the display, jpeg decodes that
+    much faster. The reduced frames are the ones displayed.
+
+    Args:
+      window_id: the window.
+      size: (width, height) of the display, None to decode at full size.
+    """
+    if size is None:
+      self.display_sizes.pop(window_id, None)
+    else:
+      self.display_sizes[window_id] = size
+
+  def _reduction(self, window_id, data_type):
+    """Chooses the reduction a message is decoded with.
+
+    A full frame is reduced as much as the display allows, using the size of
+    the previous frame of the window, its patches use the same reduction to
+    match it. Called in reception order.
+    """
+    if data_type == MessageType.PATCH:
+      return self._reductions.get(window_id, 1)
+    reduction = 1
+    display_size = self.display_sizes.get(window_id)
+    source_size = self._source_sizes.get(window_id)
+    if data_type == MessageType.FRAME and display_size and source_size:
+      reduction = next(
+          r
+          for r in (8, 4, 2, 1)
+          if source_size[0] >= display_size[0] * r
+          and source_size[1] >= display_size[1] * r
+      )
+    self._reductions[window_id] = reduction
+    return reduction
+
+  def _process_incoming_data(
+      self,
+      data,
+      window_id,
+      data_type,
+      flags=MessageFlags.END_OF_FRAME,
+      timestamp=0.0,
+  ):
+
+    start = self.instrumentation.now()
+    reduction = self._reduction(window_id, data_type)
+    decoded = self._decode_message(data, data_type, flags, reduction)
+    self._apply_message(
+        decoded, window_id, data_type, flags, timestamp, reduction, start
+    )
+
+  def _decode_message(self, data, data_type, flags, reduction):
+    """Decodes what does not depend on the previous frames of the window.
+
+    Args:
+      data: the payload of the message.
+      data_type: the MessageType of the message.
+      flags: the MessageFlags of the message.
+      reduction: 1, 2, 4 or 8, how much the image is reduced.
+
+    Returns:
+      for a FRAME or a PATCH, the full size rectangle of a scaled or patch
+      image or None, and the image or None if it could not be decoded. The
+      data of the other messages, decoded by _apply_message.
+    """
+    if data_type not in (MessageType.FRAME, MessageType.PATCH):
+      return data
+    rect = None
+    if data_type == MessageType.PATCH or flags & MessageFlags.SCALED:
+      rect, data = unpack_patch(data)
+    # a scaled image is already small, it is decoded whole and resized
+    read_flag = (
+        cv2.IMREAD_COLOR
+        if flags & MessageFlags.SCALED
+        else _REDUCED_READ_FLAGS[reduction]
+    )
+    return rect, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), read_flag)
+
+  def _apply_message(
+      self, decoded, window_id, data_type, flags, timestamp, reduction, start
+  ):
+    """Updates the frame of the window with a decoded message and shows it.
+
+    Must be called in reception order for each window. The patches are
+    applied in place on the frame of the window, the display gets a copy of
+    it so it never shows a frame being patched.
+
+    Args:
+      decoded: what _decode_message returned.
+      window_id: the window of the message.
+      data_type: the MessageType of the message.
+      flags: the MessageFlags of the message.
+      timestamp: capture time of the frame.
+      reduction: the reduction the message was decoded with.
+      start: time the decoding started, from the instrumentation clock.
+    """
+    if data_type == MessageType.FRAME:
+      rect, frame = decoded
+      if frame is None:
+        return
+      if rect is None:
+        self._source_sizes[window_id] = (
+            frame.shape[1] * reduction,
+            frame.shape[0] * reduction,
+        )
+      else:
+        self._source_sizes[window_id] = rect[2:]
+        frame = cv2.resize(
+            frame,
+            (-(-rect[2] // reduction), -(-rect[3] // reduction)),
+            interpolation=cv2.INTER_LINEAR,
+        )
+      self.frames[window_id] = frame
+      self._frame_reductions[window_id] = reduction
+      self.__record_decode(window_id, start, timestamp)
+      # patches may follow, e.g. the region of interest over the background
+      if flags & MessageFlags.END_OF_FRAME:
+        self.update_display_frame(window_id, frame.copy(), timestamp)
+
+    elif data_type == MessageType.PATCH:
+      frame = self.frames.get(window_id)
+      if frame is None or self._frame_reductions[window_id] != reduction:
+        # patches can only be applied on top of the full frame they follow
+        return
+      (x, y, w, h), patch = decoded
+      if patch is None:
+        return
+      left, top = x // reduction, y // reduction
+      right = min(-(-(x + w) // reduction), frame.shape[1])
+      bottom = min(-(-(y + h) // reduction), frame.shape[0])
+      if right <= left or bottom <= top:
+        return
+      if patch.shape[:2] != (bottom - top, right - left):
+        patch = cv2.resize(
+            patch, (right - left, bottom - top), interpolation=cv2.INTER_LINEAR
+        )
+      frame[top:bottom, left:right] = patch
+      self.__record_decode(window_id, start, timestamp)
+      # display the frame once all its patches are applied
+      if flags & MessageFlags.END_OF_FRAME:
+        self.update_display_frame(window_id, frame.copy(), timestamp)
+
+    elif data_type in (MessageType.KEYFRAME, MessageType.DELTA):
+      decoder = self.decoders.setdefault(window_id, DeltaDecoder())
+      frame = decoder.decode(data_type, decoded)
+      if frame is None:
+        return
+      # the decoder updates its frame in place, the display gets a copy
+      if frame.ndim == 3 and frame.shape[2] == 4:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+      else:
+        frame = frame.copy()
+      self.frames[window_id] = frame
+      self._frame_reductions[window_id] = 1
+      self.__record_decode(window_id, start, timestamp)
+      self.update_display_frame(window_id, frame, timestamp)
+
+  def __record_decode(self, window_id, start, timestamp):
+    """record the decoding time and the latency since the capture."""
+    self.instrumentation.record(window_id, "decode", start)
+    self.instrumentation.record_since_capture(
+        window_id, "capture_to_decode", timestamp
+    )
+
+  def _bind_channel(self, channels, session, sock, data):
+    """Ties a connection to the other connection of its session.
+
+    Args:
+      channels: dict of the sessions of each session id by ChannelKind.
+      session: the session of the connection.
+      sock: the socket of the connection.
+      data: the CHANNEL payload.
+
+    Returns:
+      the sessions of the session id.
+    """
+    session_id, kind = unpack_channel(bytes(data))
+    if kind == ChannelKind.EVENTS:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, self.events_buffer_size)
+    else:
+      sock.setsockopt(
+          socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size
+      )
+    session.channel_id = session_id
+    channel = channels.setdefault(session_id, {})
+    channel[kind] = session
+    return channel
+
+  def _unbind_channel(self, channels, session):
+    """forget the connection of a session when it closes."""
+    channel = channels.get(session.channel_id, {})
+    for kind, channel_session in list(channel.items()):
+      if channel_session is session:
+        del channel[kind]
+    if not channel:
+      channels.pop(session.channel_id, None)
+
+  def send_control(self, window_id, paused=False, size=None, max_fps=0.0):
+    """Tells the client how to stream a window.
+
+    The control is queued with the interaction events, the legacy clients
+    do not receive it. It replaces the previous control of the window.
+
+    Args:
+      window_id: the window.
+      paused: stop streaming the window, e.g. while it is out of sight.
+      size: (width, height) the frames are downscaled to fit, None for the
+        size of the window.
+      max_fps: max frame rate of the window, 0 for no limit.
+    """
+    width, height = size or (0, 0)
+    self.interaction_events.put(
+        StreamControl(window_id, paused, width, height, max_fps)
+    )
+
+  def _pack_event(self, event, protocol_version):
+    """frame an interaction event or a StreamControl for the protocol."""
+    if isinstance(event, StreamControl):
+      if protocol_version == LEGACY_PROTOCOL_VERSION:
+        return b""
+      data = pack_control(event)
+      return pack_header(MessageType.CONTROL, event.window_id, len(data)) + data
+    reduction = self._frame_reductions.get(event.window_id, 1)
+    if reduction > 1:
+      # the display shows the frame reduced, the client needs window
+      # coordinates
+      event = UIevent(
+          event.event_type,
+          event.value,
+          event.x * reduction,
+          event.y * reduction,
+          event.window_id,
+      )
+    bytes_to_send = event.to_bytes()
+    if protocol_version == LEGACY_PROTOCOL_VERSION:
+      return SIZE.pack(len(bytes_to_send)) + bytes_to_send
+    return (
+        pack_header(MessageType.UI_EVENT, event.window_id, len(bytes_to_send))
+        + bytes_to_send
+    )
+
+  def update_display_frame(self, window_id, frame, capture_time=0.0):
+    """use the incoming data to update the displays."""
+
+    displayer, _ = self.windows.get(window_id, (None, None))
+
+    if displayer is None:
+      displayer = WindowDisplay(
+          frame,
+          str(window_id),
+          FrameMailbox(),
+          self.interaction_events,
+          self.instrumentation,
+      )
+      image_thread = threading.Thread(target=displayer.display)
+
+      self.windows[window_id] = (displayer, image_thread)
+      image_thread.start()
+    else:
+      displayer.mailbox.put(frame, capture_time)
+
+  def dropped_frames(self):
+    """returns the number of frames each display skipped."""
+    return {
+        window_id: displayer.mailbox.dropped
+        for window_id, (displayer, _) in self.windows.items()
+    }
+
+  def close_all_display(self):
+    """close all the display objects."""
+
+    for displayer, image_thread in self.windows.values():
+      displayer.quit(True)
+      image_thread.join()
+
+
+class DecodePool(EncodePool):
+  """Decoding stage of a StreamReceiver.
+
+  The frames are decoded by a bounded pool of workers and applied in
+  reception order for each window, like the EncodePool of the clients. Only a
+  full frame or a keyframe supersedes the frames of its window still waiting,
+  the patches and deltas are never dropped.
+  """
 
-class StreamReceiver:
-  """Base class for the sharing client."""
+  stage = "decode"
 
-  def __init__(self, host, port, slots=8):
+  def __init__(self, max_workers=2):
+    super().__init__(max_workers, max_pending=1)
+
+
+class StreamReceiver(BaseStreamReceiver):
+  """Base class for the sharing client.
+
+  Attributes:
+    decode_pool: DecodePool decoding the frames, None when they are decoded
+      on the threads reading the connections.
+  """
+
+  def __init__(
+      self, host, port, slots=8, instrumentation=None, decode_workers=2
+  ):
+    """Initializes the receiver.
+
+    Args:
+      host: address to listen on.
+      port: port to listen on.
+      slots: max number of connections.
+      instrumentation: Instrumentation recording the receiving stages.
+      decode_workers: size of the decode_pool, 0 to decode on the threads
+        reading the connections.
+    """
+    super().__init__(instrumentation)
+    self.decode_pool = DecodePool(decode_workers) if decode_workers else None
     self.__host = host
     self.__port = port
     self.__slots = slots
     self._used_slots = 0
     self._running = False
-    self.windows: dict[str, tuple[WindowDisplay, threading.Thread]] = {}
-    self.updates = queue.Queue()
-    self.interaction_events = queue.Queue()
     self.__block = threading.Lock()
+    self._sessions = set()
+    self._channels = {}
+    self._channels_lock = threading.Lock()
     self.__server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.__init_socket()
 
@@ -58,6 +440,11 @@ class StreamReceiver:
     while self._running:
       self.__block.acquire()
       connection, _ = self.__server_socket.accept()
+      if not self._running:
+        # the connection stop_server makes to wake up accept
+        connection.close()
+        self.__block.release()
+        break
       if self._used_slots >= self.__slots:
         print("Connection refused! No free slots!")
         connection.close()
@@ -81,43 +468,101 @@ class StreamReceiver:
       self.__block.acquire()
       self.__server_socket.close()
       self.__block.release()
+      # wake up and stop the threads sending the events
+      for _ in list(self._sessions):
+        self.interaction_events.put(STOP_EVENT)
+      if self.decode_pool is not None:
+        self.decode_pool.close()
     else:
       print("Server not running!")
 
+  def _process_incoming_data(
+      self,
+      data,
+      window_id,
+      data_type,
+      flags=MessageFlags.END_OF_FRAME,
+      timestamp=0.0,
+  ):
+    """decode on the decode_pool so a slow decoding does not stop reading."""
+    if self.decode_pool is None:
+      super()._process_incoming_data(
+          data, window_id, data_type, flags, timestamp
+      )
+      return
+    if not self._running:
+      return
+    reduction = self._reduction(window_id, data_type)
+    start = self.instrumentation.now()
+
+    def apply(decoded):
+      self._apply_message(
+          decoded, window_id, data_type, flags, timestamp, reduction, start
+      )
+
+    # the data is a view on the reader buffer, the pool gets a copy
+    self.decode_pool.submit(
+        window_id,
+        self._decode_message,
+        (bytes(data), data_type, flags, reduction),
+        apply,
+        supersedes=data_type in (MessageType.FRAME, MessageType.KEYFRAME),
+    )
+
   def __client_connection(self, connection):
     """generate two threads one for incomign data and one for outgoing data."""
+    session = _ClientSession(connection)
+    self._sessions.add(session)
     in_data_thread = threading.Thread(
-        target=self.__handle_incoming_data, args=(connection,)
+        target=self.__handle_incoming_data, args=(session,)
     )
     in_data_thread.start()
 
     out_data_thread = threading.Thread(
-        target=self.__handle_out_data, args=(connection,)
+        target=self.__handle_out_data, args=(session,)
     )
     out_data_thread.start()
 
-  def __handle_incoming_data(self, connection):
+  def __handle_incoming_data(self, session):
     """handle incoming connection."""
+    connection = session.connection
+    reader = FramedReader(connection)
 
     while self._running:
       try:
-        # Receive size of metadata (window ID)
-        metadata_size_struct = self.receive_all(
-            connection, struct.calcsize("<L")
-        )
-        metadata_size = struct.unpack("<L", metadata_size_struct)[0]
-
-        # Receive the actual metadata (window ID)
-        metadata = connection.recv(metadata_size).decode("utf-8")
-        window_id, data_type, expected_frame_size = metadata.split("|")
-        expected_frame_size = int(expected_frame_size)
-
-        data = b""
-
-        while len(data) < expected_frame_size:
-          data += connection.recv(4096)
-
-        self._process_incoming_data(data, window_id, data_type)
+        if session.protocol_version == LEGACY_PROTOCOL_VERSION:
+          # Receive the metadata (window ID, data type and frame size)
+          metadata = str(reader.read_message(), "utf-8")
+          window_id, data_type, expected_frame_size = unpack_legacy(metadata)
+          flags = MessageFlags.END_OF_FRAME
+          timestamp = 0.0
+        else:
+          header = unpack_header(reader.read_exactly(HEADER.size))
+          window_id = header.window_id
+          data_type = header.message_type
+          flags = header.flags
+          timestamp = header.timestamp
+          expected_frame_size = header.payload_length
+
+        # the data is a view on the reader buffer, valid until the next read
+        start = self.instrumentation.now()
+        data = reader.read_exactly(expected_frame_size)
+        self.instrumentation.record(window_id, "receive", start)
+
+        if data_type == MessageType.HELLO:
+          self.__negotiate_protocol(session, data)
+        elif data_type == MessageType.CHANNEL:
+          with self._channels_lock:
+            channel = self._bind_channel(
+                self._channels, session, connection, data
+            )
+            if channel.get(ChannelKind.BULK) is session:
+              # the client reads the events on its events connection only
+              session.sends_events = False
+        else:
+          self._process_incoming_data(
+              data, window_id, data_type, flags, timestamp
+          )
 
       except UnicodeDecodeError:
         print("Received data is not valid UTF-8 encoded data.")
@@ -126,72 +571,96 @@ class StreamReceiver:
       except ConnectionResetError as e:
         print(f"ConnectionResetError occurred: {e}")
         break
-      except IncomingStreamingError as e:
+      except (IncomingStreamingError, ProtocolError) as e:
         print(f"Exception occurred: {e}")
         connection.close()
-        self._used_slots -= 1
         break
 
-  def receive_all(self, sock, count):
-    buf = b""
-    while count:
-      newbuf = sock.recv(count)
-      if not newbuf:
-        return None
-      buf += newbuf
-      count -= len(newbuf)
-    return buf
-
-  def _process_incoming_data(self, data, window_id, data_type):
-
-    if data_type == "frame":
-      frame = np.frombuffer(data, dtype=np.uint8)
-      frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
-      self.update_display_frame(window_id, frame)
-
-  def __handle_out_data(self, connection):
-    """handle out data."""
-
-    while True:
-      if not self.interaction_events.empty():
-        event_to_send = self.interaction_events.get()
-        print(event_to_send)
-        bytes_to_send = event_to_send.to_bytes()
-        packed_data_to_send_size = struct.pack("<L", len(bytes_to_send))
-        combined_data = packed_data_to_send_size + bytes_to_send
-
-        connection.sendall(combined_data)
+    self._used_slots -= 1
+    session.closed = True
+    with self._channels_lock:
+      self._unbind_channel(self._channels, session)
+
+  def __negotiate_protocol(self, session, data):
+    """answer the HELLO of the client with the version to use."""
+    version = unpack_hello(bytes(data))
+    if version is None:
+      print("Invalid protocol negotiation.")
+      return
+    version = min(version, PROTOCOL_VERSION)
+    session.send(SIZE.pack(HELLO.size) + pack_hello(version))
+    session.protocol_version = version
+    print(f"Using protocol version {version}.")
+
+  def __handle_out_data(self, session):
+    """send the interaction events until STOP_EVENT or the connection closes.
+
+    All the pending events are sent at once at every wake up. stop_server
+    queues a STOP_EVENT for each connection, each thread only takes one and
+    puts the others back. The bulk connection of a dual channel session
+    stops at its first wake up after it was bound and leaves the events to
+    the events connection.
+    """
+    stopping = False
+    while not stopping:
+      events = drain_queue(self.interaction_events)
+      if session.closed or not session.sends_events:
+        # leave the events and the STOP_EVENTs to the other connections,
+        # in their order
+        requeue_front(self.interaction_events, events)
+        break
 
+      data = bytearray()
+      for event_to_send in events:
+        if event_to_send is STOP_EVENT:
+          if stopping:
+            self.interaction_events.put(STOP_EVENT)
+          stopping = True
+        else:
+          print(event_to_send)
+          data += self._pack_event(event_to_send, session.protocol_version)
         self.interaction_events.task_done()
 
-  def update_display_frame(self, window_id, frame):
-    """use the incoming data to update the displays."""
-
-    displayer, _ = self.windows.get(window_id, (None, None))
-
-    if displayer is None:
-      displayer = WindowDisplay(
-          frame, window_id, self.updates, self.interaction_events
-      )
-      image_thread = threading.Thread(target=displayer.display)
-
-      self.windows[window_id] = (displayer, image_thread)
-      image_thread.start()
-    else:
-      self.updates.put((displayer.updateimg, frame))
-
-  def close_all_display(self):
-    """close all the display objects."""
+      try:
+        if data:
+          session.send(data)
+      except OSError as e:
+        print(f"Failed to send the events: {e}")
+        break
 
-    for key in self.windows.items():
-      self.updates.put((self.windows[key].quit, True))
-      self.windows[key][1].join()
+    self._sessions.discard(session)
 
   def __del__(self):
     self.stop_server()
     self.close_all_display()
 
 
+class _ClientSession:
+  """State of a client connection shared by its incoming and outgoing threads.
+
+  Attributes:
+    connection: the client socket.
+    protocol_version: negotiated protocol version.
+    closed: whether the incoming data thread stopped.
+    channel_id: session id of a dual channel session, None otherwise.
+    sends_events: whether the events are sent on the connection, not on the
+      other connection of its session.
+  """
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.protocol_version = LEGACY_PROTOCOL_VERSION
+    self.closed = False
+    self.channel_id = None
+    self.sends_events = True
+    self.__send_lock = threading.Lock()
+
+  def send(self, data):
+    """send data without interleaving it with other threads."""
+    with self.__send_lock:
+      self.connection.sendall(data)
+
+
 class IncomingStreamingError(Exception):
   """Custom exception for streaming server."""
 
@@ -0,0 +1,189 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the StreamReceiver frame updates and of its event threads."""
+
+import queue
+import socket
+import threading
+import time
+import unittest
+
+import cv2
+from events import UIevent
+from events import UIEventsTypes
+from frame_diff import pack_patch
+import numpy as np
+from protocol import MessageType
+from stream_receiver import BaseStreamReceiver
+from stream_receiver import StreamReceiver
+from streaming_client import SharedConnectionClient
+
+
+def _free_port():
+  """returns a port free on the loopback interface."""
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def _wait_for(condition, timeout=5.0):
+  """polls condition until it is true, returns its last value."""
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+
+def _png(image):
+  """encodes an image losslessly."""
+  return cv2.imencode(".png", image)[1].tobytes()
+
+
+class _ShownFrames(BaseStreamReceiver):
+  """keeps the frames passed to the displays instead of showing them."""
+
+  def __init__(self):
+    super().__init__()
+    self.shown = []
+
+  def update_display_frame(self, window_id, frame, capture_time=0.0):
+    self.shown.append(frame)
+
+
+class FrameUpdateTest(unittest.TestCase):
+
+  def test_patches_do_not_change_the_frame_shown(self):
+    receiver = _ShownFrames()
+    receiver._process_incoming_data(
+        _png(np.zeros((64, 64, 3), np.uint8)), 1, MessageType.FRAME
+    )
+    white = _png(np.full((16, 16, 3), 255, np.uint8))
+    receiver._process_incoming_data(
+        pack_patch((0, 0, 16, 16), white), 1, MessageType.PATCH, flags=0
+    )
+    receiver._process_incoming_data(
+        pack_patch((16, 16, 16, 16), white), 1, MessageType.PATCH
+    )
+    self.assertEqual(len(receiver.shown), 2)
+    self.assertFalse(receiver.shown[0].any())
+    self.assertEqual(np.count_nonzero(receiver.shown[1]), 2 * 16 * 16 * 3)
+
+  def test_region_of_interest_frame_is_shown_once_complete(self):
+    receiver = _ShownFrames()
+    # the background first, then the region of interest over it
+    receiver._process_incoming_data(
+        _png(np.zeros((64, 64, 3), np.uint8)), 1, MessageType.FRAME, flags=0
+    )
+    receiver._process_incoming_data(
+        pack_patch((16, 16, 32, 32), _png(np.full((32, 32, 3), 255, np.uint8))),
+        1,
+        MessageType.PATCH,
+    )
+    self.assertEqual(len(receiver.shown), 1)
+    self.assertTrue((receiver.shown[0][16:48, 16:48] == 255).all())
+
+
+class StreamReceiverTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.threads = set(threading.enumerate())
+    self.port = _free_port()
+    self.receiver = StreamReceiver("127.0.0.1", self.port)
+    self.receiver.start_server()
+
+  def _connect(self, count, dual_channel=False):
+    """connects count clients and waits for the receiver to serve them."""
+    clients = [
+        SharedConnectionClient(
+            "127.0.0.1",
+            self.port,
+            interaction_queue=queue.Queue(),
+            dual_channel=dual_channel,
+        )
+        for _ in range(count)
+    ]
+    sessions = count * 2 if dual_channel else count
+    self.assertTrue(
+        _wait_for(lambda: len(self.receiver._sessions) == sessions)
+    )
+    # a receiving thread still answering the negotiation when the server
+    # stops ends its connection, the client would then reconnect
+    time.sleep(0.2)
+    return clients
+
+  def _out_threads(self):
+    """the threads sending the events still alive."""
+    return [
+        thread
+        for thread in threading.enumerate()
+        if thread not in self.threads and "__handle_out_data" in thread.name
+    ]
+
+  def test_idle_cpu_with_a_client_connected(self):
+    (client,) = self._connect(1)
+    start_cpu = time.process_time()
+    time.sleep(1.0)
+    idle_cpu = time.process_time() - start_cpu
+    self.receiver.stop_server()
+    client.close()
+    # the blocked threads of both sides use next to no cpu
+    self.assertLess(idle_cpu, 0.1)
+
+  def test_stop_server_stops_the_event_threads_of_every_connection(self):
+    clients = self._connect(3)
+    self.assertEqual(len(self._out_threads()), 3)
+    self.receiver.stop_server()
+    stopped = _wait_for(lambda: not self._out_threads())
+    for client in clients:
+      client.close()
+    self.assertTrue(stopped)
+
+  def test_dual_channel_events_arrive_in_order(self):
+    (client,) = self._connect(1, dual_channel=True)
+    self.assertTrue(
+        _wait_for(
+            lambda: any(not s.sends_events for s in self.receiver._sessions)
+        )
+    )
+    for value in range(50):
+      self.receiver.interaction_events.put(
+          UIevent(UIEventsTypes.KEYSTROKE, value, window_id=1)
+      )
+    values = []
+    try:
+      for _ in range(50):
+        values.append(client.interaction_queue.get(timeout=5).value)
+    except queue.Empty:
+      pass
+    self.receiver.stop_server()
+    client.close()
+    self.assertEqual(values, list(range(50)))
+
+  def test_closed_dual_channel_clients_free_their_slots(self):
+    for _ in range(3):
+      client = SharedConnectionClient(
+          "127.0.0.1",
+          self.port,
+          interaction_queue=queue.Queue(),
+          dual_channel=True,
+      )
+      self.assertTrue(_wait_for(lambda: self.receiver._used_slots == 2))
+      client.close()
+      self.assertTrue(_wait_for(lambda: self.receiver._used_slots == 0))
+    self.receiver.stop_server()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -13,55 +13,245 @@
 # limitations under the License.
 """Module which streams the applications from the windows machine."""
 
-import hashlib
+import collections
 import queue
+import random
 import socket
 import struct
 import threading
 import time
 from typing import List
 
+from capture_sources import CaptureSource
+from capture_sources import ScreenCaptureError
 import cv2
+from delta_codec import DeltaEncoder
+from encode_pool import encode_regions
+from encode_pool import EncodePool
 from events import UIevent
-from window_capture import ScreenCaptureError
-from window_capture import WindowCapture
-from window_selection import WindowSelection
-from window_simulated_interaction import InteractionSimulator
+from events import UIEventsTypes
+from events import unpack_many
+from frame_diff import TileChangeDetector
+from framed_reader import BufferedFrameReader
+from framed_reader import FramedReader
+from instrumentation import Instrumentation
+from protocol import CHANNEL
+from protocol import ChannelKind
+from protocol import HEADER
+from protocol import LEGACY_PROTOCOL_VERSION
+from protocol import MessageFlags
+from protocol import MessageType
+from protocol import pack_channel
+from protocol import pack_header
+from protocol import pack_hello
+from protocol import pack_legacy
+from protocol import PROTOCOL_VERSION
+from protocol import ProtocolError
+from protocol import SIZE
+from protocol import StreamControl
+from protocol import unpack_control
+from protocol import unpack_header
+from protocol import unpack_hello
+from rate_control import AdaptiveFrameRate
+from rate_control import AdaptiveQuality
+from rate_control import BandwidthBudget
+from send_scheduler import FrameScheduler
+
+try:
+  from window_capture import WindowCapture
+  from window_selection import WindowSelection
+  from window_simulated_interaction import InteractionSimulator
+except ImportError:
+  # the win32 capture and input simulation only exist on windows, other
+  # platforms can still stream a CaptureSource
+  WindowCapture = None
+  WindowSelection = None
+  InteractionSimulator = None
+
+
+def _clip(rects, region):
+  """the parts of the (x, y, width, height) rectangles inside the region."""
+  region_x, region_y, region_w, region_h = region
+  clipped = []
+  for x, y, w, h in rects:
+    left, top = max(x, region_x), max(y, region_y)
+    right = min(x + w, region_x + region_w)
+    bottom = min(y + h, region_y + region_h)
+    if left < right and top < bottom:
+      clipped.append((left, top, right - left, bottom - top))
+  return clipped
 
 
 class StreamingClient:
   """Handles the streaming of window captures."""
 
-  def __init__(self, window_title, window_hwd, shared_connection):
-    """Initializes the streaming client with window and connection details."""
+  def __init__(
+      self,
+      window_title,
+      window_hwd,
+      shared_connection,
+      partial_updates=False,
+      full_frame_ratio=0.5,
+      encode_pool=None,
+      min_fps=1.0,
+      max_fps=15.0,
+      target_latency=0.1,
+      instrumentation=None,
+      capture_source: CaptureSource = None,
+      video_mode=False,
+      keyframe_interval=100,
+      lossless_colors=0,
+      recorder=None,
+      roi_size=None,
+      roi_timeout=5.0,
+      background_quality=40,
+      background_interval=4,
+  ):
+    """Initializes the streaming client with window and connection details.
+
+    Args:
+      window_title: title of the window to stream.
+      window_hwd: window handle, used as window id.
+      shared_connection: SharedConnectionClient used to send the frames.
+      partial_updates: send only the changed regions of the frame as patches,
+        the receiver must support the "patch" data type.
+      full_frame_ratio: fraction of the frame that has to change before a
+        full frame is sent instead of patches.
+      encode_pool: optional EncodePool shared between the clients, frames are
+        encoded on the capture thread when not provided.
+      min_fps: capture frame rate of a static window.
+      max_fps: capture frame rate of a window changing at every frame, the
+        bandwidth budget of the shared connection can lower it.
+      target_latency: time to send a frame, in seconds, the jpg quality and
+        the resolution are lowered to hold it.
+      instrumentation: optional Instrumentation recording the duration of
+        every stage, it can be shared between the clients.
+      capture_source: CaptureSource the frames are captured from, the window
+        is captured with WindowCapture when not provided.
+      video_mode: send the frames with the lossless inter-frame DeltaEncoder
+        instead of jpg, for mostly static or scrolling text windows. It needs
+        a receiver negotiating the protocol version 1, the frames are then
+        encoded on the capture thread, in order, even with an encode_pool.
+      keyframe_interval: frames sent between two keyframes in video mode.
+      lossless_colors: frames and patches with at most this many colours are
+        sent as png instead of jpg, sharper and smaller for flat user
+        interface, e.g. 32, and for text, e.g. 256, but slower to encode.
+        0 to always use jpg.
+      recorder: optional SessionRecorder every captured frame is appended
+        to, it can be shared between the clients.
+      roi_size: (width, height) of the region of interest around the latest
+        interaction point, None to encode the whole frame alike. For
+        roi_timeout seconds after an interaction, the region is sent at
+        every frame it changes in, the rest of the frame only every
+        background_interval frames at background_quality, the receiver
+        applies the region over it like a patch. Needs partial_updates and
+        a receiver negotiating the protocol, ignored in video mode.
+      roi_timeout: seconds the region of interest is kept after the last
+        interaction.
+      background_quality: max jpg quality outside the region of interest.
+      background_interval: frames between two updates of the outside of
+        the region of interest.
+
+    Raises:
+      ScreenCaptureError: if no capture source is provided and the win32
+        window capture is not available.
+    """
     self.window_title = window_title
     self.shared_connection = shared_connection
     self.window_id = window_hwd
-    self.fps = 5
-    self.frame_time = 1.0 / self.fps
+    self.rate_controller = AdaptiveFrameRate(
+        self.window_id,
+        min_fps,
+        max_fps,
+        shared_connection.bandwidth_budget,
+    )
+    self.fps = self.rate_controller.fps
+    self.frame_time = self.rate_controller.frame_time
+    self._refine_pending = False
     self.new_frame_avaliable = False
     self._frame_changed = True
-    self.prev_frame_hash = None
-    self.window = WindowCapture(self.window_title)
+    self.partial_updates = partial_updates
+    self.full_frame_ratio = full_frame_ratio
+    self.__change_detector = TileChangeDetector()
+    self.roi_size = roi_size
+    self.roi_timeout = roi_timeout
+    self.background_quality = background_quality
+    self.background_interval = background_interval
+    # finds the changes since the outside of the region was last sent
+    self.__background_detector = TileChangeDetector()
+    self._background_frames = background_interval
+    self._roi_active = False
+    self.encode_pool = encode_pool
+    self.lossless_colors = lossless_colors
+    self._sequence = 0
+    self.instrumentation = instrumentation or Instrumentation()
+    if capture_source is None:
+      if WindowCapture is None:
+        raise ScreenCaptureError(
+            "the window capture needs the win32 API, provide a capture_source"
+        )
+      capture_source = WindowCapture(self.window_title)
+    self.window = capture_source
+    self.recorder = recorder
+    self.max_fps = max_fps
+    self.paused = False
+    self.target_size = None
+    self._resumed = threading.Event()
+    self._resumed.set()
+    self.shared_connection.register_stream(
+        self.window_id,
+        self.request_keyframe,
+        self.__frame_sent,
+        self.apply_control,
+    )
 
     self.stop_stream_event = queue.Queue()
     self.client_thread = None
     self._running = False
-    self._configure()
+    self._configure(target_latency)
 
-  def _configure(self):
+    self.__delta_encoder = None
+    if video_mode:
+      if self.shared_connection.protocol_version == LEGACY_PROTOCOL_VERSION:
+        print("The receiver does not support the video mode, using jpg.")
+      else:
+        self.__delta_encoder = DeltaEncoder(keyframe_interval)
+    if self.roi_size is not None and (
+        not self.partial_updates
+        or self.shared_connection.protocol_version == LEGACY_PROTOCOL_VERSION
+    ):
+      # the region of interest is sent as a patch over the background
+      print("The region of interest needs partial updates, sending frames.")
+      self.roi_size = None
+
+  def _configure(self, target_latency=0.1):
     """Configures encoding parameters for streaming."""
     self.__encoding_parameters = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+    # frames can only be downscaled when the receiver gets their full size
+    self.quality_controller = AdaptiveQuality(
+        target_latency,
+        max_quality=self.__encoding_parameters[1],
+        allow_scaling=(
+            self.shared_connection.protocol_version
+            != LEGACY_PROTOCOL_VERSION
+        ),
+    )
 
   def _get_frame(self):
     """Captures a single frame from the specified window.
 
+    The frame is kept in the BGRX layout of the capture, the jpg encoder
+    ignores the X channel so converting it would only add a copy.
+
     Returns:
         frame (numpy.ndarray): Captured frame from the window.
     """
     try:
+      start = self.instrumentation.now()
       frame = self.window.screenshot()
-      frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
+      self.instrumentation.record(self.window_id, "capture", start)
+      if self.recorder is not None:
+        self.recorder.record(self.window_id, frame)
       return frame
     except ScreenCaptureError as e:
       print("An unexpected error occured " + str(e))
@@ -70,6 +260,10 @@ class StreamingClient:
   def __client_streaming(self):
     """Internal method to handle streaming framerate."""
     while self._running:
+      if not self._resumed.is_set():
+        # nothing is captured until the receiver resumes the window
+        self._resumed.wait()
+        continue
       start_time = time.time()
 
       # Get frame from window capturing module
@@ -78,56 +272,288 @@ class StreamingClient:
       if frame is None:
         continue
 
-      self._process_frame(frame)
+      self._process_frame(frame, start_time)
+
+      # adapt the frame rate to how busy the window is
+      self.fps = self.rate_controller.update(self._frame_changed)
+      self.frame_time = self.rate_controller.frame_time
 
       # Introduce delay to achieve the desired fps
       elapsed_time = time.time() - start_time
       if elapsed_time < self.frame_time:
         time.sleep(self.frame_time - elapsed_time)
 
-  def _process_frame(self, frame):
+  def _process_frame(self, frame, capture_time=0.0):
     """Processes each captured frame and sends it if there are changes.
 
     Args:
         frame (numpy.ndarray): The current frame to be processed.
+        capture_time: time the frame was captured in seconds since the epoch.
     """
 
-    # check if a new frame is avaliable
-    self._frame_changed = self.__has_frame_changed(frame)
+    # check which regions of the frame changed
+    start = self.instrumentation.now()
+    dirty_rects = self.__change_detector.detect(frame)
+    self.instrumentation.record(self.window_id, "diff", start)
+    self._frame_changed = bool(dirty_rects)
 
-    if self._frame_changed:
-      _, frame = cv2.imencode(".jpg", frame, self.__encoding_parameters)
+    if self.__delta_encoder is not None:
+      if self._frame_changed:
+        self.__encode_delta_and_send(frame, capture_time, dirty_rects)
+      return
 
-      try:
-        self.shared_connection.send_data(self.window_id, frame.tobytes(),
-                                         "frame")
-      except ConnectionResetError:
-        self._running = False
-      except ConnectionAbortedError:
-        self._running = False
-      except BrokenPipeError:
-        self._running = False
-
-  def __has_frame_changed(self, frame):
-    """Checks if the current frame is different from the previous one.
+    roi = self.__roi(frame)
+    if roi is not None:
+      self._roi_active = True
+      self.__encode_roi_and_send(frame, capture_time, dirty_rects, roi)
+      return
+    if self._roi_active:
+      # the background changes skipped while the region was active are sent
+      # with the changes of the frame
+      self._roi_active = False
+      dirty_rects = dirty_rects + self.__background_detector.detect(frame)
+      self._frame_changed = bool(dirty_rects)
 
-    Args:
-        frame: The current frame to be checked.
+    if not self._frame_changed:
+      # refine on idle: resend the static frame at full quality
+      if self._refine_pending:
+        self._refine_pending = False
+        self.__encode_and_send(
+            frame,
+            capture_time,
+            [(
+                None,
+                self.quality_controller.max_quality,
+                self.__target_scale(frame),
+            )],
+        )
+      return
+
+    rects = None
+    if (
+        self.partial_updates
+        and TileChangeDetector.dirty_ratio(dirty_rects, frame)
+        < self.full_frame_ratio
+    ):
+      rects = dirty_rects
+
+    self._refine_pending = (
+        self._refine_pending or self.quality_controller.degraded
+    )
+    self.__encode_and_send(
+        frame,
+        capture_time,
+        [(
+            rects,
+            self.quality_controller.quality,
+            min(self.quality_controller.scale, self.__target_scale(frame)),
+        )],
+    )
+
+  def __roi(self, frame):
+    """Returns the region of interest of the frame.
 
     Returns:
-        bool: True if the frame has changed, False otherwise.
+      the (x, y, width, height) region of roi_size centered on the latest
+      interaction point and moved inside the frame, None without a recent
+      interaction or in video mode.
+    """
+    if self.roi_size is None:
+      return None
+    point = self.shared_connection.interaction_point(self.window_id)
+    if point is None or time.time() - point[2] > self.roi_timeout:
+      return None
+    height, width = frame.shape[:2]
+    roi_width = min(self.roi_size[0], width)
+    roi_height = min(self.roi_size[1], height)
+    x = min(max(0, point[0] - roi_width // 2), width - roi_width)
+    y = min(max(0, point[1] - roi_height // 2), height - roi_height)
+    return x, y, roi_width, roi_height
+
+  def __encode_roi_and_send(self, frame, capture_time, dirty_rects, roi):
+    """Sends the changes inside the region of interest and the background.
+
+    The outside of the region is diffed with what was sent of it every
+    background_interval frames, even if the frame did not change since, so
+    the changes of the skipped frames are sent too.
+
+    Args:
+        frame (numpy.ndarray): The frame to send.
+        capture_time: time the frame was captured.
+        dirty_rects: regions changed since the previous frame.
+        roi: the region of interest.
+    """
+    background_rects = []
+    self._background_frames += 1
+    if self._background_frames >= self.background_interval:
+      self._background_frames = 0
+      background_rects = self.__background_detector.detect(frame)
+
+    parts = []
+    scale = self.__target_scale(frame)
+    roi_rects = _clip(dirty_rects, roi)
+    if background_rects:
+      rects = background_rects
+      if TileChangeDetector.dirty_ratio(rects, frame) >= self.full_frame_ratio:
+        rects = None
+      parts.append((
+          rects,
+          min(self.quality_controller.quality, self.background_quality),
+          min(self.quality_controller.scale, scale),
+      ))
+      # the background drawn over the region has to be covered again
+      roi_rects = [roi] if rects is None else _clip(dirty_rects + rects, roi)
+    if roi_rects:
+      parts.append((roi_rects, self.quality_controller.quality, scale))
+    if not parts:
+      return
+
+    # the background is refined at full quality once the interaction ends
+    self._refine_pending = True
+    self.__encode_and_send(frame, capture_time, parts)
+
+  def __target_scale(self, frame):
+    """the downscale factor fitting the frame in the target_size."""
+    if self.target_size is None:
+      return 1.0
+    height, width = frame.shape[:2]
+    return min(1.0, self.target_size[0] / width, self.target_size[1] / height)
+
+  def __encode_and_send(self, frame, capture_time, parts):
+    """Encodes the frame, or the rects of it, and sends it.
+
+    Args:
+        frame (numpy.ndarray): The frame to send.
+        capture_time: time the frame was captured.
+        parts: list of (rects, quality, scale) encoded in order, the rects
+          are the regions to send as patches, None to send the whole frame,
+          with the jpg quality and the downscale factor.
+    """
+    self._sequence += 1
+    sequence = self._sequence
+    parts = [
+        ([self.__encoding_parameters[0], quality], rects, scale)
+        for rects, quality, scale in parts
+    ]
+    start = self.instrumentation.now()
+
+    if self.encode_pool is None:
+      messages = encode_regions(frame, parts, self.lossless_colors)
+      self.instrumentation.record(self.window_id, "encode", start)
+      self.__send_messages(messages, sequence, capture_time)
+    else:
+      # a dropped frame leaves the receiver behind the change detector,
+      # resetting it makes the next frame a full one.
+      self.encode_pool.submit(
+          self.window_id,
+          encode_regions,
+          (frame, parts, self.lossless_colors),
+          lambda messages: self.__encoded(
+              messages, sequence, capture_time, start
+          ),
+          self.__reset_detectors,
+      )
+
+  def __encode_delta_and_send(self, frame, capture_time, rects):
+    """Encodes the frame as a keyframe or a delta and sends it.
+
+    Args:
+        frame (numpy.ndarray): The frame to send.
+        capture_time: time the frame was captured.
+        rects: regions changed since the previous frame.
+    """
+    self._sequence += 1
+    start = self.instrumentation.now()
+    message_type, data = self.__delta_encoder.encode(frame, rects)
+    self.instrumentation.record(self.window_id, "encode", start)
+    self.__send_messages(
+        [(message_type, MessageFlags.NONE, data)], self._sequence, capture_time
+    )
+
+  def __encoded(self, messages, sequence, capture_time, start):
+    """Sends the messages encoded by the pool.
+
+    The encode stage recorded includes the time waiting in the pool.
+    """
+    self.instrumentation.record(self.window_id, "encode", start)
+    self.__send_messages(messages, sequence, capture_time)
+
+  def __send_messages(self, messages, sequence, capture_time):
+    """Sends the encoded messages of a frame.
+
+    Args:
+        messages: list of (MessageType, MessageFlags, bytes) produced by
+          encode_frame.
+        sequence: sequence number of the frame.
+        capture_time: time the frame was captured.
+    """
+    sent_bytes = sum(len(data) for _, _, data in messages)
+    self.rate_controller.record_sent(sent_bytes)
+    try:
+      last = len(messages) - 1
+      for i, (data_type, flags, data) in enumerate(messages):
+        if i == last:
+          flags |= MessageFlags.END_OF_FRAME
+        self.shared_connection.send_data(
+            self.window_id, data, data_type, sequence, capture_time, flags
+        )
+    except ConnectionResetError:
+      self._running = False
+    except ConnectionAbortedError:
+      self._running = False
+    except BrokenPipeError:
+      self._running = False
+
+  def __frame_sent(self, sent_bytes, send_time, capture_time):
+    """Records a frame written to the connection.
+
+    Args:
+        sent_bytes: size of the frame.
+        send_time: seconds from the frame being queued to it being written,
+          the time waiting for the frames of the other windows included.
+        capture_time: time the frame was captured.
     """
-    current_hash = hashlib.md5(frame.tobytes()).hexdigest()
+    self.quality_controller.record_sent(sent_bytes, send_time)
+    self.instrumentation.record_duration(self.window_id, "send", send_time)
+    self.instrumentation.record_since_capture(
+        self.window_id, "capture_to_sent", capture_time
+    )
 
-    if self.prev_frame_hash is None:
-      self.prev_frame_hash = current_hash
-      return True
+  def apply_control(self, control):
+    """Applies a StreamControl of the receiver.
 
-    has_changed = current_hash != self.prev_frame_hash
-    if has_changed:
-      self.prev_frame_hash = current_hash
+    A paused window is not captured at all. The target size downscales the
+    frames like the quality controller does, the receiver still gets their
+    full size, it is ignored in video mode. The max fps of the receiver can
+    only lower the one of the client.
 
-    return has_changed
+    Args:
+      control: the StreamControl of the window.
+    """
+    self.paused = control.paused
+    if control.width and control.height:
+      self.target_size = (control.width, control.height)
+    else:
+      self.target_size = None
+    self.rate_controller.max_fps = (
+        min(self.max_fps, control.max_fps) if control.max_fps else self.max_fps
+    )
+    if self.paused:
+      self._resumed.clear()
+    else:
+      self._resumed.set()
+
+  def __reset_detectors(self):
+    """the next frame is sent in full, its background included."""
+    self.__change_detector.reset()
+    self.__background_detector.reset()
+    self._background_frames = self.background_interval
+
+  def request_keyframe(self):
+    """send the next captured frame in full, e.g. after the receiver lost it."""
+    self.__reset_detectors()
+    if self.__delta_encoder is not None:
+      self.__delta_encoder.request_keyframe()
 
   def start_stream(self):
     """Method to start the stream."""
@@ -142,49 +568,206 @@ class StreamingClient:
     """Method to stop the stream."""
     if self._running:
       self._running = False
+      self._resumed.set()
       self.stop_stream_event.put(("stop_stream", self.window_id))
+      self.shared_connection.unregister_stream(self.window_id)
+      if self.rate_controller.budget is not None:
+        self.rate_controller.budget.remove(self.window_id)
     else:
       print("Client not streaming!")
 
 
 class SharedConnectionClient:
-  """Base class that implement connection."""
+  """Base class that implement connection.
+
+  The frames of all the windows are written by a single sending thread, in
+  the order of a FrameScheduler, so one window sending large frames does not
+  delay the others and the messages of concurrent frames are not interleaved.
+  """
 
-  def __init__(self, host, port):
+  def __init__(
+      self,
+      host,
+      port,
+      handshake_timeout=1.0,
+      bandwidth_budget=None,
+      interaction_queue=None,
+      dual_channel=False,
+      send_buffer_size=4 << 20,
+      frame_scheduler=None,
+      events_buffer_size=16 << 10,
+  ):
     """Method to initialize the class.
 
     Args:
       host: ip that the msule will connect to.
       port: port the module will connect to.
+      handshake_timeout: seconds to wait for the receiver to answer the
+        protocol version negotiation before using the legacy protocol.
+      bandwidth_budget: bytes per second shared by all the streaming clients
+        of the connection, None for unlimited.
+      interaction_queue: queue to put the received events in, its owner
+        simulates them. A queue and an InteractionSimulator are created when
+        not provided.
+      dual_channel: receive the interaction events on a second connection
+        with TCP_NODELAY, so they do not wait behind the frames queued on
+        the first one. It needs a receiver negotiating the protocol version
+        1, the events come on the first connection otherwise.
+      send_buffer_size: SO_SNDBUF of the connection sending the frames in
+        dual channel mode.
+      frame_scheduler: FrameScheduler ordering the frames of the windows, the
+        window receiving the interaction events is boosted. A default one is
+        created when not provided.
+      events_buffer_size: SO_SNDBUF and SO_RCVBUF of the connection
+        receiving the events in dual channel mode.
     """
     self._host = host
     self._port = port
-    self.interaction_queue = queue.Queue()
-    self.interaction_simulator = InteractionSimulator(self.interaction_queue)
-    self.interaction_simulator_thread = threading.Thread(
-        target=self.interaction_simulator.process_queue)
-    self.interaction_simulator_thread.start()
+    self.handshake_timeout = handshake_timeout
+    self.protocol_version = LEGACY_PROTOCOL_VERSION
+    self.bandwidth_budget = BandwidthBudget(bandwidth_budget)
+    self._keyframe_requests = {}
+    self._frame_sent = {}
+    self._controls = {}
+    self._interaction_points = {}
+    self._partial_frames = collections.defaultdict(list)
+    self.frame_scheduler = frame_scheduler or FrameScheduler()
+    self.interaction_queue = interaction_queue or queue.Queue()
+    self.interaction_simulator = None
+    if interaction_queue is None and InteractionSimulator is not None:
+      self.interaction_simulator = InteractionSimulator(self.interaction_queue)
+      self.interaction_simulator_thread = threading.Thread(
+          target=self.interaction_simulator.process_queue)
+      self.interaction_simulator_thread.start()
+    self.dual_channel = dual_channel
+    self.send_buffer_size = send_buffer_size
+    self.events_buffer_size = events_buffer_size
+    self.session_id = random.getrandbits(64)
     self.receive_data_thread = None
     self._client_socket = None
+    self._events_socket = None
+    self._closed = False
+    # held while writing a frame and while (re)connecting
+    self._send_lock = threading.Lock()
     self._connect()
+    self.send_data_thread = threading.Thread(
+        target=self.__send_frames, daemon=True
+    )
+    self.send_data_thread.start()
 
   def _connect(self, max_attempts=5, delay=2):
     """Handles connection and reconnection attempts."""
-    if self._client_socket is not None:
-      self._client_socket.close()
-    self._client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    attempts = 0
-    while attempts < max_attempts:
-      try:
-        self._client_socket.connect((self._host, self._port))
-        print("Connection successful.")
-        self._restart_receive_data_thread()
-        return
-      except socket.error as e:
-        print(f"Connection attempt {attempts + 1} failed: {e}")
-        time.sleep(delay)
-        attempts += 1
-    raise ConnectionError("Failed to connect after several attempts.")
+    reconnecting = self._client_socket is not None
+    if reconnecting:
+      # wakes up the sending thread if it is blocked writing a frame
+      self.__shutdown(self._client_socket)
+    with self._send_lock:
+      if reconnecting:
+        self._client_socket.close()
+      if self._events_socket is not None:
+        self._events_socket.close()
+        self._events_socket = None
+      self._client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      if self.dual_channel:
+        self._client_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size
+        )
+      attempts = 0
+      while attempts < max_attempts:
+        try:
+          self._client_socket.connect((self._host, self._port))
+          print("Connection successful.")
+          self._handshake()
+          if self.dual_channel:
+            self._open_events_channel()
+          if reconnecting:
+            # the controls of the previous receiver no longer apply, the
+            # paused windows resume until the new one sends its own
+            for window_id, on_control in list(self._controls.items()):
+              on_control(StreamControl(window_id))
+          self._restart_receive_data_thread()
+          if reconnecting:
+            # the receiver lost the frames patches are applied on
+            self.frame_scheduler.clear()
+            for request_keyframe in list(self._keyframe_requests.values()):
+              request_keyframe()
+          return
+        except socket.error as e:
+          if self._closed:
+            # closed while reconnecting
+            return
+          print(f"Connection attempt {attempts + 1} failed: {e}")
+          time.sleep(delay)
+          attempts += 1
+      raise ConnectionError("Failed to connect after several attempts.")
+
+  def _handshake(self):
+    """Negotiates the protocol version with the receiver.
+
+    The HELLO is sent with the legacy framing so receivers not supporting the
+    negotiation ignore it, without an answer the legacy protocol is used.
+    """
+    self.protocol_version = self._negotiate(self._client_socket)
+    if self.protocol_version != LEGACY_PROTOCOL_VERSION:
+      print(f"Using protocol version {self.protocol_version}.")
+
+  def _negotiate(self, sock):
+    """Returns the protocol version negotiated on a connection.
+
+    The receiver may have events queued for the window before it reads the
+    HELLO, they come first with the legacy framing and are queued until the
+    answer, a legacy receiver never answers.
+    """
+    hello = pack_hello(PROTOCOL_VERSION)
+    sock.sendall(pack_legacy(0, MessageType.HELLO, len(hello)) + hello)
+
+    reader = FramedReader(sock, initial_size=64)
+    deadline = time.monotonic() + self.handshake_timeout
+    try:
+      while True:
+        sock.settimeout(max(deadline - time.monotonic(), 1e-3))
+        data = bytes(reader.read_message())
+        version = unpack_hello(data)
+        if version is not None:
+          return min(version, PROTOCOL_VERSION)
+        try:
+          self.interaction_queue.put(self._data_to_event(data))
+        except struct.error:
+          print("Invalid event received during the negotiation.")
+    except socket.timeout:
+      print("No protocol negotiation, using the legacy protocol.")
+      return LEGACY_PROTOCOL_VERSION
+    finally:
+      sock.settimeout(None)
+
+  def _open_events_channel(self):
+    """Opens the connection the interaction events are received on.
+
+    Both connections send a CHANNEL message with the session id so the
+    receiver can tie them together.
+    """
+    if self.protocol_version == LEGACY_PROTOCOL_VERSION:
+      print("The receiver does not support the dual channel mode.")
+      return
+    self._client_socket.sendall(
+        pack_header(MessageType.CHANNEL, 0, CHANNEL.size)
+        + pack_channel(self.session_id, ChannelKind.BULK)
+    )
+
+    events_socket = socket.create_connection((self._host, self._port))
+    events_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+      events_socket.setsockopt(
+          socket.SOL_SOCKET, option, self.events_buffer_size
+      )
+    if self._negotiate(events_socket) == LEGACY_PROTOCOL_VERSION:
+      events_socket.close()
+      return
+    events_socket.sendall(
+        pack_header(MessageType.CHANNEL, 0, CHANNEL.size)
+        + pack_channel(self.session_id, ChannelKind.EVENTS)
+    )
+    self._events_socket = events_socket
 
   def _restart_receive_data_thread(self):
     """Restarts the data receiving thread."""
@@ -194,44 +777,202 @@ class SharedConnectionClient:
     self.receive_data_thread = threading.Thread(target=self.__receive_data)
     self.receive_data_thread.start()
 
-  def send_data(self, window_id, data: bytes, data_type):
+  def register_stream(
+      self, window_id, request_keyframe, frame_sent=None, control=None
+  ):
+    """Registers a window streamed on the connection.
+
+    Args:
+      window_id: the window streamed.
+      request_keyframe: called when the receiver needs a full frame.
+      frame_sent: optional, called with the size of every frame of the
+        window written, the seconds since it was queued and its capture time.
+      control: optional, called with the StreamControl the receiver sends
+        for the window.
+    """
+    self._keyframe_requests[window_id] = request_keyframe
+    if frame_sent is not None:
+      self._frame_sent[window_id] = frame_sent
+    if control is not None:
+      self._controls[window_id] = control
+
+  def unregister_stream(self, window_id):
+    """forget a window that stopped streaming."""
+    self._keyframe_requests.pop(window_id, None)
+    self._frame_sent.pop(window_id, None)
+    self._controls.pop(window_id, None)
+    self._partial_frames.pop(window_id, None)
+    self.frame_scheduler.remove(window_id)
+
+  def send_data(
+      self,
+      window_id,
+      data: bytes,
+      data_type,
+      sequence=0,
+      timestamp=0.0,
+      flags=MessageFlags.END_OF_FRAME,
+  ):
     """Method to send data.
 
+    The messages of a window are gathered until the end of the frame, then
+    the frame is queued to the sending thread. A full frame or a keyframe
+    replaces the frames of the window not sent yet, otherwise this blocks
+    while the window has too many frames queued.
+
     Args:
       window_id: identifier of the window the data sent belongs to.
       data: the serialized data to be sent.
-      data_type: ui event type being sent.
+      data_type: MessageType of the data being sent.
+      sequence: sequence number of the frame the data belongs to.
+      timestamp: capture time of the frame the data belongs to.
+      flags: MessageFlags of the data.
     """
-    try:
-      size = len(data)
-      metadata = f"{window_id}|{data_type}|{size}".encode()
+    frame = self._partial_frames[window_id]
+    frame.append((data, data_type, sequence, timestamp, flags))
+    if not flags & MessageFlags.END_OF_FRAME:
+      return
+    del self._partial_frames[window_id]
+    self.frame_scheduler.put(
+        window_id,
+        frame,
+        sum(len(message[0]) for message in frame),
+        any(
+            message[1] in (MessageType.FRAME, MessageType.KEYFRAME)
+            for message in frame
+        ),
+    )
 
-      packed_metadata_size = struct.pack("<L", len(metadata))
+  def __send_frames(self):
+    """Writes the frames in the order of the scheduler until closed.
 
-      combined_data = packed_metadata_size + metadata + data
-      self._client_socket.sendall(combined_data)
-    except OSError as e:
-      print(f"An OSError occurred: {e}")
+    A failed write shuts the connections down, the receiving thread then
+    reconnects, the frames are dropped until it did.
+    """
+    failed_socket = None
+    while True:
+      scheduled = self.frame_scheduler.get()
+      if scheduled is None:
+        return
+      window_id, frame, queued_time = scheduled
+      start_time = time.perf_counter()
+      buffers = []
+      with self._send_lock:
+        for data, data_type, sequence, timestamp, flags in frame:
+          if self.protocol_version == LEGACY_PROTOCOL_VERSION:
+            buffers.append(pack_legacy(window_id, data_type, len(data)))
+          else:
+            buffers.append(
+                pack_header(
+                    data_type, window_id, len(data), sequence, timestamp, flags
+                )
+            )
+          buffers.append(data)
+        try:
+          self._client_socket.sendall(b"".join(buffers))
+        except OSError as e:
+          if self._client_socket is not failed_socket and not self._closed:
+            failed_socket = self._client_socket
+            print(f"An OSError occurred: {e}")
+            # in dual channel mode the receiving thread reads the events
+            # connection, shutting it down makes it reconnect
+            for sock in (self._events_socket, self._client_socket):
+              if sock is not None:
+                self.__shutdown(sock)
+          continue
+
+      frame_sent = self._frame_sent.get(window_id)
+      if frame_sent is not None:
+        frame_sent(
+            sum(len(data) for data, *_ in frame),
+            queued_time + time.perf_counter() - start_time,
+            frame[-1][3],
+        )
 
   def __receive_data(self):
-    """Method to receive data."""
+    """Method to receive data.
+
+    All the events received together are decoded at once, the controls are
+    passed to the StreamingClient of their window.
+    """
+    sock = self._events_socket or self._client_socket
+    legacy = self.protocol_version == LEGACY_PROTOCOL_VERSION
+    if legacy:
+      reader = BufferedFrameReader(sock, SIZE.size, initial_size=4096)
+    else:
+      reader = BufferedFrameReader(
+          sock,
+          HEADER.size,
+          lambda prefix: unpack_header(prefix).payload_length,
+          initial_size=4096,
+      )
 
     while True:
       try:
-        size_struct = self._client_socket.recv(struct.calcsize("<L"))
-        data_size = struct.unpack("<L", size_struct)[0]
-        data = self._client_socket.recv(data_size)
-        received_event = self._data_to_event(data)
-        self.interaction_queue.put(received_event)
+        messages = reader.read_messages()
+        if not legacy:
+          events = []
+          for prefix, data in messages:
+            header = unpack_header(prefix)
+            if header.message_type == MessageType.UI_EVENT:
+              events.append((prefix, data))
+            elif header.message_type == MessageType.CONTROL:
+              self.__control(unpack_control(header.window_id, data))
+          messages = events
+        if not messages:
+          continue
+
+        # the events must not keep a view on the reader buffer
+        received_events = unpack_many(
+            b"".join(data for _, data in messages)
+        )
+        self.frame_scheduler.set_focus(received_events[-1].window_id)
+        for received_event in received_events:
+          self.__record_interaction(received_event)
+          self.interaction_queue.put(received_event)
 
       except UnicodeDecodeError:
         print("Received data is not valid UTF-8 encoded data.")
-      except IncomingStreamingError as e:
-        print(f"Exception occurred: {e}")
-        self._client_socket.close()
-      except (ConnectionResetError, socket.error) as e:
+      except struct.error as e:
+        print(f"Invalid events received: {e}")
+      except (
+          ConnectionResetError,
+          IncomingStreamingError,
+          ProtocolError,
+          socket.error,
+      ) as e:
+        if self._closed:
+          return
         print(f"Connection error occurred: {e}")
+        # the reconnection starts a new receiving thread
         self._connect()
+        return
+
+  def __record_interaction(self, event):
+    """remember where the user interacted last with the window."""
+    if event.event_type != UIEventsTypes.KEYSTROKE.value:
+      self._interaction_points[event.window_id] = (
+          event.x, event.y, time.time()
+      )
+    elif event.window_id in self._interaction_points:
+      # typing happens where the user clicked last
+      x, y, _ = self._interaction_points[event.window_id]
+      self._interaction_points[event.window_id] = (x, y, time.time())
+
+  def interaction_point(self, window_id):
+    """Returns where the user interacted last with a window.
+
+    Returns:
+      tuple of the x and y window coordinates and the time of the last
+      interaction in seconds since the epoch, None if there was none.
+    """
+    return self._interaction_points.get(window_id)
+
+  def __control(self, control):
+    """pass a StreamControl to the client of its window."""
+    on_control = self._controls.get(control.window_id)
+    if on_control is not None:
+      on_control(control)
 
   def _data_to_event(self, data):
     """Method to close the connection."""
@@ -241,7 +982,25 @@ class SharedConnectionClient:
 
   def close(self):
     """Method to close the connection."""
-    self._client_socket.close()
+    self._closed = True
+    self.frame_scheduler.close()
+    if self.interaction_simulator is not None:
+      self.interaction_simulator.stop()
+    for sock in (self._events_socket, self._client_socket):
+      if sock is None:
+        continue
+      # wakes up the receiving thread, close alone leaves it blocked
+      self.__shutdown(sock)
+      sock.close()
+    self.send_data_thread.join()
+
+  @staticmethod
+  def __shutdown(sock):
+    """shut a socket down, ignoring the errors of a dead connection."""
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
 
 
 class IncomingStreamingError(Exception):
@@ -260,6 +1019,10 @@ if __name__ == "__main__":
   ip = "127.0.0.1"
 
   connection = SharedConnectionClient(ip, 9999)
+  pool = EncodePool()
+  # set enabled to True to print the latency of every stage
+  instrumentation = Instrumentation(enabled=False)
+  instrumentation.start_periodic_dump()
   WindowSelector = WindowSelection()
 
   streaming_clients: List[StreamingClient] = []
@@ -267,7 +1030,13 @@ if __name__ == "__main__":
   for i in range(3):
     title, hWnd = WindowSelector.select()
     print(f"Selected window {i+1}: {title}")
-    window_client = StreamingClient(title, hWnd, connection)
+    window_client = StreamingClient(
+        title,
+        hWnd,
+        connection,
+        encode_pool=pool,
+        instrumentation=instrumentation,
+    )
     window_client.start_stream()
     streaming_clients.append(window_client)
     print("Window sharing has begun. Use ctrl-C to stop.")
@@ -277,3 +1046,6 @@ if __name__ == "__main__":
 
   for client in streaming_clients:
     client.stop_stream()
+
+  pool.close()
+  instrumentation.stop_periodic_dump()
@@ -15,6 +15,8 @@
 
 import ctypes
 import threading
+from capture_sources import CaptureSource
+from capture_sources import ScreenCaptureError
 import cv2
 import numpy as np
 import PIL.Image
@@ -26,7 +28,7 @@ from window_contour_drawer import WindowContourDrawer
 from window_selection import WindowSelection
 
 
-class WindowCapture:
+class WindowCapture(CaptureSource):
   """Attributes: title: title of the window you need to capture.
 
   hwnd: window handle.
@@ -150,21 +152,15 @@ class WindowCapture:
       return window.width, window.height
     return None, None
 
-  def __del__(self):
-    """Destructor to ensure the contour drawer thread is stopped when the object is destroyed."""
+  def close(self):
+    """stop the contour drawer thread."""
     if self.drawer_thread and self.drawer_thread.is_alive():
       self.drawer.stop_drawing()
       self.drawer_thread.join()
 
-
-class ScreenCaptureError(Exception):
-  """Custom exception for screencapture."""
-
-  def __init__(
-      self, message='the incoming streaming of serialized images had a problem'
-  ):
-    self.message = message
-    super().__init__(message)
+  def __del__(self):
+    """Destructor to ensure the contour drawer thread is stopped when the object is destroyed."""
+    self.close()
 
 
 if __name__ == '__main__':
@@ -16,10 +16,47 @@
 import queue
 import threading
 import cv2
+from events import drain_queue
+from events import STOP_EVENT
 from events import UIevent
 from events import UIEventsTypes
 
 
+class FrameMailbox:
+  """Single slot holding the newest frame of a window.
+
+  A frame put while the previous one was not taken yet replaces it, so the
+  display always renders the latest frame and never builds a backlog.
+
+  Attributes:
+    dropped: number of frames replaced before being taken.
+    delivered: number of frames taken.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._frame = None
+    self._capture_time = 0.0
+    self.dropped = 0
+    self.delivered = 0
+
+  def put(self, frame, capture_time=0.0):
+    """store the frame and its capture time, replacing the one not taken yet."""
+    with self._lock:
+      if self._frame is not None:
+        self.dropped += 1
+      self._frame = frame
+      self._capture_time = capture_time
+
+  def take(self):
+    """returns the newest frame and its capture time, (None, 0.0) if empty."""
+    with self._lock:
+      frame, self._frame = self._frame, None
+      if frame is not None:
+        self.delivered += 1
+      return frame, self._capture_time
+
+
 class WindowDisplay:
   """A simple class to display the images sent during peer-to-peer.
 
@@ -27,21 +64,26 @@ class WindowDisplay:
     img: title of the window you need to capture.
     window_id: the window_id.
     interaction_queue: ui events queue.
-    work_queue: events sent by an external object (image updates).
+    mailbox: FrameMailbox the new images are put in.
     close: boolean that is check at every updated to close the displayer.
     ocr: alto xml file outputted from the optical recognition character OCR.
     img_updated: updated image to be displayed.
+    instrumentation: optional Instrumentation recording the display latency.
 
   hwnd: window handle. size: window size. position: window position.
   """
 
-  def __init__(self, img, window_id, work_queue, interaction_queue):
+  def __init__(
+      self, img, window_id, mailbox, interaction_queue, instrumentation=None
+  ):
     self.img = img
     self.window_id = window_id
     self.interaction_queue = interaction_queue
-    self.work_queue = work_queue
+    self.mailbox = mailbox
+    self.instrumentation = instrumentation
     self._running = True
     self.img_updated = True  # Flag to track image updates
+    self._capture_time = 0.0
 
   def updateimg(self, img):
     """update the img to be displayed."""
@@ -60,7 +102,16 @@ class WindowDisplay:
     while self._running:
       self._process_frame()
 
-      cv2.imshow(self.window_id, self.img)
+      if self.instrumentation is not None and self.img_updated:
+        start = self.instrumentation.now()
+        cv2.imshow(self.window_id, self.img)
+        self.instrumentation.record(self.window_id, "imshow", start)
+        self.instrumentation.record_since_capture(
+            self.window_id, "capture_to_display", self._capture_time
+        )
+        self.img_updated = False
+      else:
+        cv2.imshow(self.window_id, self.img)
 
       k = cv2.waitKey(1)
       if k != -1:
@@ -72,11 +123,11 @@ class WindowDisplay:
     cv2.destroyWindow(self.window_id)
 
   def _process_frame(self):
-    """process queue if needed."""
-    if not self.work_queue.empty():
-      task, param = self.work_queue.get()
-      task(param)
-      self.work_queue.task_done()
+    """update the image with the newest frame if any."""
+    img, capture_time = self.mailbox.take()
+    if img is not None:
+      self.updateimg(img)
+      self._capture_time = capture_time
 
   def on_mouse(self, event, x, y, p1, _):
     """handles the envent triggered by the mouseclick and triggers the queue event.
@@ -121,17 +172,20 @@ class UIEventObserver:
     self.interaction_queue = interaction_queue
 
   def wait_for_event(self):
-    """wait for the event observed to be produced."""
-    while True:
-      if not self.interaction_queue.empty():
-        event = self.interaction_queue.get()
-        print(event)
+    """wait for the events observed until STOP_EVENT is received."""
+    stopping = False
+    while not stopping:
+      for event in drain_queue(self.interaction_queue):
+        if event is STOP_EVENT:
+          stopping = True
+        elif not stopping:
+          print(event)
         self.interaction_queue.task_done()
 
 
 # Start of the main program here
 if __name__ == '__main__':
-  update_queue = queue.Queue()
+  frame_mailbox = FrameMailbox()
   interact_queue = queue.Queue()
 
   # for testing purposes you can generate test.png launching window_capture
@@ -141,7 +195,7 @@ if __name__ == '__main__':
   image_name = 'test.png'
   w_id = '1920393'
   loaded_image = cv2.imread(image_name)
-  LI = WindowDisplay(loaded_image, w_id, update_queue, interact_queue)
+  LI = WindowDisplay(loaded_image, w_id, frame_mailbox, interact_queue)
 
   # Create an instance of EventObserver and pass the producer as a parameter
   observer = UIEventObserver(interact_queue)
@@ -158,11 +212,12 @@ if __name__ == '__main__':
   input('now?')
   other_image_name = 'test1.png'
   other_loaded_image = cv2.imread(other_image_name)
-  update_queue.put((LI.updateimg, other_loaded_image))
+  frame_mailbox.put(other_loaded_image)
 
   # replace image
   input('hit a button to close')
-  update_queue.put((LI.quit, True))
+  LI.quit(True)
+  interact_queue.put(STOP_EVENT)
 
   # Wait for both threads to finish
   image_thread.join()
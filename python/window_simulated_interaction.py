@@ -15,6 +15,9 @@
 
 import queue
 from events import ClickType
+from events import coalesce_events
+from events import drain_queue
+from events import STOP_EVENT
 from events import UIevent
 import pyautogui
 import win32con
@@ -32,28 +35,29 @@ class InteractionSimulator:
   def bring_to_foreground(self, hwnd):
     """Bring the window to foreground."""
 
+    if win32gui.GetForegroundWindow() == hwnd:
+      return
     if not win32gui.IsWindowVisible(hwnd):
       raise WindowNotVisibleError()
-    if win32gui.GetForegroundWindow() != hwnd:
-      win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
-      win32gui.SetWindowPos(
-          hwnd,
-          win32con.HWND_TOPMOST,
-          0,
-          0,
-          0,
-          0,
-          win32con.SWP_NOMOVE | win32con.SWP_NOSIZE,
-      )
-      win32gui.SetWindowPos(
-          hwnd,
-          win32con.HWND_NOTOPMOST,
-          0,
-          0,
-          0,
-          0,
-          win32con.SWP_NOMOVE | win32con.SWP_NOSIZE,
-      )
+    win32gui.ShowWindow(hwnd, win32con.SW_RESTORE)
+    win32gui.SetWindowPos(
+        hwnd,
+        win32con.HWND_TOPMOST,
+        0,
+        0,
+        0,
+        0,
+        win32con.SWP_NOMOVE | win32con.SWP_NOSIZE,
+    )
+    win32gui.SetWindowPos(
+        hwnd,
+        win32con.HWND_NOTOPMOST,
+        0,
+        0,
+        0,
+        0,
+        win32con.SWP_NOMOVE | win32con.SWP_NOSIZE,
+    )
 
   def convert_to_global_coordinates(self, hwnd, local_x, local_y):
     """Convert local window to global screen coordinates."""
@@ -104,33 +108,68 @@ class InteractionSimulator:
     """Simulate writing text."""
     pyautogui.write(text, interval=0.1)
 
-  def simulate_interaction_event(self, event: UIevent):
-    """Handle event to be Simulated."""
-    if event.is_valid():
-      task = event.event_task()
-      if task == ClickType.KEY_PRESS:
-        self.key_press(event.value)
-      else:
+  def simulate_interaction_event(self, event: UIevent, focus=True):
+    """Handle event to be Simulated.
+
+    Args:
+      event: the event.
+      focus: bring the window of a mouse event to foreground first, False
+        when the previous event already did.
+
+    Returns:
+      True when the event was simulated, False when it was not valid.
+    """
+    if not event.is_valid():
+      return False
+    task = event.event_task()
+    if task == ClickType.KEY_PRESS:
+      self.key_press(event.value)
+    else:
+      if focus:
         self.bring_to_foreground(event.window_id)
-        if task == ClickType.MOUSE_CLICK:
-          self.mouse_click(
-              event.window_id, event.x, event.y, event.button().name.lower()
-          )
-        elif task == ClickType.MOUSE_DOUBLE_CLICK:
-          self.mouse_double_click(
-              event.window_id, event.x, event.y, event.button().name.lower()
-          )
-        elif task == ClickType.MOUSE_SCROLL:
-          self.mouse_scroll(event.window_id, event.x, event.y, event.value)
+      if task == ClickType.MOUSE_CLICK:
+        self.mouse_click(
+            event.window_id, event.x, event.y, event.button().name.lower()
+        )
+      elif task == ClickType.MOUSE_DOUBLE_CLICK:
+        self.mouse_double_click(
+            event.window_id, event.x, event.y, event.button().name.lower()
+        )
+      elif task == ClickType.MOUSE_SCROLL:
+        self.mouse_scroll(event.window_id, event.x, event.y, event.value)
+    return True
 
   def process_queue(self):
-    """wait for the event observed to be produced."""
-    while True:
-      if not self.interaction_queue.empty():
-        event = self.interaction_queue.get()
-        self.simulate_interaction_event(event)
+    """wait for the events and simulate them until STOP_EVENT is received.
+
+    The events pending are coalesced, a burst of scrolls is simulated as a
+    single scroll, and a window is brought to foreground once for the events
+    following each other on it.
+    """
+    stopping = False
+    while not stopping:
+      events = drain_queue(self.interaction_queue)
+      focused = None
+      for event in coalesce_events(events):
+        if event is STOP_EVENT:
+          stopping = True
+        elif not stopping:
+          try:
+            simulated = self.simulate_interaction_event(
+                event, focus=event.window_id != focused
+            )
+            if simulated and event.event_task() != ClickType.KEY_PRESS:
+              focused = event.window_id
+          except WindowNotVisibleError as e:
+            focused = None
+            print(f"Event not simulated: {e}")
+      for _ in events:
         self.interaction_queue.task_done()
 
+  def stop(self):
+    """stop process_queue once the events already queued are simulated."""
+    self.interaction_queue.put(STOP_EVENT)
+
 
 class WindowNotVisibleError(Exception):
   """Class providing a custom error for window not visible."""